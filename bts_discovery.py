@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Discovery of BTSs and UmTRXs in the local network
+#
+
+""" Concurrent network discovery with a results cache """
+
+import re
+import time
+import socket
+import argparse
+import ipaddress
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Adds helper/ to sys.path
+import testsuite_bts
+import umtrx_ctrl
+
+SSH_PORT = 22
+DEFAULT_WORKERS = 32
+DEFAULT_TTL = 60
+# Only interface networks of this size or smaller are scanned by default
+MAX_SCAN_PREFIX = 24
+
+
+def local_networks():
+    """
+    Get IPv4 networks of the local interfaces which are up
+    :return: List of (ipaddress.IPv4Interface, broadcast address or None)
+    """
+    try:
+        out = subprocess.check_output(["ip", "-o", "-4", "addr", "show",
+                                       "up"]).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    nets = []
+    for m in re.finditer(r'inet (\S+)(?: brd (\S+))?', out):
+        iface = ipaddress.IPv4Interface(m.group(1))
+        if not iface.is_loopback:
+            nets.append((iface, m.group(2)))
+    return nets
+
+
+class BtsDiscovery:
+    """
+    Finds UmTRXs with the UDP broadcast and probes hosts concurrently:
+    TCP connect to the SSH port, then uname and UmTRX EEPROM serial over
+    SSH. Probe results are cached for `ttl` seconds.
+    """
+
+    def __init__(self, login='', password='', workers=DEFAULT_WORKERS,
+                 ttl=DEFAULT_TTL, timeout=1.0):
+        """
+        :param login: SSH login
+        :param password: SSH password
+        :param workers: Maximum number of concurrent probes
+        :param ttl: Probe results lifetime (sec)
+        :param timeout: SSH port connect timeout (sec)
+        """
+        self.login = login
+        self.password = password
+        self.workers = workers
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def scan_umtrx(self, bcast_addrs, window=1.0):
+        """
+        Broadcast UmTRX detect request on all given broadcast addresses
+        :return: Dictionary { UmTRX address : control protocol version }
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            return umtrx_ctrl.detect_all(sock, bcast_addrs, window)
+        finally:
+            sock.close()
+
+    def _probe(self, ip):
+        res = {"ip": ip, "t": time.time(), "reachable": False,
+               "uname": None, "serial": None, "error": None}
+        try:
+            socket.create_connection((ip, SSH_PORT), self.timeout).close()
+        except OSError as e:
+            res["error"] = str(e)
+            return res
+        res["reachable"] = True
+        try:
+            bts = testsuite_bts.BtsControlSsh(ip, SSH_PORT, self.login,
+                                              self.password, prepare=False)
+            try:
+                res["uname"] = bts.get_uname()
+                res["serial"] = bts.get_umtrx_eeprom_val("serial")
+            finally:
+                bts.close()
+        except Exception as e:
+            res["error"] = str(e)
+        return res
+
+    def probe(self, ip):
+        """ Probe the host or return the cached result if it's fresh """
+        with self.lock:
+            res = self.cache.get(ip)
+        if res is not None and time.time() - res["t"] < self.ttl:
+            return res
+        res = self._probe(ip)
+        with self.lock:
+            self.cache[ip] = res
+        return res
+
+    def invalidate(self, ip=None):
+        """ Drop cached result of the host or of all hosts """
+        with self.lock:
+            if ip is None:
+                self.cache = {}
+            else:
+                self.cache.pop(ip, None)
+
+    def discover(self, hosts=(), subnets=(), bcast_addrs=(), window=1.0,
+                 on_result=None):
+        """
+        Find UmTRXs with the broadcast and probe them together with the
+        given hosts and all hosts of the given subnets
+        :param hosts: Host addresses to probe
+        :param subnets: Networks to probe, e.g. "192.168.1.0/24"
+        :param bcast_addrs: Broadcast addresses for UmTRX detection
+        :param window: Time to collect UmTRX detect replies (sec)
+        :param on_result: Function called with every result as soon as the
+                          probe finishes (from a worker thread)
+        :return: List of reachable hosts and UmTRXs as dictionaries with
+                 "ip", "reachable", "uname", "serial", "umtrx" and "error"
+        """
+        umtrx = self.scan_umtrx(bcast_addrs, window) if bcast_addrs else {}
+        candidates = list(hosts) + sorted(umtrx)
+        for net in subnets:
+            candidates += [str(ip) for ip in
+                           ipaddress.ip_network(net, strict=False).hosts()]
+        # Remove duplicates keeping the order
+        candidates = list(dict.fromkeys(candidates))
+
+        found = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.probe, ip) for ip in candidates]
+            for f in as_completed(futures):
+                res = dict(f.result())
+                res["umtrx"] = umtrx.get(res["ip"])
+                if not res["reachable"] and res["umtrx"] is None:
+                    continue
+                found.append(res)
+                if on_result is not None:
+                    on_result(res)
+        return sorted(found, key=lambda r: ipaddress.ip_address(r["ip"]))
+
+
+def default_scan_targets():
+    """ Subnets and broadcast addresses of the local interfaces """
+    subnets = []
+    bcast_addrs = []
+    for iface, brd in local_networks():
+        if iface.network.prefixlen >= MAX_SCAN_PREFIX:
+            subnets.append(str(iface.network))
+        if brd is not None:
+            bcast_addrs.append(brd)
+    return subnets, bcast_addrs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find BTSs and UmTRXs")
+    parser.add_argument("hosts", type=str, nargs='*',
+                        help="Additional hosts to probe")
+    parser.add_argument("-n", "--subnet", dest='subnets', action='append',
+                        help="Network to scan (default: networks of the "
+                             "local interfaces up to /%d)" % MAX_SCAN_PREFIX)
+    parser.add_argument("-b", "--broadcast", dest='bcast_addrs',
+                        action='append',
+                        help="Broadcast address for UmTRX detection "
+                             "(default: all local interfaces)")
+    parser.add_argument("-u", "--user", type=str, default='',
+                        help="SSH login")
+    parser.add_argument("-P", "--password", type=str, default='',
+                        help="SSH password")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=DEFAULT_WORKERS,
+                        help="Concurrent probes (default: %d)" %
+                             DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    subnets, bcast_addrs = default_scan_targets()
+    t = time.time()
+    found = BtsDiscovery(args.user, args.password, args.workers).discover(
+        args.hosts,
+        args.subnets if args.subnets is not None else subnets,
+        args.bcast_addrs if args.bcast_addrs is not None else bcast_addrs)
+    for r in found:
+        print("%-16s %-8s %-12s %s" % (
+            r["ip"], "UmTRX" if r["umtrx"] is not None else "",
+            r["serial"] or "-", r["uname"] or r["error"] or ""))
+    print("Found %d hosts in %.1f sec" % (len(found), time.time() - t))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# CMD57 broker. Owns the CMD57 serial port and serves several test
+# processes over a Unix socket.
+#
+
+""" Local CMD57 sharing service and its client """
+
+import os
+import time
+import queue
+import argparse
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+
+BROKER_SCHEME = "unix://"
+DEFAULT_PRIORITY = 10
+# Time to wait for the broker to open the CMD57 and to start listening (sec)
+BROKER_START_TIMEOUT = 30
+
+# Methods that only read the instrument state. Identical queued requests
+# of these from the clients sharing the instrument configuration are
+# served by a single instrument call
+QUERY_PREFIXES = ("ask_", "fetch_", "read_", "identify")
+
+
+def is_query(method):
+    return method.startswith(QUERY_PREFIXES)
+
+
+class BrokerConnection:
+    """ Connection of a client to the broker """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+
+class Cmd57Broker:
+    """
+    Serves cmd57_console method calls from many clients. Requests are
+    executed one by one in the priority order; a client can acquire the
+    instrument for a configure and measure section. Clients acquiring it
+    with equal configurations share it, otherwise the access is exclusive.
+    """
+
+    def __init__(self, dev, address):
+        """
+        :param dev: CMD57 device instance (e.g. cmd57_console.rs232)
+        :param address: Unix socket path to listen on
+        """
+        self.dev = dev
+        self.address = address
+        self.requests = queue.PriorityQueue()
+        self.seq = 0
+        self.seq_lock = threading.Lock()
+        # Clients holding the instrument: { client : configuration }
+        self.owners = {}
+        self.held = []
+        self.stats = {"requests": 0, "calls": 0}
+
+    def _put(self, priority, client, request):
+        with self.seq_lock:
+            self.seq += 1
+            self.requests.put((priority, self.seq, client, request))
+
+    def _serve_client(self, conn):
+        """ Read requests from the client connection """
+        client = BrokerConnection(conn)
+        try:
+            while True:
+                priority, method, args, kwargs = conn.recv()
+                self._put(priority, client, (method, args, kwargs))
+        except (EOFError, OSError):
+            pass
+        finally:
+            # Release the instrument if the client has gone
+            self._put(-1, client, ("release", (), {}))
+
+    def _reply(self, client, ok, value):
+        with client.lock:
+            try:
+                client.conn.send((ok, value))
+            except (OSError, ValueError):
+                pass
+
+    def _call(self, method, args, kwargs):
+        self.stats["calls"] += 1
+        try:
+            return True, getattr(self.dev, method)(*args, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            return False, e
+
+    def _may_acquire(self, config):
+        """ Check whether the instrument can be acquired with the given
+        configuration now """
+        if len(self.owners) == 0:
+            return True
+        # Don't let new clients share the instrument while a client with
+        # another configuration waits for it
+        return config is not None and \
+            all(c == config for c in self.owners.values()) and \
+            not any(item[3][0] == "acquire" for item in self.held)
+
+    def _release(self, client):
+        """ Remove the client from the owners, let the held requests go
+        when the instrument is free """
+        if client not in self.owners:
+            return
+        del self.owners[client]
+        if len(self.owners) == 0:
+            for item in self.held:
+                self.requests.put(item)
+            self.held = []
+
+    def _take_same(self, request):
+        """ Remove queued requests identical to the given query of the
+        clients sharing the instrument configuration: the owners of the
+        instrument or all clients if it isn't acquired """
+        same = []
+        rest = []
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item[3] == request and \
+                    (len(self.owners) == 0 or item[2] in self.owners):
+                same.append(item[2])
+            else:
+                rest.append(item)
+        for item in rest:
+            self.requests.put(item)
+        return same
+
+    def _dispatch(self):
+        """ Execute queued requests on the instrument """
+        while True:
+            priority, seq, client, request = self.requests.get()
+            method, args, kwargs = request
+            if method == "release":
+                self._release(client)
+                if priority >= 0:
+                    self._reply(client, True, None)
+                continue
+            if method == "acquire":
+                if client in self.owners:
+                    # Acquiring for a new section releases the previous one
+                    self._release(client)
+                    self.requests.put((priority, seq, client, request))
+                    continue
+                config = args[0] if len(args) > 0 else None
+                if not self._may_acquire(config):
+                    self.held.append((priority, seq, client, request))
+                    continue
+                self.owners[client] = config
+                self._reply(client, True, None)
+                continue
+            if len(self.owners) > 0 and client not in self.owners:
+                self.held.append((priority, seq, client, request))
+                continue
+            self.stats["requests"] += 1
+            clients = [client]
+            if is_query(method):
+                clients += self._take_same(request)
+                self.stats["requests"] += len(clients) - 1
+            ok, value = self._call(method, args, kwargs)
+            for c in clients:
+                self._reply(c, ok, value)
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        listener = Listener(self.address, family='AF_UNIX')
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._serve_client, args=(conn,),
+                                 daemon=True).start()
+        finally:
+            listener.close()
+
+
+class Cmd57BrokerClient:
+    """
+    Proxy exposing the cmd57_console methods of the device owned by the
+    broker. Calls are blocking, exceptions are re-raised locally.
+    """
+
+    def __init__(self, address, priority=DEFAULT_PRIORITY):
+        """
+        :param address: Unix socket path or "unix://<path>" string
+        :param priority: Requests priority, lower is served first
+        """
+        if address.startswith(BROKER_SCHEME):
+            address = address[len(BROKER_SCHEME):]
+        self.address = address
+        self.priority = priority
+        self.conn = Client(address, family='AF_UNIX')
+        self.lock = threading.Lock()
+
+    def _request(self, method, *args, **kwargs):
+        with self.lock:
+            self.conn.send((self.priority, method, args, kwargs))
+            ok, value = self.conn.recv()
+        if not ok:
+            raise value
+        return value
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self._request(method, *args, **kwargs)
+
+    def acquire(self, config=None):
+        """ Get the access to the instrument for a configure and measure
+        section. Acquiring it again starts a new section.
+        :param config: Instrument configuration of the section, e.g. a
+                       tuple of the settings. Clients with equal
+                       configurations running the same test script share
+                       the instrument, None gets the exclusive access """
+        return self._request("acquire", config)
+
+    def release(self):
+        """ Release the access to the instrument """
+        return self._request("release")
+
+    def quit(self):
+        """ Disconnect from the broker, the instrument stays open """
+        self.conn.close()
+
+    def __str__(self):
+        return "CMD57 broker at %s" % self.address
+
+
+def wait_broker(address, process=None, timeout=BROKER_START_TIMEOUT):
+    """
+    Wait till the broker accepts connections
+    :param address: Unix socket path or "unix://<path>" string
+    :param process: Broker process, waiting stops if it has exited
+    :param timeout: Maximum time to wait (sec)
+    :return: True if the broker is ready
+    """
+    if address.startswith(BROKER_SCHEME):
+        address = address[len(BROKER_SCHEME):]
+    t = time.time()
+    while time.time() - t < timeout:
+        try:
+            Client(address, family='AF_UNIX').close()
+            return True
+        except (FileNotFoundError, ConnectionRefusedError):
+            if process is not None and not process.is_alive():
+                return False
+            time.sleep(0.1)
+    return False
+
+
+def run_broker(port, address):
+    """ Open the CMD57 and serve it on the given socket """
+    from scpi.devices import cmd57_console as cmd57
+    dev = cmd57.rs232(port, rtscts=True)
+    try:
+        Cmd57Broker(dev, address).serve_forever()
+    finally:
+        dev.quit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CMD57 sharing broker")
+    parser.add_argument("-p", "--cmd57-port",
+                        dest='cmd57_port', type=str, default='/dev/ttyUSB0',
+                        help="Serial port name for the CMD57 control "
+                             "(default: /dev/ttyUSB0)")
+    parser.add_argument("-S", "--socket", dest='socket', type=str,
+                        default='/tmp/cmd57.sock',
+                        help="Unix socket to listen on "
+                             "(default: /tmp/cmd57.sock)")
+    args = parser.parse_args()
+    run_broker(args.cmd57_port, args.socket)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Simulated R&S CMD57 for running test scripts without the instrument
+#
+
+""" CMD57 simulator implementing the cmd57_console methods used by tests """
+
+import time
+import random
+from urllib.parse import urlparse, parse_qsl
+
+SIM_SCHEME = "sim://"
+
+# Minimum delay of every call (sec). The real instrument answers in tens of
+# milliseconds, so polling loops never spin on it
+MIN_LATENCY = 0.001
+
+# Modulation and switching spectrum measurement offsets (kHz)
+SPECTRUM_MODULATION_OFFSETS = [-1800, -1200, -600, -400, -250, -200, -100,
+                               0, 100, 200, 250, 400, 600, 1200, 1800]
+SPECTRUM_SWITCHING_OFFSETS = [-1800, -1200, -600, -400, 0,
+                              400, 600, 1200, 1800]
+
+
+class Cmd57Sim:
+    """
+    Simulated CMD57. Every call sleeps for `latency` (at least MIN_LATENCY)
+    plus a random `jitter` and measured values get gaussian noise scaled by
+    `noise`.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, noise=1.0, power=37.0,
+                 ber_time=0.0, seed=None):
+        """
+        :param latency: Base delay of every instrument call (sec)
+        :param jitter: Maximum random delay added to the base one (sec)
+        :param noise: Scale of the measurement noise, 0 to disable it
+        :param power: Nominal DUT output power (dBm)
+        :param ber_time: Duration of the BER test measurement (sec)
+        :param seed: Random seed for reproducible runs
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.noise = noise
+        self.power = power
+        self.ber_time = ber_time
+        self.rnd = random.Random(seed)
+        self.calls = 0
+        self.state = "IDLE"
+        self.network_type = "GSM900"
+        self.io_used = "I1O1"
+        self.arfcn = 1
+        self.ber_used_ts_power = -104
+        self.ber_unused_ts_power = 30
+        self.ber_test_num = 1
+
+    def __str__(self):
+        return "CMD57 simulator (latency %g sec, noise %g)" % (self.latency,
+                                                                self.noise)
+
+    def _delay(self, scale=1.0):
+        self.calls += 1
+        time.sleep(scale * max(self.latency, MIN_LATENCY) +
+                   self.rnd.uniform(0, self.jitter))
+
+    def _noisy(self, nominal, sigma):
+        return nominal + self.rnd.gauss(0, sigma * self.noise)
+
+    #
+    # Identification and setup
+    #
+
+    def identify(self):
+        self._delay()
+        return ["Rohde&Schwarz", "CMD57", "000000/000", "SIM"]
+
+    def ask_installed_options(self):
+        self._delay()
+        return ["B1", "B3", "B4", "B5", "B6", "B7", "B19", "B71", "K21"]
+
+    def set_io_used(self, io):
+        self._delay()
+        self.io_used = io
+
+    def set_network_type(self, network_type):
+        self._delay()
+        self.network_type = network_type
+
+    def ask_network_type(self):
+        self._delay()
+        return self.network_type
+
+    def configure_man(self, ccch_arfcn=None, tch_arfcn=None, tch_ts=None,
+                      tsc=None, expected_power=None, tch_tx_power=None,
+                      tch_mode=None, tch_timing=None):
+        self._delay(8)
+        if ccch_arfcn is not None:
+            self.arfcn = ccch_arfcn
+
+    def configure_spectrum_modulation(self, burst_num=None):
+        self._delay()
+
+    def ask_bts_ccch_arfcn(self):
+        self._delay()
+        return self.arfcn
+
+    def ask_dev_state(self):
+        self._delay()
+        return self.state
+
+    def switch_to_idle(self):
+        self._delay()
+        self.state = "IDLE"
+
+    def switch_to_man_bidl(self):
+        self._delay()
+        self.state = "BIDL"
+
+    def switch_to_man_bbch(self):
+        self._delay(4)
+        self.state = "BBCH"
+
+    def switch_to_man_btch(self):
+        self._delay(4)
+        self.state = "BTCH"
+
+    def quit(self):
+        pass
+
+    #
+    # Power, phase and frequency
+    #
+
+    def ask_peak_power(self):
+        self._delay(2)
+        return round(self._noisy(self.power + 0.3, 0.2), 2)
+
+    def ask_burst_power_avg(self):
+        self._delay(2)
+        return round(self._noisy(self.power, 0.2), 2)
+
+    def ask_burst_power_arr(self):
+        self._delay(4)
+        return [round(self._noisy(self.power, 0.1), 2) for _ in range(148)]
+
+    def ask_freq_err(self):
+        self._delay(2)
+        return round(self._noisy(0.0, 10.0), 1)
+
+    def ask_phase_err_arr(self):
+        self._delay(4)
+        return [round(self._noisy(0.0, 1.0), 2) for _ in range(147)]
+
+    def fetch_phase_err_pk(self):
+        self._delay()
+        return round(self._noisy(3.0, 0.5), 2)
+
+    def fetch_phase_err_rms(self):
+        self._delay()
+        return round(abs(self._noisy(1.0, 0.1)), 2)
+
+    #
+    # Spectrum
+    #
+
+    def fetch_spectrum_modulation_offsets(self):
+        self._delay()
+        return list(SPECTRUM_MODULATION_OFFSETS)
+
+    def ask_spectrum_modulation_tolerance_abs(self):
+        self._delay()
+        return [-51.0 if o else 0.0 for o in SPECTRUM_MODULATION_OFFSETS]
+
+    def ask_spectrum_modulation_tolerance_rel(self):
+        self._delay()
+        return [-60.0 if abs(o) >= 400 else -30.0 if o else 0.5
+                for o in SPECTRUM_MODULATION_OFFSETS]
+
+    def ask_spectrum_modulation(self):
+        self._delay(6)
+        return [round(self._noisy(-70.0 if abs(o) >= 400 else
+                                  -35.0 if o else 0.0, 1.0), 1)
+                for o in SPECTRUM_MODULATION_OFFSETS]
+
+    def ask_spectrum_modulation_match(self):
+        self._delay()
+        return "MATC"
+
+    def fetch_spectrum_switching_offsets(self):
+        self._delay()
+        return list(SPECTRUM_SWITCHING_OFFSETS)
+
+    def ask_spectrum_switching_tolerance_abs(self):
+        self._delay()
+        return [-36.0 if o else 0.0 for o in SPECTRUM_SWITCHING_OFFSETS]
+
+    def ask_spectrum_switching_tolerance_rel(self):
+        self._delay()
+        return [-57.0 if o else 0.0 for o in SPECTRUM_SWITCHING_OFFSETS]
+
+    def ask_spectrum_switching(self):
+        self._delay(6)
+        return [round(self._noisy(-65.0 if o else 0.0, 1.0), 1)
+                for o in SPECTRUM_SWITCHING_OFFSETS]
+
+    def ask_spectrum_switching_match(self):
+        self._delay()
+        return "MATC"
+
+    #
+    # BER settings
+    #
+
+    def set_ber_used_ts_power(self, power):
+        self._delay()
+        self.ber_used_ts_power = power
+
+    def set_ber_unused_ts_power(self, power):
+        self._delay()
+        self.ber_unused_ts_power = power
+
+    def set_ber_test_num(self, num):
+        self._delay()
+        self.ber_test_num = num
+        return num
+
+    def ask_ber_used_ts_power(self):
+        self._delay()
+        return self.ber_used_ts_power
+
+    def ask_ber_unused_ts_power(self):
+        self._delay()
+        return self.ber_unused_ts_power
+
+    def ask_ber_frames_num(self):
+        self._delay()
+        return 100
+
+    def ask_ber_max_test_time(self):
+        self._delay()
+        return 60.0
+
+    def ask_ber_abort_cond(self):
+        self._delay()
+        return "CONT"
+
+    def ask_ber_holdoff_time(self):
+        self._delay()
+        return 0.0
+
+    def ask_ber_limit_class_1b(self):
+        self._delay()
+        return 0.4
+
+    def ask_ber_max_class_1b_samples(self):
+        self._delay()
+        return 13200
+
+    def ask_ber_limit_class_2(self):
+        self._delay()
+        return 2.0
+
+    def ask_ber_max_class_2_samples(self):
+        self._delay()
+        return 7800
+
+    def ask_ber_limit_erased_frames(self):
+        self._delay()
+        return 0.1
+
+    def ask_ber_max_erased_frames_samples(self):
+        self._delay()
+        return 100
+
+    #
+    # BER results
+    #
+
+    def read_ber_test_result(self):
+        self._delay()
+        if self.ber_time > 0:
+            time.sleep(self.ber_time)
+        return "PASS"
+
+    def _ber_events(self, rate, samples):
+        return max(int(round(self._noisy(rate * samples / 100.0,
+                                         rate * samples / 400.0))), 0)
+
+    def fetch_ber_class_1b_events(self):
+        self._delay()
+        return self._ber_events(0.05, 13200)
+
+    def fetch_ber_class_1b_ber(self):
+        self._delay()
+        return round(abs(self._noisy(0.05, 0.01)), 3)
+
+    def fetch_ber_class_1b_rber(self):
+        self._delay()
+        return round(abs(self._noisy(0.05, 0.01)), 3)
+
+    def fetch_ber_class_2_events(self):
+        self._delay()
+        return self._ber_events(0.5, 7800)
+
+    def fetch_ber_class_2_ber(self):
+        self._delay()
+        return round(abs(self._noisy(0.5, 0.05)), 3)
+
+    def fetch_ber_class_2_rber(self):
+        self._delay()
+        return round(abs(self._noisy(0.5, 0.05)), 3)
+
+    def fetch_ber_erased_events(self):
+        self._delay()
+        return 0
+
+    def fetch_ber_erased_fer(self):
+        self._delay()
+        return 0.0
+
+    def fetch_ber_crc_errors(self):
+        self._delay()
+        return 0
+
+    def print_ber_test_settings(self):
+        print("BER test settings: used TS %d dBm, unused TS %d dBm" %
+              (self.ber_used_ts_power, self.ber_unused_ts_power))
+
+    def print_ber_test_result(self, *args):
+        print("BER test result: PASS (simulated)")
+
+
+def from_url(url, dut_checks=None):
+    """
+    Create simulator from "sim://?latency=0.05&noise=1&power=37&seed=1"
+    :param url: Simulator URL, all parameters are optional
+    :param dut_checks: DUT checks from bts_params. Without the power in the
+                       URL the DUT outputs the middle of its power limits
+    :return: Cmd57Sim instance
+    """
+    params = {k: float(v) for k, v in parse_qsl(urlparse(url).query)}
+    if "seed" in params:
+        params["seed"] = int(params["seed"])
+    if "power" not in params and dut_checks is not None and \
+            "burst_power_avg_min" in dut_checks:
+        params["power"] = (dut_checks["burst_power_avg_min"] +
+                           dut_checks["burst_power_avg_max"]) / 2.0
+    return Cmd57Sim(**params)
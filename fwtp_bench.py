@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FW Test Platform engine benchmark
+#
+
+""" Benchmark of the fwtp engine on synthetic test scripts """
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import yaml
+
+from fwtp_core import *
+from fwtp_engine import *
+
+BENCH_TEST_PREFIX = "bench_noop_"
+
+
+def register_noop_tests(count):
+    """ Register `count` decorated tests doing nothing """
+    names = []
+    for i in range(count):
+        name = "%s%d" % (BENCH_TEST_PREFIX, i)
+        if name not in TestSuiteConfig.KNOWN_TESTS_DESC:
+            test_checker_decorator(name, INFO="Benchmark test %d" % i,
+                                   CHECK=test_ignore_checker())(
+                lambda kwargs: kwargs["ITER"])
+        names.append(name)
+    return names
+
+
+def gen_script(bundles, tests, depth, width):
+    """
+    Generate a synthetic test script
+    :param bundles: Number of top level bundles
+    :param tests: Number of tests in every leaf bundle
+    :param depth: Nesting depth of the repeat blocks in every bundle
+    :param width: Number of args of every repeat block
+    :return: YAML string
+    """
+    names = register_noop_tests(tests)
+
+    def leaf(b, level):
+        return {"name": "leaf%d_%d" % (b, level),
+                "scope": "B%d/{{ITER}}" % b,
+                "testsuites": names}
+
+    tree = []
+    for b in range(bundles):
+        body = leaf(b, depth)
+        for level in range(depth, 0, -1):
+            body = {"name": "level%d_%d" % (b, level),
+                    "testsuites": [{"repeat": {
+                        "name": "rep%d" % level,
+                        "args": [{"VAR%d" % level: "v{{ITER}}",
+                                  "IDX%d" % level: i}
+                                 for i in range(width)],
+                        "bundle": body}}]}
+        tree.append({"bundle": body})
+    return yaml.dump(tree)
+
+
+class BenchTestResults(TestResults):
+    """ TestResults without any output """
+
+    def output_progress(self, string):
+        pass
+
+    def enter_bundle(self, t, path, bundle, disc):
+        pass
+
+    def print_result(self, t, path, ti, result, value,
+                     old_result, old_value, delta, reason):
+        pass
+
+
+def bench_visitor(path, ti, kwargs):
+    """ Minimal test visitor matching the CLI one """
+    val = ti.func(kwargs)
+    return kwargs["TR"].check_test_result(path, ti, val, **kwargs)
+
+
+def best_of(func, repeat):
+    """ Return the best wall time of `repeat` calls of func """
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def run_benchmarks(bundles, tests, depth, width, repeat):
+    """ Run all benchmarks and return dictionary of results """
+    TestSuiteConfig.DECORATOR_DEFAULT = bench_visitor
+    script = gen_script(bundles, tests, depth, width)
+    calls = bundles * tests * width ** depth
+    res = {"calls": calls}
+
+    res["parse"] = best_of(lambda: TestExecutor(script), repeat)
+
+    texec = TestExecutor(script)
+    state = {}
+
+    def run():
+        state["tr"] = BenchTestResults()
+        texec.run({"TR": state["tr"], "DUT": "bench"})
+    res["run"] = best_of(run, repeat)
+    res["dispatch_per_test"] = res["run"] / calls
+
+    tr = state["tr"]
+    res["json"] = best_of(tr.json, repeat)
+    res["summary"] = best_of(tr.summary, repeat)
+
+    variables = {"VAR%d" % i: "value%d" % i for i in range(20)}
+    variables["ITER"] = "/0/1/2"
+    subs = "TRX{{VAR3}}/BER{{ITER}}"
+    number = 10000
+    res["apply_subs"] = min(timeit.repeat(
+        lambda: apply_subs(subs, variables), number=number,
+        repeat=repeat)) / number
+    res["merge_dicts"] = min(timeit.repeat(
+        lambda: merge_dicts(variables, {"A": 1, "B": 2}, ITER="/1"),
+        number=number, repeat=repeat)) / number
+    return res
+
+
+def compare(res, baseline, threshold):
+    """ Print comparison with the baseline, return number of regressions """
+    regressions = 0
+    for key in sorted(res):
+        if key == "calls" or key not in baseline:
+            continue
+        ratio = res[key] / baseline[key] if baseline[key] > 0 else 0
+        mark = ""
+        if ratio > threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        print("%20s: %12.3e  baseline %12.3e  x%.2f%s" % (
+            key, res[key], baseline[key], ratio, mark))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="fwtp engine benchmark")
+    parser.add_argument("-b", "--bundles", type=int, default=10,
+                        help="Number of top level bundles (default: 10)")
+    parser.add_argument("-n", "--tests", type=int, default=20,
+                        help="Tests in every leaf bundle (default: 20)")
+    parser.add_argument("-d", "--depth", type=int, default=2,
+                        help="Repeat blocks nesting depth (default: 2)")
+    parser.add_argument("-w", "--width", type=int, default=5,
+                        help="Args in every repeat block (default: 5)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Repeat every measurement (default: 3)")
+    parser.add_argument("-s", "--save", type=str, default=None,
+                        help="Save results as a baseline JSON file")
+    parser.add_argument("-c", "--compare", type=str, default=None,
+                        help="Compare results with a baseline JSON file")
+    parser.add_argument("-t", "--threshold", type=float, default=1.2,
+                        help="Slowdown ratio reported as a regression "
+                             "(default: 1.2)")
+    args = parser.parse_args()
+
+    res = run_benchmarks(args.bundles, args.tests, args.depth, args.width,
+                         args.repeat)
+    res["params"] = {"bundles": args.bundles, "tests": args.tests,
+                     "depth": args.depth, "width": args.width}
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            f.write(json.dumps(res, indent=4, separators=(',', ': ')))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.loads(f.read())
+        if baseline.get("params") != res["params"]:
+            print("Warning: baseline was taken with %s" % baseline["params"])
+        res.pop("params")
+        sys.exit(1 if compare(res, baseline, args.threshold) > 0 else 0)
+
+    for key in sorted(res):
+        print("%20s: %s" % (key, res[key]))
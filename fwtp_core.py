@@ -7,6 +7,8 @@
 
 """ Core test module. Defines common constnats """
 
+import time
+import threading
 from functools import wraps
 
 TEST_NA = -1
@@ -21,6 +23,16 @@ TEST_RESULT_NAMES = {
     TEST_FAIL: "FAIL"
 }
 
+# Resource categories for the blocked time accounting
+RES_CMD57 = "cmd57"
+# BTS control commands, executed over SSH for a remote BTS
+RES_SSH = "ssh"
+# UmTRX UDP control and property tree requests made by the helpers
+RES_UDP = "udp"
+
+# Sessions unused for this time are closed by SessionRegistry (sec)
+SESSION_IDLE_TIMEOUT = 600
+
 # checkers
 
 
@@ -123,6 +135,8 @@ class TestSuiteConfig:
     DECORATOR_DEFAULT = None
     KNOWN_TESTS_DESC = {}
     CALLER_PATH = "/"
+    # TestStats of the test being executed now
+    CURRENT_STATS = None
 
 
 class TestFuncDesc:
@@ -139,6 +153,10 @@ class TestFuncDesc:
             "DUT" - Device under test compatibility list
             "INFO" - Human readable description
             "CHECK" - Checker function
+            "PROVIDES" - Names of the variables with connection objects
+                         the test puts into the execution context
+            "SETUP" - True if the test sets up the tester or the DUT, so it
+                      is run again when an interrupted run is resumed
         """
         self.testname = testname
         self.func = func
@@ -146,6 +164,8 @@ class TestFuncDesc:
         self.INFO = kwargs["INFO"] if "INFO" in kwargs else testname
         self.CHECK = kwargs["CHECK"] if "CHECK" in kwargs \
             else test_none_checker()
+        self.PROVIDES = kwargs["PROVIDES"] if "PROVIDES" in kwargs else []
+        self.SETUP = kwargs["SETUP"] if "SETUP" in kwargs else False
 
     def check_dut(self, dut):
         """
@@ -163,6 +183,247 @@ class TestFuncDesc:
         return self.INFO
 
 
+class TestStats:
+    """
+    Timing of a single test run: wall time and time blocked on every
+    resource category together with the number of round trips
+    """
+
+    def __init__(self, path, testname, nested=False):
+        """
+        :param path: Path of the test being executed
+        :param testname: Test name
+        :param nested: True if the test is called from another test
+        """
+        self.path = path
+        self.testname = testname
+        self.nested = nested
+        self.start = time.time()
+        self.duration = None
+        self.blocked = {}
+        self.round_trips = {}
+        # (category, operation, start, duration) of every accounted call
+        self.spans = []
+        self._t0 = time.perf_counter()
+
+    def account(self, category, operation, start, duration, round_trips=1):
+        """
+        Account a call blocked on the resource
+        :param category: Resource category (RES_CMD57, RES_SSH, RES_UDP,
+                         etc.)
+        :param operation: Name of the call
+        :param start: Wall time of the call start
+        :param duration: Time spent in the call (sec)
+        :param round_trips: Number of round trips made by the call
+        :return: None
+        """
+        self.blocked[category] = self.blocked.get(category, 0) + duration
+        self.round_trips[category] = \
+            self.round_trips.get(category, 0) + round_trips
+        self.spans.append((category, operation, start, duration))
+
+    def total_blocked(self):
+        """ Time blocked on all resources (sec) """
+        return sum(self.blocked.values())
+
+    def add_nested(self, stats):
+        """ Add resource totals of the finished nested test """
+        for c in stats.blocked:
+            self.blocked[c] = self.blocked.get(c, 0) + stats.blocked[c]
+        for c in stats.round_trips:
+            self.round_trips[c] = \
+                self.round_trips.get(c, 0) + stats.round_trips[c]
+
+    def stop(self):
+        self.duration = time.perf_counter() - self._t0
+
+    def as_dict(self):
+        return {"path": self.path,
+                "start": self.start,
+                "duration": self.duration,
+                "blocked": dict(self.blocked),
+                "round_trips": dict(self.round_trips)}
+
+
+def account_resource(category, operation, start, duration, round_trips=1):
+    """
+    Account time blocked on a resource to the test being executed now.
+    Ignored outside of a test
+    """
+    stats = TestSuiteConfig.CURRENT_STATS
+    if stats is not None:
+        stats.account(category, operation, start, duration, round_trips)
+
+
+class ResourceProxy:
+    """
+    Transparent proxy of an instrument or a DUT control object. Every
+    public method call is accounted as one round trip blocked on the
+    resource category. Time the call accounts to other resources itself
+    (e.g. RES_UDP of a helper run over SSH) isn't counted twice
+    """
+
+    def __init__(self, target, category):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_category", category)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        category = self._category
+
+        @wraps(attr)
+        def timed(*args, **kwargs):
+            start = time.time()
+            t0 = time.perf_counter()
+            stats = TestSuiteConfig.CURRENT_STATS
+            nested = stats.total_blocked() if stats is not None else 0
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - t0
+                if stats is not None:
+                    duration -= stats.total_blocked() - nested
+                account_resource(category, name, start, max(duration, 0))
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __str__(self):
+        return str(self._target)
+
+
+class DeferredResource:
+    """
+    Placeholder of a connection variable provided by a test which is skipped
+    on resume. The connection is established by `setup` on the first use,
+    so only the connections needed by the remaining tests are re-established
+    """
+
+    def __init__(self, setup):
+        object.__setattr__(self, "_setup", setup)
+        object.__setattr__(self, "_target", None)
+
+    def _resolve(self):
+        if self._target is None:
+            object.__setattr__(self, "_target", self._setup())
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __str__(self):
+        return str(self._resolve())
+
+
+class SessionRegistry:
+    """
+    Keeps connected DUT and instrument control objects alive between test
+    runs. Sessions are looked up by a key, checked before reuse and closed
+    after being unused for `idle_timeout` seconds.
+    """
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _close(session):
+        if session["close"] is not None:
+            try:
+                session["close"](session["obj"])
+            except Exception:
+                pass
+
+    def get(self, key, factory, check=None, close=None, release=None):
+        """
+        Get the live session or create a new one. The session is in use
+        till release() is called.
+        :param key: Session key, e.g. ("cmd57", "/dev/ttyUSB0")
+        :param factory: Function creating the session object
+        :param check: Function returning True if the object is usable
+        :param close: Function closing the object
+        :param release: Function called with the object when the test run
+                        is over
+        :return: (session object, True if an existing session is reused)
+        """
+        self.evict_idle()
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session is not None:
+            try:
+                alive = check is None or check(session["obj"])
+            except Exception:
+                alive = False
+            if alive:
+                session["busy"] = True
+                session["release"] = release
+                with self.lock:
+                    self.sessions[key] = session
+                return session["obj"], True
+            self._close(session)
+        obj = factory()
+        with self.lock:
+            self.sessions[key] = {"obj": obj, "close": close, "busy": True,
+                                  "release": release, "t": time.time()}
+        return obj, False
+
+    def release(self):
+        """ Mark all sessions unused, called when the test run is over """
+        with self.lock:
+            sessions = [s for s in self.sessions.values() if s["busy"]]
+            for session in sessions:
+                session["busy"] = False
+                session["t"] = time.time()
+        for session in sessions:
+            if session["release"] is not None:
+                try:
+                    session["release"](session["obj"])
+                except Exception:
+                    pass
+
+    def evict_idle(self):
+        """ Close the sessions unused for longer than idle_timeout """
+        t = time.time()
+        with self.lock:
+            idle = [k for k, s in self.sessions.items() if not s["busy"] and
+                    t - s["t"] > self.idle_timeout]
+            evicted = [self.sessions.pop(k) for k in idle]
+        for session in evicted:
+            self._close(session)
+
+    def close_all(self):
+        """ Close all sessions """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            self._close(session)
+
+
+def run_test_timed(path, ti, *args, **kwargs):
+    """
+    Call the test visitor (TestSuiteConfig.DECORATOR_DEFAULT) collecting
+    the test timing into TestSuiteConfig.CURRENT_STATS
+    """
+    parent = TestSuiteConfig.CURRENT_STATS
+    stats = TestStats(path, ti.testname, parent is not None)
+    TestSuiteConfig.CURRENT_STATS = stats
+    try:
+        return TestSuiteConfig.DECORATOR_DEFAULT(path, ti, *args, **kwargs)
+    finally:
+        stats.stop()
+        TestSuiteConfig.CURRENT_STATS = parent
+        if parent is not None:
+            parent.add_nested(stats)
+
+
 def test_checker_decorator(testname, **kwargs):
     """ Wrapper function for all testsuites """
 
@@ -172,7 +433,7 @@ def test_checker_decorator(testname, **kwargs):
 
         @wraps(func)
         def wrapper(*args, **kwargs):
-            return TestSuiteConfig.DECORATOR_DEFAULT(
+            return run_test_timed(
                 TestSuiteConfig.CALLER_PATH,
                 TestSuiteConfig.KNOWN_TESTS_DESC[testname],
                 *args, **kwargs)
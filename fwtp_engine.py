@@ -55,8 +55,17 @@ class TestResults(metaclass=ABCMeta):
         """
         pass
 
+    def output_debug(self, string):
+        """
+        Output debug information during a test. Ignored by default
+        :param string: Output string
+        :return: None
+        """
+        pass
+
     def __init__(self):
         self.test_results = {}
+        self.test_stats = {}
         self.prev_test_results = {}
         self.scope = 'global'
 
@@ -72,6 +81,10 @@ class TestResults(metaclass=ABCMeta):
         check_string = "bts-test.%s_" % test_id
         for file in os.listdir("out/"):
             i = file.startswith(check_string)
+            # Skip the other files of the run, e.g. the transport metrics
+            if i > 0 and not file[i + len(check_string) - 1:-5].replace(
+                    '-', '').isdigit():
+                continue
             if i > 0:
                 self.output_progress("JSON data found on %s" %
                                      file[i + len(check_string) - 1:-5])
@@ -113,6 +126,8 @@ class TestResults(metaclass=ABCMeta):
         """
         if scope in self.test_results:
             self.test_results[scope] = {}
+        if scope in self.test_stats:
+            self.test_stats[scope] = {}
 
     def _get_scope_subtree(self, scope=None):
         if scope is None:
@@ -152,6 +167,22 @@ class TestResults(metaclass=ABCMeta):
             return None, None, None
         return self.prev_test_results[self.scope][ti.testname]
 
+    def resume_test(self, path, ti, t, result, value):
+        """
+        Restore the result of the test which has passed before the resumed
+        run was interrupted
+        :param path: Path of current test
+        :param ti: Testuite information (fwtp_core.TestFuncDesc class)
+        :param t: Time of the test execution
+        :param result: Test result from the checkpoint
+        :param value: Test value from the checkpoint
+        :return: None
+        """
+        old_t, old_result, old_value = self._get_old(path, ti)
+        self._get_scope_subtree()[ti.testname] = (t, result, value)
+        self.print_result(t, path, ti, result, value,
+                          old_result, old_value, None, "resumed")
+
     def set_test_result(self, path, ti, result, value=None):
         """
         Set the result of the test exectution
@@ -171,6 +202,10 @@ class TestResults(metaclass=ABCMeta):
         except:
             pass
         self._get_scope_subtree()[ti.testname] = (t, result, value)
+        st = TestSuiteConfig.CURRENT_STATS
+        if st is not None and st.testname == ti.testname:
+            # Filled in with the duration when the test returns
+            self.test_stats.setdefault(self.scope, {})[ti.testname] = st
         self.print_result(t, path, ti, result, value,
                           old_result, old_value, delta, None)
 
@@ -202,6 +237,85 @@ class TestResults(metaclass=ABCMeta):
         return self._get_scope_subtree(scope).get(ti.testname,
                                                   (0, TEST_NA, None))
 
+    def get_test_stats(self, path, ti, scope=None):
+        """
+        Get timing of the test in the specific path
+        :param path: Path of the executed test
+        :param ti: Testsuite information (fwtp_core.TestFuncDesc class)
+        :param scope: Scope where result is stored
+        :return: fwtp_core.TestStats or None if the test hasn't been timed
+        """
+        if scope is None:
+            scope = self.scope
+        return self.test_stats.get(scope, {}).get(ti.testname)
+
+    def stats(self):
+        """
+        Get timing of all tests from current run
+        :return: Dictionary { scope : { testname : TestStats.as_dict() } }
+        """
+        return {scope: {name: st.as_dict()
+                        for name, st in self.test_stats[scope].items()}
+                for scope in self.test_stats}
+
+    def bundle_stats(self):
+        """
+        Get timing totals per bundle. Nested tests are already included in
+        the resource totals of their callers and are not counted
+        :return: Dictionary { bundle path : { "tests", "duration",
+                 "blocked", "round_trips" } }
+        """
+        bundles = {}
+        for scope in self.test_stats:
+            for st in self.test_stats[scope].values():
+                if st.nested or st.duration is None:
+                    continue
+                b = bundles.setdefault(st.path, {"tests": 0, "duration": 0,
+                                                 "blocked": {},
+                                                 "round_trips": {}})
+                b["tests"] += 1
+                b["duration"] += st.duration
+                for c in st.blocked:
+                    b["blocked"][c] = b["blocked"].get(c, 0) + st.blocked[c]
+                for c in st.round_trips:
+                    b["round_trips"][c] = \
+                        b["round_trips"].get(c, 0) + st.round_trips[c]
+        return bundles
+
+    def chrome_trace(self):
+        """
+        Format timing of current run in the Chrome trace event format
+        accepted by chrome://tracing and Perfetto. Tests are shown on the
+        first thread, resource calls on a thread per resource category
+        :return: JSON string
+        """
+        events = []
+        tids = {}
+        for scope in self.test_stats:
+            for st in self.test_stats[scope].values():
+                if st.duration is None:
+                    continue
+                events.append({"name": st.testname, "cat": "test",
+                               "ph": "X", "pid": 1, "tid": 0,
+                               "ts": st.start * 1e6,
+                               "dur": st.duration * 1e6,
+                               "args": {"scope": scope, "path": st.path,
+                                        "blocked": st.blocked,
+                                        "round_trips": st.round_trips}})
+                for category, op, start, duration in st.spans:
+                    events.append({"name": op, "cat": category,
+                                   "ph": "X", "pid": 1,
+                                   "tid": tids.setdefault(category,
+                                                          len(tids) + 1),
+                                   "ts": start * 1e6,
+                                   "dur": duration * 1e6})
+        for category, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                           "tid": tid, "args": {"name": category}})
+        events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                       "tid": 0, "args": {"name": "tests"}})
+        return json.dumps({"traceEvents": events})
+
     def json(self):
         """
         Format JSON with all test results from current run
@@ -225,6 +339,124 @@ class TestResults(metaclass=ABCMeta):
         return stat
 
 
+class TestCheckpoint:
+    """
+    Results of the executed tests and the exported variables of the run
+    saved after every test, so an interrupted run can be resumed skipping
+    the tests which have already passed. Setup tests are always run again
+    """
+
+    # Variables of the run environment, they don't identify the run and
+    # aren't saved
+    RUNTIME_VARIABLES = ("SESSIONS", "UI", "TR", "ITER", "CHECKPOINT")
+
+    def __init__(self, filename, resume=False):
+        """
+        :param filename: Checkpoint JSON file name
+        :param resume: Load the checkpoint and skip the passed tests
+        """
+        self.filename = filename
+        self.resume = resume
+        self.identity = {}
+        self.results = {}
+        self.args = None
+        self.output_progress = print
+        # Set when the run is interrupted while saving the checkpoint
+        self.aborted = False
+
+    @classmethod
+    def _serializable(cls, variables):
+        """ Variables which can be saved to JSON, e.g. no connections """
+        res = {}
+        for k, v in variables.items():
+            if k in cls.RUNTIME_VARIABLES:
+                continue
+            try:
+                res[k] = json.loads(json.dumps(v))
+            except (TypeError, ValueError):
+                pass
+        return res
+
+    def start(self, args, output_progress):
+        """
+        Bind the checkpoint to the variables of the run. In the resume mode
+        load the checkpoint of the same run and restore the variables
+        exported by the passed tests
+        :param args: Dictionary of the run variables
+        :param output_progress: Function printing progress messages
+        :return: None
+        """
+        self.identity = self._serializable(args)
+        self.args = args
+        self.output_progress = output_progress
+        if self.resume:
+            try:
+                with open(self.filename, "r") as f:
+                    data = json.load(f)
+            except (IOError, ValueError):
+                data = None
+            if data is None:
+                output_progress("No checkpoint in %s, running all tests" %
+                                self.filename)
+            elif data["identity"] != self.identity:
+                output_progress("Checkpoint %s is of another run, running "
+                                "all tests" % self.filename)
+            else:
+                self.results = data["results"]
+                for k, v in data["variables"].items():
+                    args.setdefault(k, v)
+                output_progress("Resuming from %s, %d tests passed" % (
+                    self.filename, len([r for r in self.results.values()
+                                        if r[1] == TEST_OK])))
+        self.save()
+
+    def passed(self, key):
+        """
+        :param key: Test key "<path>/<testname>"
+        :return: Tuple (time, test_result, test_value) if the test has
+                 passed in the resumed run, otherwise None
+        """
+        res = self.results.get(key) if self.resume else None
+        return tuple(res) if res is not None and res[1] == TEST_OK else None
+
+    def record(self, key, result):
+        """
+        Record the test result and save the checkpoint. The run goes on if
+        the checkpoint can't be saved. If it's interrupted while saving, the
+        previous checkpoint is kept and the remaining tests are aborted as
+        the test visitor does
+        :param key: Test key "<path>/<testname>"
+        :param result: Tuple (time, test_result, test_value)
+        :return: None
+        """
+        self.results[key] = result
+        try:
+            self.save()
+        except KeyboardInterrupt:
+            self.aborted = True
+        except OSError as e:
+            self.output_progress("Can't save checkpoint %s: %s" % (
+                self.filename, e))
+
+    def remove(self):
+        """ Remove the checkpoint of the completed run """
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def save(self):
+        """ Write the checkpoint through a temporary file """
+        variables = {k: v for k, v in self._serializable(self.args).items()
+                     if k not in self.identity}
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"identity": self.identity,
+                                "variables": variables,
+                                "results": self.results}, default=str))
+        os.replace(tmp, self.filename)
+
+
 def str2bool(v):
     """
     Helper function transforms v to boolean
@@ -320,7 +552,26 @@ class TestCaseCall:
                     "Calling %s/%s -> %s()" % (path, self.test,
                                                ti.func.__name__))
 
-            res = TestSuiteConfig.DECORATOR_DEFAULT(path, ti, kwargs)
+            checkpoint = kwargs.get("CHECKPOINT")
+            if checkpoint is not None and checkpoint.aborted:
+                kwargs["TR"].skip_test(path, ti, TEST_ABORTED)
+                return True
+            key = "%s/%s" % (path, self.test)
+            # Setup tests change the tester or the DUT state which isn't
+            # kept in the checkpoint
+            passed = checkpoint.passed(key) \
+                if checkpoint is not None and not ti.SETUP else None
+            if passed is not None:
+                kwargs["TR"].resume_test(path, ti, *passed)
+                for name in ti.PROVIDES:
+                    if name not in kwargs:
+                        kwargs[name] = DeferredResource(
+                            self._deferred_setup(path, ti, name, kwargs))
+                return True
+
+            res = run_test_timed(path, ti, kwargs)
+            if checkpoint is not None:
+                checkpoint.record(key, kwargs["TR"].get_test_result(path, ti))
             if self.abort_bundle_on_failure and res != TEST_OK:
                 kwargs["TR"].output_progress(
                     ("Test %s failed which also fails " +
@@ -334,6 +585,31 @@ class TestCaseCall:
                                                    self.name, dut))
         return True
 
+    @staticmethod
+    def _deferred_setup(path, ti, name, kwargs):
+        """
+        Make function running the skipped test to get the variable it
+        provides. The test result goes to the scope of the skipped test
+        """
+        tr = kwargs["TR"]
+        scope = tr.scope
+
+        def setup():
+            tr.output_progress("Running %s/%s to get %s" % (
+                path, ti.testname, name))
+            current_scope = tr.scope
+            tr.set_test_scope(scope)
+            try:
+                run_test_timed(path, ti, kwargs)
+            finally:
+                tr.set_test_scope(current_scope)
+            value = kwargs.get(name)
+            if value is None or isinstance(value, DeferredResource):
+                raise RuntimeError("Test %s hasn't provided %s" % (
+                    ti.testname, name))
+            return value
+        return setup
+
 
 class TestRepeat:
     """
@@ -481,7 +757,7 @@ class TestExecutor:
         Initialize the test script
         :param testscript:  YAML string representing the whole test bundle
         """
-        self.yamltree = yaml.load(testscript)
+        self.yamltree = yaml.safe_load(testscript)
         self.bundles = []
         self.errors = 0
 
@@ -512,7 +788,7 @@ class TestExecutor:
             self.errors = self.errors + 1
             print("Parsing error, don't know how to handle: %s" % bundletree)
 
-    def run(self, args):
+    def run(self, args, checkpoint=None, resume=False):
         """
         Run test execution with spicified variables in args. All tests a
         relied on specific variables:
@@ -520,14 +796,23 @@ class TestExecutor:
         'DUT' - actual DUT being tested (for test compatibility checks)
         'ITER' - internal variable to store iteration variable over the
                  repeat block. Will be overriden if it was set
+        'CHECKPOINT' - internal variable, TestCheckpoint of the run
 
         :param args: Dictionary of specified variables
+        :param checkpoint: File name to save results of the tests and the
+                           exported variables to after every test
+        :param resume: Skip tests which have passed according to the
+                       checkpoint of the same run
         :return: None
         """
         if TestExecutor.trace_calls:
             args["TR"].output_progress(
                 "Run testsuite with global variables: `%s`" % args)
         args["ITER"] = ""
+        if checkpoint is not None:
+            cp = TestCheckpoint(checkpoint, resume)
+            cp.start(args, args["TR"].output_progress)
+            args["CHECKPOINT"] = cp
         for b in self.bundles:
             if TestExecutor.trace_calls:
                 args["TR"].output_progress("Executing bundle: %s" % b)
@@ -1,66 +1,88 @@
 #!/usr/bin/env python
+#
+# Select the primary TRX of osmo-trx with the '-S' option in its runit run
+# file. The file is written only if the option has to be changed, through
+# a temporary file renamed over the original one.
+#
+# Prints the selected TRX ('1' or '2') and, when setting it, 'changed' or
+# 'unchanged' on the second line.
+#
+import os
 import re
 import sys
+import stat
 import argparse
+import tempfile
 
 CONFIG_FILE_NAME = '/etc/sv/osmo-trx/run'
 OPTION = '-S'
 
-parser = argparse.ArgumentParser()
-parser.add_argument("trx", type=str, default='',
-                    help="Pass '1' to choose TRX1 as the primary TRX. "
-                         "Pass '2' to choose TRX2 as the primary TRX. "
-                         "Pass '?' to read the current setting.")
-args = parser.parse_args()
+trx_re = re.compile(r'^[^#].*[/ ]osmo-trx ')
 
-action = args.trx
 
-#
-# Read file
-#
-
-f = open(CONFIG_FILE_NAME, 'r')
-lines = f.readlines()
-f.close()
+def get_primary(lines):
+    """ Returns '1', '2' or None if osmo-trx command line isn't found """
+    for line in lines:
+        if trx_re.match(line) is not None:
+            return '2' if OPTION in line.split() else '1'
+    return None
 
-#
-# Process the file
-#
 
-trx_re = re.compile(r'^[^#].*[/ ]osmo-trx ')
-for i in range(len(lines)):
-    if trx_re.match(lines[i]) is not None:
-        s = lines[i].split()
-        if action == '1':
-            # Remove '-S'
-            if OPTION in s:
+def set_primary(lines, trx):
+    """ Returns new lines with the '-S' option set for the TRX """
+    res = []
+    for line in lines:
+        if trx_re.match(line) is not None:
+            s = line.split()
+            if trx == '1' and OPTION in s:
+                # Remove '-S'
                 s.remove(OPTION)
-                lines[i] = ' '.join(s) + '\n'
-            print "1"
-        elif action == '2':
-            # Add '-S'
-            if OPTION not in s:
+                line = ' '.join(s) + '\n'
+            elif trx == '2' and OPTION not in s:
+                # Add '-S'
                 s.append(OPTION)
-                lines[i] = ' '.join(s) + '\n'
-            print "2"
-        elif action == '?':
-            # Check '-S'
-            if OPTION in s:
-                print "2"
-            else:
-                print "1"
-            sys.exit()
-        else:
-            raise RuntimeError('Unkown action selected')
+                line = ' '.join(s) + '\n'
+        res.append(line)
+    return res
 
-#
-# Write the file back
-#
 
-if action == '?':
-    # Normally we shouldn't get here
-    print "unknown"
-else:
-    f = open(CONFIG_FILE_NAME, 'w')
-    f.writelines(lines)
-    f.close()
+def write_atomic(filename, lines):
+    """ Write the file through a temporary file in the same directory
+    keeping the file mode """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename),
+                               prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, stat.S_IMODE(os.stat(filename).st_mode))
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trx", type=str, default='',
+                        choices=['1', '2', '?'],
+                        help="Pass '1' to choose TRX1 as the primary TRX. "
+                             "Pass '2' to choose TRX2 as the primary TRX. "
+                             "Pass '?' to read the current setting.")
+    args = parser.parse_args()
+
+    with open(CONFIG_FILE_NAME, 'r') as f:
+        lines = f.readlines()
+
+    if args.trx == '?':
+        print(get_primary(lines) or "unknown")
+        sys.exit()
+
+    new_lines = set_primary(lines, args.trx)
+    print(args.trx)
+    if new_lines != lines:
+        write_atomic(CONFIG_FILE_NAME, new_lines)
+        print("changed")
+    else:
+        print("unchanged")
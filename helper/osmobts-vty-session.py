@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Long-lived OsmoBTS VTY session. Keeps the VTY connected and tracks the
+# current config node, so a request costs only its own commands.
+#
+# Requests are read from stdin, one JSON object per line:
+#   {"node": ["configure terminal", "bts 0", "trx 0"],
+#    "commands": ["maxdly 10"]}
+# "node" lists the commands entering the config node from the enable node,
+# an empty list means the enable node itself.
+# Every request is answered with one JSON line on stdout:
+#   {"ok": true, "output": ["..."]} or {"ok": false, "error": "..."}
+# A command output starting with "%" (e.g. "% Unknown command.") is an error.
+import sys
+import json
+import socket
+import obscvty
+
+
+class VtyCommandError(Exception):
+    pass
+
+
+class vty_session:
+
+    def __init__(self, appstring="OsmoBTS", host="127.0.0.1", port=4241):
+        self.args = (appstring, host, port)
+        self.connect()
+
+    def connect(self):
+        self.vty = obscvty.VTYInteract(*self.args)
+        # Current node, None until the enable command is sent
+        self.node = None
+
+    def command(self, cmd):
+        """ Execute a command, raise VtyCommandError if VTY rejects it """
+        res = self.vty.command(cmd)
+        if res.lstrip().startswith("%"):
+            raise VtyCommandError("%s: %s" % (cmd, res.strip()))
+        return res
+
+    def enter(self, node):
+        """ Move to the config node with the minimum of commands """
+        if self.node is None:
+            # Unknown node after a connect or an error. "end" leaves any
+            # config node and is ignored outside of them
+            self.vty.command("end")
+            self.vty.command("enable")
+            self.node = []
+        if self.node != node[:len(self.node)]:
+            self.vty.command("end")
+            self.node = []
+        for cmd in node[len(self.node):]:
+            self.command(cmd)
+            self.node.append(cmd)
+
+    def _run(self, node, commands):
+        self.enter(node)
+        return [self.command(cmd) for cmd in commands]
+
+    def run(self, node, commands):
+        try:
+            return self._run(node, commands)
+        except (IOError, socket.error):
+            # osmo-bts has been restarted, reconnect and retry once
+            self.connect()
+            return self._run(node, commands)
+
+
+if __name__ == '__main__':
+    session = vty_session()
+    for line in iter(sys.stdin.readline, ''):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            req = json.loads(line)
+            rep = {"ok": True,
+                   "output": session.run(req.get("node", []),
+                                         req["commands"])}
+        except Exception as e:
+            session.node = None
+            rep = {"ok": False, "error": str(e)}
+        sys.stdout.write(json.dumps(rep) + "\n")
+        sys.stdout.flush()
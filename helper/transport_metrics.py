@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##########################
+# Transport metrics
+##########################
+
+# Counters and latency histograms of transport operations (SSH exec,
+# SFTP put, SPI transfer, ZPU action, property tree request, etc.).
+# Works with Python 2 and 3: it's used by the tester and by the helpers
+# running on the BTS.
+#
+# A helper process appends its metrics as a JSON line to METRICS_LOG on
+# exit if this file exists next to the module. The tester creates it when
+# it copies helpers to the BTS and reads it back to collect the metrics.
+
+import os
+import json
+import time
+import atexit
+import threading
+
+METRICS_LOG = "transport_metrics.log"
+
+# Upper bounds of the latency histogram buckets (sec), the last bucket
+# counts everything slower
+LATENCY_BUCKETS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+                   0.1, 0.3, 1.0, 3.0, 10.0]
+
+
+class OperationMetrics:
+    """ Counters of a single operation """
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.hist = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, duration, bytes_out=0, bytes_in=0):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        i = 0
+        while i < len(LATENCY_BUCKETS) and duration > LATENCY_BUCKETS[i]:
+            i += 1
+        self.hist[i] += 1
+
+    def merge(self, d):
+        """ Add counters from the dictionary returned by as_dict() """
+        self.count += d["count"]
+        self.timeouts += d["timeouts"]
+        self.errors += d["errors"]
+        self.total += d["total"]
+        for k, f in (("min", min), ("max", max)):
+            if d[k] is not None:
+                v = getattr(self, k)
+                setattr(self, k, d[k] if v is None else f(v, d[k]))
+        self.bytes_out += d["bytes_out"]
+        self.bytes_in += d["bytes_in"]
+        self.hist = [a + b for a, b in zip(self.hist, d["hist"])]
+
+    def as_dict(self):
+        return {"count": self.count,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "total": self.total,
+                "avg": self.total / self.count if self.count > 0 else None,
+                "min": self.min,
+                "max": self.max,
+                "bytes_out": self.bytes_out,
+                "bytes_in": self.bytes_in,
+                "hist": list(self.hist)}
+
+
+class TransportMetrics:
+    """ Thread safe registry of the operation metrics """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = {}
+
+    def _op(self, op):
+        m = self.ops.get(op)
+        if m is None:
+            m = self.ops[op] = OperationMetrics()
+        return m
+
+    def record(self, op, duration, bytes_out=0, bytes_in=0):
+        """
+        Account a completed operation
+        :param op: Operation name
+        :param duration: Operation time (sec)
+        :param bytes_out: Bytes sent
+        :param bytes_in: Bytes received
+        """
+        with self.lock:
+            self._op(op).add(duration, bytes_out, bytes_in)
+
+    def timeout(self, op):
+        """ Account a timed out operation """
+        with self.lock:
+            self._op(op).timeouts += 1
+
+    def error(self, op):
+        """ Account a failed operation """
+        with self.lock:
+            self._op(op).errors += 1
+
+    def merge(self, snapshot):
+        """ Add metrics from the dictionary returned by snapshot() """
+        with self.lock:
+            for op in snapshot:
+                self._op(op).merge(snapshot[op])
+
+    def snapshot(self):
+        """
+        Get all metrics
+        :return: Dictionary { operation : OperationMetrics.as_dict() }
+        """
+        with self.lock:
+            return dict((op, self.ops[op].as_dict()) for op in self.ops)
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+
+
+def now():
+    """ Monotonic clock if available (python 3) """
+    return time.perf_counter() if hasattr(time, "perf_counter") \
+        else time.time()
+
+
+# Metrics of this process
+METRICS = TransportMetrics()
+
+
+def load_log(filename):
+    """ Merge all records of the metrics log into a new TransportMetrics """
+    metrics = TransportMetrics()
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                metrics.merge(json.loads(line))
+    return metrics
+
+
+def _append_log(filename):
+    if len(METRICS.ops) == 0:
+        return
+    try:
+        with open(filename, "a") as f:
+            f.write(json.dumps(METRICS.snapshot()) + "\n")
+    except (IOError, OSError):
+        pass
+
+
+_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), METRICS_LOG)
+if os.path.exists(_log):
+    atexit.register(_append_log, _log)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Calibration of both UmTRX LMS chips for a set of bands in one process.
+# Register sequences of LMS1 and LMS2 are independent, so they are run
+# concurrently over the shared asyncio control client. The result is a
+# report with timing and result of every step.
+#
+import sys
+import json
+import time
+import socket
+import argparse
+import contextlib
+
+import umtrx_ctrl
+import umtrx_lms
+from umtrx_ctrl_async import umtrx_async_ctrl
+
+# Band centers: (Tx, Rx) in Hz. Tx is the BTS downlink
+PRESETS = {
+    "GSM850": (881.5e6, 836.5e6),
+    "EGSM900": (942.5e6, 897.5e6),
+    "GSM1800": (1842.5e6, 1747.5e6),
+    "GSM1900": (1960.0e6, 1880.0e6),
+}
+PRESET_ALIASES = {
+    "GSM900": "EGSM900",
+    "DCS1800": "GSM1800",
+    "PCS1900": "GSM1900",
+}
+
+
+def parse_preset(preset):
+    """ Parse space separated list of bands in umtrx_auto_calibration
+    format, e.g. "GSM900 DCS1800" """
+    bands = []
+    for band in preset.split():
+        band = PRESET_ALIASES.get(band.upper(), band.upper())
+        if band not in PRESETS:
+            raise ValueError("Unknown band '%s'" % band)
+        if band not in bands:
+            bands.append(band)
+    return bands
+
+
+class calibration_steps:
+    """ Runs calibration steps of a single LMS and records them """
+
+    def __init__(self, lms_dev, lms, t0):
+        self.lms_dev = lms_dev
+        self.lms = lms
+        self.t0 = t0
+        self.steps = []
+
+    def run(self, name, band, func, *args):
+        """ Call func(lms_dev, *args) and record the step. Returns the
+        function result, None if the UmTRX stopped responding """
+        t = time.time()
+        error = None
+        try:
+            res = func(self.lms_dev, *args)
+        except socket.timeout as e:
+            res = None
+            error = str(e)
+        step = {"lms": self.lms, "step": name, "band": band,
+                "start": t - self.t0, "duration": time.time() - t,
+                "result": bool(res[0] if isinstance(res, tuple) else res)}
+        if isinstance(res, tuple):
+            step["cached"] = res[1]
+        if error is not None:
+            step["error"] = error
+        self.steps.append(step)
+        return res
+
+
+def calibrate_lms(lms_dev, ref_clock, lpf_bandwidth_code, bands, t0,
+                  cache=None, serial=None):
+    """ Calibrate the LMS and check that both PLLs tune to every band.
+    Returns list of steps """
+    lms = lms_dev.spi.spi_num
+    steps = calibration_steps(lms_dev, lms, t0)
+    if cache is not None:
+        res = steps.run("auto_calibration", None,
+                        umtrx_lms.lms_auto_calibration_cached, ref_clock,
+                        lpf_bandwidth_code, cache, serial)
+    else:
+        res = steps.run("auto_calibration", None,
+                        umtrx_lms.lms_auto_calibration, ref_clock,
+                        lpf_bandwidth_code)
+    if res is None:
+        return steps.steps
+    for band in bands:
+        tx, rx = PRESETS[band]
+        steps.run("tx_pll_tune", band, umtrx_lms.lms_tx_pll_tune, ref_clock,
+                  int(tx))
+        steps.run("rx_pll_tune", band, umtrx_lms.lms_rx_pll_tune, ref_clock,
+                  int(rx))
+    return steps.steps
+
+
+def calibrate(umtrx, bands, ref_clock=26000000, lpf_bandwidth_code=0x0f,
+              cache=None, serial=None):
+    """ Calibrate both LMS chips of the UmTRX concurrently.
+    Returns the report dictionary """
+    t0 = time.time()
+    ctrl = umtrx_async_ctrl(umtrx)
+    try:
+        per_lms = ctrl.run_per_lms(calibrate_lms, ref_clock,
+                                   lpf_bandwidth_code, bands, t0, cache,
+                                   serial)
+        retransmits = ctrl.client.retransmits
+    finally:
+        ctrl.close()
+    steps = sorted(per_lms[0] + per_lms[1], key=lambda s: s["start"])
+    return {"umtrx": umtrx,
+            "serial": serial,
+            "bands": bands,
+            "duration": time.time() - t0,
+            "retransmits": retransmits,
+            "result": len(steps) > 0 and all(s["result"] for s in steps),
+            "steps": steps}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Calibrate both UmTRX LMS chips for the given bands.')
+    parser.add_argument('--umtrx-addr', dest='umtrx', default='192.168.10.2',
+                        help='UmTRX address (default: 192.168.10.2)')
+    parser.add_argument('--preset', default='EGSM900',
+                        help='Space separated bands: GSM850, EGSM900 ' +
+                             '(same as GSM900), GSM1800 (same as DCS1800),' +
+                             ' GSM1900 (same as PCS1900)')
+    parser.add_argument('--pll-ref-clock', type=float, default=26e6,
+                        help='PLL reference clock, 26MHz by default')
+    parser.add_argument('--lpf-bandwidth-code',
+                        type=lambda s: int(s, 16), default=0x0f,
+                        choices=range(0, 0x10), metavar='0..0x0f',
+                        help='LPF bandwidth code (default: 0x0f)')
+    parser.add_argument('--calibration-cache', metavar='FILE', nargs='?',
+                        const=umtrx_lms.CALIBRATION_CACHE,
+                        help='use the calibration cache (default: ' +
+                             umtrx_lms.CALIBRATION_CACHE + ')')
+    parser.add_argument('--serial',
+                        help='UmTRX serial, required with ' +
+                             '--calibration-cache')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+    if args.calibration_cache is not None and args.serial is None:
+        sys.exit('--calibration-cache requires --serial.')
+    try:
+        bands = parse_preset(args.preset)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(umtrx_ctrl.UDP_TIMEOUT)
+    if umtrx_ctrl.detect(sock, args.umtrx) is None:
+        sys.exit('UmTRX at %s is not responding.' % args.umtrx)
+    sock.close()
+
+    cache = umtrx_lms.lms_calibration_cache(args.calibration_cache) \
+        if args.calibration_cache is not None else None
+    # Progress output of the calibration procedures goes to stderr to keep
+    # the report on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        report = calibrate(args.umtrx, bands, int(args.pll_ref_clock),
+                           args.lpf_bandwidth_code, cache, args.serial)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for s in report["steps"]:
+            print('LMS%d %-16s %-8s %7.3f %7.3f  %s' % (
+                s["lms"], s["step"], s["band"] or '', s["start"],
+                s["duration"], 'SUCCESS' if s["result"] else 'FAIL'))
+        print('%s in %.3f sec, %d retransmits' % (
+            'SUCCESS' if report["result"] else 'FAIL', report["duration"],
+            report["retransmits"]))
+    sys.exit(0 if report["result"] else 1)
@@ -17,12 +17,20 @@
 #
 import struct
 import socket
+import itertools
+from transport_metrics import METRICS, now
 # pylint: disable = C0301, C0103, C0111, R0903, R0913
 
 UDP_CONTROL_PORT = 49152
 UDP_MAX_XFER_BYTES = 1024
 UDP_TIMEOUT = 1
 UDP_POLL_INTERVAL = 0.10  # in seconds
+# Retransmit timer limits and initial value before any RTT sample
+UDP_MIN_RTO = 0.005
+UDP_INITIAL_RTO = 0.1
+UDP_RETRIES = 5
+# Maximum number of requests in flight for batched transfers
+UDP_WINDOW = 16
 # Must match firmware proto. We're setting it in detect()
 USRP2_CONTROL_PROTO_VERSION = 11
 supported_control_proto_versions = [11, 12]
@@ -83,9 +91,14 @@ def pack_zpu_action_fmt(proto_ver, pktid, seq, action, data):
     return struct.pack(ZPU_ACTION_FMT, proto_ver, pktid, seq, action, data)
 
 
-def recv_item(skt, fmt, chk, ind):
+def recv_item(skt, fmt, chk, ind, op=None, t0=None, sent=0):
+    """ Receive a reply packet and return (item at `ind`, proto version).
+    If `op` is given the transaction started at `t0` with `sent` bytes
+    is accounted in the transport metrics """
     try:
         pkt = skt.recv(UDP_MAX_XFER_BYTES)
+        if op is not None:
+            METRICS.record(op, now() - t0, sent, len(pkt))
         pkt_list = unpack_format(pkt, fmt)
         # print("Received %d bytes: %x, '%c', %x" % (len(pkt), pkt_list[0],
         #     pkt_list[1], pkt_list[2]))
@@ -93,15 +106,228 @@ def recv_item(skt, fmt, chk, ind):
             return (None, None)
         return (pkt_list[ind], pkt_list[0])
     except socket.timeout:
+        if op is not None:
+            METRICS.timeout(op)
         return (None, None)
 
 
+# Sequence numbers are unique in the process, so a reply can't be taken
+# for a request of another device sharing the socket. 0 is left for
+# detect() and ping()
+_seq = itertools.count(1)
+
+
+def next_seq():
+    return next(_seq) & 0xffffffff
+
+
+class rtt_estimator:
+    """ Retransmit timeout from the RFC 6298 style SRTT/RTTVAR estimate """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = UDP_INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, UDP_MIN_RTO),
+                       UDP_TIMEOUT)
+
+
+class umtrx_udp_transport:
+    """ Request/response transport with per-request sequence numbers and
+    adaptive retransmit timeout. Replies with an unexpected id or sequence
+    number are discarded. """
+
+    def __init__(self, umtrx_socket, net_address):
+        self.skt = umtrx_socket
+        self.addr = net_address
+        self.rtt = rtt_estimator()
+        self.retransmits = 0
+        self.stale = 0
+
+    def transact(self, pack, fmt, chk, ind, op):
+        """ Send a request and wait for the matching reply.
+        pack - function building the request packet for a sequence number
+        fmt, chk, ind - reply format, reply id and index of the result
+        op - operation name for the transport metrics
+        Returns (item at `ind`, proto version) or (None, None) if all
+        retransmits are lost. Every retransmit gets a new sequence
+        number, so any reply gives an unambiguous RTT sample. """
+        self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 0)
+        timeout = self.skt.gettimeout()
+        t_first = now()
+        sent = {}
+        rto = self.rtt.rto
+        try:
+            for attempt in range(UDP_RETRIES + 1):
+                seq = next_seq()
+                out_pkt = pack(seq)
+                sent[seq] = now()
+                self.skt.sendto(out_pkt, (self.addr, UDP_CONTROL_PORT))
+                deadline = sent[seq] + rto
+                while True:
+                    remaining = deadline - now()
+                    if remaining <= 0:
+                        break
+                    self.skt.settimeout(remaining)
+                    try:
+                        pkt = self.skt.recv(UDP_MAX_XFER_BYTES)
+                    except socket.timeout:
+                        break
+                    t = now()
+                    try:
+                        pkt_list = unpack_format(pkt, fmt)
+                    except struct.error:
+                        self.stale += 1
+                        continue
+                    if pkt_list[1] != chk or pkt_list[2] not in sent:
+                        self.stale += 1
+                        continue
+                    self.rtt.sample(t - sent[pkt_list[2]])
+                    METRICS.record(op, t - t_first,
+                                   len(out_pkt) * len(sent), len(pkt))
+                    return (pkt_list[ind], pkt_list[0])
+                METRICS.timeout(op)
+                self.retransmits += 1
+                rto = min(rto * 2, UDP_TIMEOUT)
+            # Keep the backed off timer for the next request
+            self.rtt.rto = rto
+            METRICS.error(op)
+            return (None, None)
+        finally:
+            self.skt.settimeout(timeout)
+
+    def transact_many(self, packs, fmt, chk, ind, op, window=UDP_WINDOW,
+                      seqs=None):
+        """ Pipelined transact() of a batch of requests: up to `window`
+        requests are in flight and replies are matched by the sequence
+        number. Lost requests are retransmitted with their own backoff, so
+        the execution order of the requests is not guaranteed.
+        seqs - list to fill with the sequence numbers of the accepted
+               replies in the order of `packs`
+        Returns the list of items at `ind` in the order of `packs`, None
+        for every request which got no reply after all retransmits. """
+        self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 0)
+        timeout = self.skt.gettimeout()
+        results = [None] * len(packs)
+        # seq -> request index for all sent packets, the late replies to
+        # retransmitted requests are still valid
+        sent = {}
+        # seq -> (request index, send time, deadline) of the requests in
+        # flight
+        inflight = {}
+        attempts = [0] * len(packs)
+        first_sent = [None] * len(packs)
+        bytes_out = [0] * len(packs)
+        done = [False] * len(packs)
+        queue = list(range(len(packs)))
+        queue.reverse()
+        try:
+            while queue or inflight:
+                while queue and len(inflight) < window:
+                    i = queue.pop()
+                    seq = next_seq()
+                    out_pkt = packs[i](seq)
+                    t = now()
+                    if first_sent[i] is None:
+                        first_sent[i] = t
+                    rto = min(self.rtt.rto * (1 << attempts[i]), UDP_TIMEOUT)
+                    bytes_out[i] += len(out_pkt)
+                    sent[seq] = i
+                    inflight[seq] = (i, t, t + rto)
+                    self.skt.sendto(out_pkt, (self.addr, UDP_CONTROL_PORT))
+                remaining = min(v[2] for v in inflight.values()) - now()
+                pkt = None
+                if remaining > 0:
+                    self.skt.settimeout(remaining)
+                    try:
+                        pkt = self.skt.recv(UDP_MAX_XFER_BYTES)
+                    except socket.timeout:
+                        pass
+                t = now()
+                if pkt is not None:
+                    try:
+                        pkt_list = unpack_format(pkt, fmt)
+                    except struct.error:
+                        pkt_list = None
+                    if pkt_list is None or pkt_list[1] != chk or \
+                            pkt_list[2] not in sent or \
+                            done[sent[pkt_list[2]]]:
+                        self.stale += 1
+                        continue
+                    i = sent[pkt_list[2]]
+                    done[i] = True
+                    results[i] = pkt_list[ind]
+                    if seqs is not None:
+                        seqs[i] = pkt_list[2]
+                    req = inflight.pop(pkt_list[2], None)
+                    if req is not None:
+                        self.rtt.sample(t - req[1])
+                    else:
+                        # Reply to an earlier transmission, drop the
+                        # retransmit in flight or queued
+                        for seq in [s for s in inflight
+                                    if inflight[s][0] == i]:
+                            del inflight[seq]
+                        if i in queue:
+                            queue.remove(i)
+                    METRICS.record(op, t - first_sent[i], bytes_out[i],
+                                   len(pkt))
+                    continue
+                for seq in [s for s in inflight if inflight[s][2] <= t]:
+                    i = inflight.pop(seq)[0]
+                    METRICS.timeout(op)
+                    attempts[i] += 1
+                    if attempts[i] > UDP_RETRIES:
+                        METRICS.error(op)
+                    else:
+                        self.retransmits += 1
+                        queue.append(i)
+            return results
+        finally:
+            self.skt.settimeout(timeout)
+
+    def transact_ordered(self, packs, fmt, chk, ind, op):
+        """ transact_many() of idempotent requests which have to be
+        executed in the order of `packs`. All requests are sent in one
+        burst and the UmTRX executes them in the order of the sequence
+        numbers. If a retransmitted request has been executed after a
+        later one, the requests from the later one are sent again. """
+        seqs = [None] * len(packs)
+        results = self.transact_many(packs, fmt, chk, ind, op, len(packs),
+                                     seqs)
+        i = first_reordered(seqs)
+        if i is not None:
+            results[i:] = self.transact_ordered(packs[i:], fmt, chk, ind, op)
+        return results
+
+
+def first_reordered(seqs):
+    """ Index of the first request executed before the preceding one
+    according to the sequence numbers of the replies, None if all of them
+    are executed in order """
+    for i in range(1, len(seqs)):
+        if seqs[i] is not None and seqs[i - 1] is not None and \
+                seqs[i] < seqs[i - 1]:
+            return i
+    return None
+
+
 def ping(skt, addr):
     skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     out_pkt = pack_control_fmt(
         USRP2_CONTROL_PROTO_VERSION, UMTRX_CTRL_ID_REQUEST, 0)
+    t0 = now()
     skt.sendto(out_pkt, (addr, UDP_CONTROL_PORT))
-    return recv_item(skt, CONTROL_FMT, UMTRX_CTRL_ID_RESPONSE, 1)
+    return recv_item(skt, CONTROL_FMT, UMTRX_CTRL_ID_RESPONSE, 1,
+                     "udp_ping", t0, len(out_pkt))
 
 
 def detect(skt, bcast_addr):
@@ -112,9 +338,11 @@ def detect(skt, bcast_addr):
         USRP2_CONTROL_PROTO_VERSION, UMTRX_CTRL_ID_REQUEST, 0)
     # print(" Sending %d bytes: %x, '%c',.." % (len(out_pkt),
     #      USRP2_CONTROL_PROTO_VERSION, UMTRX_CTRL_ID_REQUEST))
+    t0 = now()
     skt.sendto(out_pkt, (bcast_addr, UDP_CONTROL_PORT))
     response, version = recv_item(
-        skt, CONTROL_IP_FMT, UMTRX_CTRL_ID_RESPONSE, 3)
+        skt, CONTROL_IP_FMT, UMTRX_CTRL_ID_RESPONSE, 3,
+        "udp_detect", t0, len(out_pkt))
     if version is None or response is None:
         return None
     if version not in supported_control_proto_versions:
@@ -126,14 +354,51 @@ def detect(skt, bcast_addr):
     return socket.inet_ntoa(struct.pack("<L", socket.ntohl(response)))
 
 
+def detect_all(skt, bcast_addrs, window=UDP_TIMEOUT):
+    """ Broadcast the detect request to every address and collect all
+    replies received within `window` seconds.
+    Returns dictionary { UmTRX address : control protocol version } """
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    out_pkt = pack_control_fmt(
+        USRP2_CONTROL_PROTO_VERSION, UMTRX_CTRL_ID_REQUEST, 0)
+    t0 = now()
+    for addr in bcast_addrs:
+        try:
+            skt.sendto(out_pkt, (addr, UDP_CONTROL_PORT))
+        except socket.error:
+            pass
+    found = {}
+    timeout = skt.gettimeout()
+    try:
+        while True:
+            remaining = t0 + window - now()
+            if remaining <= 0:
+                break
+            skt.settimeout(remaining)
+            try:
+                pkt = skt.recv(UDP_MAX_XFER_BYTES)
+                pkt_list = unpack_format(pkt, CONTROL_IP_FMT)
+            except socket.timeout:
+                break
+            except struct.error:
+                continue
+            if pkt_list[1] != UMTRX_CTRL_ID_RESPONSE:
+                continue
+            METRICS.record("udp_detect", now() - t0, len(out_pkt), len(pkt))
+            found[socket.inet_ntoa(struct.pack(
+                "<L", socket.ntohl(pkt_list[3])))] = pkt_list[0]
+    finally:
+        skt.settimeout(timeout)
+    return found
+
+
 class umtrx_dev_spi:
     """ A class for talking to a device sitting on the SPI bus of UmTRX """
 
     def __init__(self, umtrx_socket, net_address, spi_bus_number,
                  out_edge=SPI_EDGE_RISE, in_edge=SPI_EDGE_RISE):
         """ spi_bus_number - a number of SPI bus to read/write """
-        self.skt = umtrx_socket
-        self.addr = net_address
+        self.transport = umtrx_udp_transport(umtrx_socket, net_address)
         self.spi_num = spi_bus_number
         self.out_edge = out_edge
         self.in_edge = in_edge
@@ -142,17 +407,37 @@ class umtrx_dev_spi:
         """ Write data to SPI bus and optionally read some data back.
         data - data to write to the SPI bus
         num_bits - number of bits of data to read/write
-        readback - 1 to read data from SPI bus, 0 to ignore data on the bus """
-        self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 0)
-        out_pkt = pack_spi_fmt(USRP2_CONTROL_PROTO_VERSION,
-                               USRP2_CTRL_ID_TRANSACT_ME_SOME_SPI_BRO,
-                               0, self.spi_num, data, self.in_edge,
-                               self.out_edge, num_bits, readback)
-        self.skt.sendto(out_pkt, (self.addr, UDP_CONTROL_PORT))
-        ret, _ = recv_item(self.skt, SPI_FMT,
-                           USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE, 4)
+        readback - 1 to read data from SPI bus, 0 to ignore data on the bus
+        Returns None if the UmTRX doesn't respond """
+        ret, _ = self.transport.transact(
+            self._pack_spi(data, num_bits, readback), SPI_FMT,
+            USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE, 4, "spi")
         return ret
 
+    def spi_rw_many(self, transfers, window=UDP_WINDOW):
+        """ Batched spi_rw().
+        transfers - list of (data, num_bits, readback)
+        window - maximum number of transfers in flight, 1 keeps the order
+        Returns the list of spi_rw() results """
+        return self.transport.transact_many(
+            [self._pack_spi(data, num_bits, readback)
+             for data, num_bits, readback in transfers],
+            SPI_FMT, USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE, 4, "spi", window)
+
+    def spi_rw_ordered(self, transfers):
+        """ Batched spi_rw() of idempotent transfers sent in one burst and
+        executed in the order of `transfers` """
+        return self.transport.transact_ordered(
+            [self._pack_spi(data, num_bits, readback)
+             for data, num_bits, readback in transfers],
+            SPI_FMT, USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE, 4, "spi")
+
+    def _pack_spi(self, data, num_bits, readback):
+        return lambda seq: pack_spi_fmt(
+            USRP2_CONTROL_PROTO_VERSION,
+            USRP2_CTRL_ID_TRANSACT_ME_SOME_SPI_BRO, seq, self.spi_num, data,
+            self.in_edge, self.out_edge, num_bits, readback)
+
 
 class umtrx_lms_device:
 
@@ -161,7 +446,10 @@ class umtrx_lms_device:
         self.verbosity = 0
 
     def reg_read(self, reg):
-        data = self.spi.spi_rw(reg << 8, 16, 1) & ((1 << 8) - 1)
+        data = self.spi.spi_rw(reg << 8, 16, 1)
+        if data is None:
+            raise socket.timeout("LMS register 0x%x read timed out" % reg)
+        data &= (1 << 8) - 1
         if self.verbosity > 0:
             print("REG READ  0x%x -> 0x%x" % (reg, data,))
         return data
@@ -171,6 +459,42 @@ class umtrx_lms_device:
             print("REG WRITE 0x%x <- 0x%x" % (reg, data,))
         self.spi.spi_rw(((0x80 | reg) << 8) | data, 16, 0)
 
+    def reg_read_many(self, regs):
+        """ Read registers with a batched SPI transfer.
+        Returns the list of values in the order of `regs` """
+        return self._reg_read_result(regs, self.spi.spi_rw_many(
+            [(reg << 8, 16, 1) for reg in regs]))
+
+    def reg_read_ordered(self, regs):
+        """ Read registers in one burst which is executed in the order of
+        `regs`.
+        Returns the list of values in the order of `regs` """
+        return self._reg_read_result(regs, self.spi.spi_rw_ordered(
+            [(reg << 8, 16, 1) for reg in regs]))
+
+    def _reg_read_result(self, regs, data):
+        for reg, val in zip(regs, data):
+            if val is None:
+                raise socket.timeout("LMS register 0x%x read timed out" %
+                                     reg)
+        data = [val & 0xff for val in data]
+        if self.verbosity > 0:
+            for reg, val in zip(regs, data):
+                print("REG READ  0x%x -> 0x%x" % (reg, val,))
+        return data
+
+    def reg_write_many(self, regs, ordered=False):
+        """ Write registers with a batched SPI transfer. Unless `ordered`
+        is set the writes may be executed out of order, so `regs`
+        shouldn't have duplicates.
+        regs - list of (reg, data) """
+        if self.verbosity > 0:
+            for reg, data in regs:
+                print("REG WRITE 0x%x <- 0x%x" % (reg, data,))
+        self.spi.spi_rw_many([(((0x80 | reg) << 8) | data, 16, 0)
+                              for reg, data in regs],
+                             1 if ordered else UDP_WINDOW)
+
     def reg_rmw(self, reg, action):
         """ Read-Modify-Write for LMS register.
         'action' is a lambda(x) expression """
@@ -195,19 +519,16 @@ class umtrx_lms_device:
 class umtrx_vcxo_dac:
 
     def __init__(self, umtrx_socket, net_address):
-        self.skt = umtrx_socket
-        self.addr = net_address
+        self.transport = umtrx_udp_transport(umtrx_socket, net_address)
         # self.spi = umtrx_dev_spi(umtrx_socket,
         #                          net_address, 4, out_edge=SPI_EDGE_FALL)
 
     def zpu_action(self, action, data=0):
-        self.skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 0)
-        out_pkt = pack_zpu_action_fmt(USRP2_CONTROL_PROTO_VERSION,
-                                      UMTRX_CTRL_ID_ZPU_REQUEST,
-                                      0, action, data)
-        self.skt.sendto(out_pkt, (self.addr, UDP_CONTROL_PORT))
-        ret, _ = recv_item(self.skt, ZPU_ACTION_FMT,
-                           UMTRX_CTRL_ID_ZPU_RESPONSE, 4)
+        ret, _ = self.transport.transact(
+            lambda seq: pack_zpu_action_fmt(USRP2_CONTROL_PROTO_VERSION,
+                                            UMTRX_CTRL_ID_ZPU_REQUEST,
+                                            seq, action, data),
+            ZPU_ACTION_FMT, UMTRX_CTRL_ID_ZPU_RESPONSE, 4, "zpu")
         return ret
 
     def set_dac(self, v):
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Asyncio client of the UmTRX UDP control protocol. All requests to both
+# LMS chips and to the VCTCXO DAC are multiplexed over a single socket and
+# matched to replies by the sequence number, so several of them can be in
+# flight at once.
+#
+# Existing umtrx_lms functions work with the blocking lms_device() facade
+# and can be run for both LMS chips concurrently from separate threads.
+#
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import umtrx_ctrl
+import umtrx_lms
+from umtrx_ctrl import UDP_CONTROL_PORT, UDP_TIMEOUT, UDP_RETRIES, \
+    UDP_WINDOW, SPI_FMT, ZPU_ACTION_FMT, SPI_EDGE_RISE, next_seq, \
+    pack_spi_fmt, pack_zpu_action_fmt, unpack_format, rtt_estimator
+from transport_metrics import METRICS, now
+
+# Version, id and sequence number common to all reply formats
+HEADER_FMT = '!LLL'
+
+
+class umtrx_control_protocol(asyncio.DatagramProtocol):
+    """ Dispatches received replies to the pending requests """
+
+    def __init__(self):
+        self.transport = None
+        # seq -> (reply id, reply format, future)
+        self.pending = {}
+        self.stale = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            _, pktid, seq = struct.unpack_from(HEADER_FMT, data)
+        except struct.error:
+            self.stale += 1
+            return
+        req = self.pending.get(seq)
+        if req is None or req[0] != pktid or req[2].done():
+            self.stale += 1
+            return
+        try:
+            req[2].set_result((unpack_format(data, req[1]), now()))
+        except struct.error:
+            self.stale += 1
+
+    def error_received(self, exc):
+        # ICMP errors are handled as lost packets by the retransmit timer
+        pass
+
+
+class umtrx_async_client:
+    """ Asyncio UmTRX control client. Create it with open() """
+
+    def __init__(self, transport, protocol, net_address):
+        self.transport = transport
+        self.protocol = protocol
+        self.addr = net_address
+        self.rtt = rtt_estimator()
+        self.retransmits = 0
+        # Limits requests in flight of the batched transfers
+        self.window = asyncio.Semaphore(UDP_WINDOW)
+
+    @classmethod
+    async def open(cls, net_address):
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            umtrx_control_protocol,
+            remote_addr=(net_address, UDP_CONTROL_PORT))
+        return cls(transport, protocol, net_address)
+
+    def close(self):
+        self.transport.close()
+
+    async def transact(self, pack, fmt, chk, ind, op):
+        """ Send a request and wait for the matching reply.
+        pack - function building the request packet for a sequence number
+        fmt, chk, ind - reply format, reply id and index of the result
+        op - operation name for the transport metrics
+        Returns the item at `ind` or None if all retransmits are lost. """
+        return (await self._transact(pack, fmt, chk, ind, op))[0]
+
+    async def _transact(self, pack, fmt, chk, ind, op):
+        """ transact() returning (item at `ind`, sequence number of the
+        accepted reply) """
+        fut = asyncio.get_event_loop().create_future()
+        sent = {}
+        rto = self.rtt.rto
+        t_first = now()
+        try:
+            for attempt in range(UDP_RETRIES + 1):
+                seq = next_seq()
+                out_pkt = pack(seq)
+                self.protocol.pending[seq] = (chk, fmt, fut)
+                sent[seq] = now()
+                self.transport.sendto(out_pkt)
+                try:
+                    pkt_list, t = await asyncio.wait_for(
+                        asyncio.shield(fut), rto)
+                except asyncio.TimeoutError:
+                    METRICS.timeout(op)
+                    self.retransmits += 1
+                    rto = min(rto * 2, UDP_TIMEOUT)
+                    continue
+                self.rtt.sample(t - sent[pkt_list[2]])
+                METRICS.record(op, t - t_first, len(out_pkt) * len(sent),
+                               struct.calcsize(fmt))
+                return pkt_list[ind], pkt_list[2]
+            self.rtt.rto = rto
+            METRICS.error(op)
+            return None, None
+        finally:
+            for seq in sent:
+                self.protocol.pending.pop(seq, None)
+
+    async def spi_rw(self, spi_num, data, num_bits, readback,
+                     out_edge=SPI_EDGE_RISE, in_edge=SPI_EDGE_RISE):
+        """ Write data to SPI bus `spi_num` and optionally read some data
+        back. Returns None if the UmTRX doesn't respond """
+        return (await self._spi_rw(spi_num, data, num_bits, readback,
+                                   out_edge, in_edge))[0]
+
+    def _spi_rw(self, spi_num, data, num_bits, readback,
+                out_edge=SPI_EDGE_RISE, in_edge=SPI_EDGE_RISE):
+        return self._transact(
+            lambda seq: pack_spi_fmt(
+                umtrx_ctrl.USRP2_CONTROL_PROTO_VERSION,
+                umtrx_ctrl.USRP2_CTRL_ID_TRANSACT_ME_SOME_SPI_BRO,
+                seq, spi_num, data, in_edge, out_edge, num_bits, readback),
+            SPI_FMT, umtrx_ctrl.USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE, 4,
+            "spi")
+
+    async def spi_rw_ordered(self, spi_num, transfers):
+        """ Batched spi_rw() of idempotent transfers sent in one burst and
+        executed in the order of `transfers`, see
+        umtrx_ctrl.umtrx_udp_transport.transact_ordered() """
+        res = await asyncio.gather(*[self._spi_rw(spi_num, *t)
+                                     for t in transfers])
+        results = [r[0] for r in res]
+        i = umtrx_ctrl.first_reordered([r[1] for r in res])
+        if i is not None:
+            results[i:] = await self.spi_rw_ordered(spi_num, transfers[i:])
+        return results
+
+    async def spi_rw_many(self, spi_num, transfers, window=UDP_WINDOW):
+        """ Batched spi_rw() of (data, num_bits, readback) transfers with
+        at most UDP_WINDOW requests in flight. window=1 keeps the order """
+        if window == 1:
+            return [await self.spi_rw(spi_num, *t) for t in transfers]
+
+        async def limited(data, num_bits, readback):
+            async with self.window:
+                return await self.spi_rw(spi_num, data, num_bits, readback)
+        return await asyncio.gather(*[limited(*t) for t in transfers])
+
+    async def zpu_action(self, action, data=0):
+        return await self.transact(
+            lambda seq: pack_zpu_action_fmt(
+                umtrx_ctrl.USRP2_CONTROL_PROTO_VERSION,
+                umtrx_ctrl.UMTRX_CTRL_ID_ZPU_REQUEST, seq, action, data),
+            ZPU_ACTION_FMT, umtrx_ctrl.UMTRX_CTRL_ID_ZPU_RESPONSE, 4, "zpu")
+
+    async def reg_read(self, lms, reg):
+        data = await self.spi_rw(lms, reg << 8, 16, 1)
+        if data is None:
+            raise socket.timeout("LMS%d register 0x%x read timed out" %
+                               (lms, reg))
+        return data & 0xff
+
+    async def reg_write(self, lms, reg, data):
+        await self.spi_rw(lms, ((0x80 | reg) << 8) | data, 16, 0)
+
+    async def get_dac(self):
+        return await self.zpu_action(
+            umtrx_ctrl.UMTRX_ZPU_REQUEST_GET_VCTCXO_DAC)
+
+    async def set_dac(self, v):
+        await self.zpu_action(umtrx_ctrl.UMTRX_ZPU_REQUEST_SET_VCTCXO_DAC, v)
+
+
+class umtrx_sync_spi:
+    """ Blocking spi_rw() of umtrx_ctrl.umtrx_dev_spi served by the
+    asyncio client """
+
+    def __init__(self, ctrl, spi_bus_number):
+        self.ctrl = ctrl
+        self.spi_num = spi_bus_number
+
+    def spi_rw(self, data, num_bits, readback):
+        return self.ctrl.call(self.ctrl.client.spi_rw(
+            self.spi_num, data, num_bits, readback))
+
+    def spi_rw_many(self, transfers, window=UDP_WINDOW):
+        return self.ctrl.call(self.ctrl.client.spi_rw_many(
+            self.spi_num, transfers, window))
+
+    def spi_rw_ordered(self, transfers):
+        return self.ctrl.call(self.ctrl.client.spi_rw_ordered(
+            self.spi_num, transfers))
+
+
+class umtrx_async_lms_device(umtrx_ctrl.umtrx_lms_device):
+    """ umtrx_lms_device working through the shared asyncio client """
+
+    def __init__(self, ctrl, lms_number):
+        self.spi = umtrx_sync_spi(ctrl, lms_number)
+        self.verbosity = 0
+
+
+class umtrx_async_vcxo_dac(umtrx_ctrl.umtrx_vcxo_dac):
+    """ umtrx_vcxo_dac working through the shared asyncio client """
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def zpu_action(self, action, data=0):
+        return self.ctrl.call(self.ctrl.client.zpu_action(action, data))
+
+
+class umtrx_async_ctrl:
+    """ Runs the asyncio client in a background thread and gives blocking
+    device objects which can be used from any number of threads """
+
+    def __init__(self, net_address):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.client = self.call(umtrx_async_client.open(net_address))
+
+    def call(self, coro):
+        """ Run the coroutine in the client loop and wait for the result """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def lms_device(self, lms_number):
+        return umtrx_async_lms_device(self, lms_number)
+
+    def vcxo_dac(self):
+        return umtrx_async_vcxo_dac(self)
+
+    def run_per_lms(self, func, *args):
+        """ Call func(lms_dev, *args) for LMS1 and LMS2 concurrently
+        and return the list of results """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(func, self.lms_device(lms), *args)
+                       for lms in (1, 2)]
+            return [f.result() for f in futures]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run UmTRX LMS operations for both LMS chips '
+                    'concurrently.')
+    parser.add_argument('--umtrx-addr', dest='umtrx', default='192.168.10.2',
+                        help='UmTRX address (default: 192.168.10.2)')
+    parser.add_argument('--pll-ref-clock', type=float, default=26e6,
+                        help='PLL reference clock, 26MHz by default')
+    parser.add_argument('--lpf-bandwidth-code',
+                        type=lambda s: int(s, 16), default=0x0f,
+                        choices=range(0, 0x10), metavar='0..0x0f',
+                        help='LPF bandwidth code (default: 0x0f)')
+    op = parser.add_mutually_exclusive_group(required=True)
+    op.add_argument('--dump', action='store_true', help='dump registers')
+    op.add_argument('--lms-auto-calibration', action='store_true',
+                    help='Run DC offset calibrations and LPF bandwidth '
+                         'tuning')
+    op.add_argument('--lms-tx-pll-tune', type=float,
+                    metavar='232.5e6..3720e6',
+                    help='Tune Tx PLL to the given frequency')
+    op.add_argument('--lms-rx-pll-tune', type=float,
+                    metavar='232.5e6..3720e6',
+                    help='Tune Rx PLL to the given frequency')
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(UDP_TIMEOUT)
+    if umtrx_ctrl.detect(sock, args.umtrx) is None:
+        sys.exit('UmTRX at %s is not responding.' % args.umtrx)
+    sock.close()
+
+    ctrl = umtrx_async_ctrl(args.umtrx)
+    t = time.time()
+    ref_clock = int(args.pll_ref_clock)
+    if args.dump:
+        lms1, lms2 = ctrl.run_per_lms(umtrx_lms.dump)
+        print(''.join('# 0x%02X: LMS1=0x%02X \tLMS2=0x%02X\t%s\n' % (
+            l1[0], l1[1], l2[1], 'OK' if l1[1] == l2[1] else 'DIFF')
+            for l1, l2 in zip(lms1, lms2)))
+    elif args.lms_auto_calibration:
+        ctrl.run_per_lms(umtrx_lms.lms_auto_calibration, ref_clock,
+                         args.lpf_bandwidth_code)
+    elif args.lms_tx_pll_tune is not None:
+        print(ctrl.run_per_lms(umtrx_lms.lms_tx_pll_tune, ref_clock,
+                               int(args.lms_tx_pll_tune)))
+    elif args.lms_rx_pll_tune is not None:
+        print(ctrl.run_per_lms(umtrx_lms.lms_rx_pll_tune, ref_clock,
+                               int(args.lms_rx_pll_tune)))
+    print('Done in %.3f sec, %d retransmits' % (time.time() - t,
+                                                ctrl.client.retransmits))
+    ctrl.close()
@@ -15,10 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import json
 import socket
 import argparse
 import time
 import math
+import threading
 import umtrx_ctrl
 # pylint: disable = C0301, C0103, C0111
 
@@ -69,7 +72,7 @@ LPF_CODE_TO_BW = {
 
 # LPF bandwidth in MHz to LPF code
 # Just reverse LPF_CODE_TO_BW for simplicity
-LPF_BW_TO_CODE = dict((v, k) for k, v in LPF_CODE_TO_BW.iteritems())
+LPF_BW_TO_CODE = dict((v, k) for k, v in LPF_CODE_TO_BW.items())
 
 
 # A list of reserved registers which read as junk
@@ -77,11 +80,122 @@ RESV_REGS = (0x0C, 0x0D, 0x37, 0x38, 0x39, 0x3A, 0x3B,
              0x3C, 0x3D, 0x69, 0x6A, 0x6B, 0x6C, 0x6D)
 
 
+# Default file of the calibration cache
+CALIBRATION_CACHE = '/var/tmp/umtrx_lms_calibration.json'
+# Cached calibration is valid for this time (sec)
+CALIBRATION_MAX_AGE = 7 * 24 * 3600
+# and for this temperature difference (C) if the temperature is known
+CALIBRATION_MAX_TEMP_DELTA = 10.0
+# Maximum difference of DC_REGVAL not considered as a drift
+DC_DRIFT_TOLERANCE = 2
+
+# DC calibration modules: (calibration_reg_base, number of DC_ADDRs,
+# TopSPI::CLK_EN bit of the module)
+DC_CALIBRATION_MODULES = ((0x00, 1, 5), (0x30, 2, 1), (0x50, 2, 3),
+                          (0x60, 5, 4))
+# Registers fields set by the LPF tuning: (reg, mask)
+# DCO_DACCAL of Rx and Tx LPF, RCCAL_LPF of Rx and Tx LPF
+LPF_CALIBRATION_FIELDS = ((0x35, 0x3f), (0x55, 0x3f), (0x36, 0x70),
+                          (0x56, 0x70))
+# Calibration registers: base+0x00 DC_REGVAL (read-only value selected
+# by DC_ADDR), base+0x02 DC_CNTVAL (value to load with DC_LOAD)
+# and base+0x03 bits DC_START_CLBR, DC_LOAD, DC_ADDR
+DC_START_CLBR = 1 << 5
+DC_LOAD = 1 << 4
+DC_ADDR_MASK = 0x07
+
+# Delays before the DC calibration status polls (sec). The calibration
+# takes 6.4us which is less than an SPI round trip, so the first polls go
+# without a delay and the rest back off in case the module is slow.
+DC_POLL_SCHEDULE = (0, 0, 0, 1e-5, 1e-4, 1e-4, 1e-3, 1e-3, 1e-3, 1e-3)
+# Number of status polls of every DC calibration run of the last
+# lms_auto_calibration() of every LMS
+# { lms : { (calibration_reg_base, dc_addr) : [polls, ...] } }
+dc_poll_stats = {}
+
+# Read-only status registers and DC calibration registers which are
+# accessed indirectly through DC_ADDR. They are skipped on restore.
+STATUS_REGS = (0x00, 0x01, 0x04, 0x1A, 0x2A, 0x30, 0x31,
+               0x50, 0x51, 0x60, 0x61)
+
+
 def dump(lms_dev):
     return [(x, lms_dev.reg_read(x),)
             for x in range(0, 128) if x not in RESV_REGS]
 
 
+def snapshot(lms_dev):
+    """ Read all registers with a batched transfer.
+    Returns dictionary { register : value } """
+    regs = [x for x in range(0, 128) if x not in RESV_REGS]
+    return dict(zip(regs, lms_dev.reg_read_many(regs)))
+
+
+def save_snapshot(filename, regs, dc=None):
+    """ Save the snapshot as a hex dump, 16 registers per line.
+    Registers missing in the snapshot are written as '--'. DC calibration
+    values read by lms_read_calibration() follow as 'DC base/addr: value'
+    lines """
+    with open(filename, 'w') as f:
+        for base in range(0, 128, 16):
+            f.write('%02X: %s\n' % (base, ' '.join(
+                '%02X' % regs[x] if x in regs else '--'
+                for x in range(base, base + 16))))
+        for base, addr, val in dc or []:
+            f.write('DC %02X/%d: %02X\n' % (base, addr, val))
+
+
+def load_snapshot(filename):
+    """ Load the snapshot saved by save_snapshot().
+    Returns (dictionary { register : value }, list of DC calibration
+    values [calibration_reg_base, dc_addr, DC_REGVAL]) """
+    regs = {}
+    dc = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            base, data = line.split(':', 1)
+            if base.startswith('DC '):
+                base, addr = base[3:].split('/')
+                dc.append([int(base, 16), int(addr), int(data, 16)])
+                continue
+            for i, val in enumerate(data.split()):
+                if val != '--':
+                    regs[int(base, 16) + i] = int(val, 16)
+    return regs, dc
+
+
+def restore(lms_dev, regs, dc=None, verify=True):
+    """ Write the snapshot registers which differ from the current values
+    in the address order, then load the DC calibration values the way
+    lms_apply_calibration() does and read everything back to verify.
+    Returns (list of written registers, list of registers failed to
+    verify). DC values failed to verify are reported by the
+    calibration_reg_base
+    """
+    # Writing the DC calibration control registers must not start the
+    # calibration or load DC_CNTVAL
+    dc_ctrl = [m[0] + 0x03 for m in DC_CALIBRATION_MODULES]
+    regs = dict((x, regs[x] & ~(DC_START_CLBR | DC_LOAD)
+                 if x in dc_ctrl else regs[x]) for x in regs
+                if x not in RESV_REGS and x not in STATUS_REGS)
+    current = snapshot(lms_dev)
+    changed = sorted(x for x in regs if current.get(x) != regs[x])
+    lms_dev.reg_write_many([(x, regs[x]) for x in changed], ordered=True)
+    if dc:
+        lms_apply_calibration(lms_dev, {"dc": dc, "fields": []})
+    failed = []
+    if verify and len(changed) > 0:
+        failed = [x for x, val in zip(changed, lms_dev.reg_read_many(changed))
+                  if val != regs[x]]
+    if verify and dc:
+        failed += sorted(set(b for b, a in lms_verify_calibration(
+            lms_dev, {"dc": dc, "fields": []})))
+    return changed, failed
+
+
 def select_freq(freq):
     """ Test if given freq within the range and return corresponding value """
     l = list(filter(lambda t: True if t[0] < freq <= t[1] else False,
@@ -499,8 +613,6 @@ def lms_set_vga1dc_q(lms_dev, dc_shift):
 def lms_general_dc_calibration_loop(lms_dev, dc_addr, calibration_reg_base):
     """ Programming and Calibration Guide:
         4.1 General DC Calibration Procedure """
-    try_cnt_limit = 10
-
     if verbosity > 0:
         print("DC Offset Calibration for addr %d:" % (dc_addr,))
     reg_val = lms_dev.reg_read(calibration_reg_base + 0x03)
@@ -514,16 +626,19 @@ def lms_general_dc_calibration_loop(lms_dev, dc_addr, calibration_reg_base):
     reg_val = reg_val ^ (1 << 5)
     lms_dev.reg_write(calibration_reg_base + 0x03, reg_val)
 
-    while try_cnt_limit:
-        try_cnt_limit -= 1
+    for cnt, delay in enumerate(DC_POLL_SCHEDULE):
         if verbosity > 1:
-            print("cnt=%d" % try_cnt_limit)
+            print("cnt=%d" % (len(DC_POLL_SCHEDULE) - cnt - 1))
 
         # Wait for 6.4(1.6) us
-        time.sleep(6.4e-6)
-
-        # Read DC_CLBR_DONE
-        reg_val = lms_dev.reg_read(calibration_reg_base + 0x01)
+        if delay > 0:
+            time.sleep(delay)
+
+        # Read DC_CLBR_DONE, DC_LOCK and DC_REGVAL in one burst. DC_REGVAL
+        # must not be read before the status reporting the end of the
+        # calibration, so the burst is executed in order
+        reg_val, DC_REGVAL = lms_dev.reg_read_ordered(
+            [calibration_reg_base + 0x01, calibration_reg_base + 0x00])
         DC_CLBR_DONE = (reg_val >> 1) & 0x1
         if verbosity > 1:
             print(" DC_CLBR_DONE=%d" % DC_CLBR_DONE)
@@ -532,15 +647,9 @@ def lms_general_dc_calibration_loop(lms_dev, dc_addr, calibration_reg_base):
         if DC_CLBR_DONE == 1:
             continue
 
-        # Read DC_LOCK
-        reg_val = lms_dev.reg_read(calibration_reg_base + 0x01)
         DC_LOCK = (reg_val >> 2) & 0x7
         if verbosity > 1:
             print(" DC_LOCK=%d" % DC_LOCK)
-
-        # Read DC_REGVAL
-        DC_REGVAL = lms_dev.reg_read(calibration_reg_base + 0x00)
-        if verbosity > 1:
             print("DC_REGVAL = %d" % DC_REGVAL)
 
         # DC_LOCK != 0 or 7?
@@ -548,6 +657,8 @@ def lms_general_dc_calibration_loop(lms_dev, dc_addr, calibration_reg_base):
             # We're done.
             break
 
+    dc_poll_stats.setdefault(lms_dev.spi.spi_num, {}).setdefault(
+        (calibration_reg_base, dc_addr), []).append(cnt + 1)
     # Return the value
     return DC_REGVAL
 
@@ -579,9 +690,9 @@ def lms_general_dc_calibration(lms_dev, dc_addr, calibration_reg_base):
             return None
 
     if verbosity > 0:
-        print("Successful DC Offset Calibration for register bank 0x%X, DC " +
-              "addr %d. Result: 0x%X" % (calibration_reg_base,
-                                         dc_addr, DC_REGVAL))
+        print(("Successful DC Offset Calibration for register bank 0x%X, " +
+               "DC addr %d. Result: 0x%X") % (calibration_reg_base,
+                                              dc_addr, DC_REGVAL))
     return DC_REGVAL
 
 
@@ -734,14 +845,17 @@ def lms_auto_calibration(lms_dev, ref_clock, lpf_bandwidth_code):
              gain is irrelevant for the purpose of this calibration.
           4. RxVGA2 gain is irrelevant, because it's set to 30dB during the
              calibration and then restored to the original value.
+
+        Returns True if all DC offset calibrations have converged.
     """
+    stats = dc_poll_stats[lms_dev.spi.spi_num] = {}
     print("LPF Tuning...")
-    lms_lpf_tuning_dc_calibration(lms_dev)
+    result = lms_lpf_tuning_dc_calibration(lms_dev)
     print("LPF Bandwidth Tuning...")
     lms_lpf_bandwidth_tuning(lms_dev, ref_clock, lpf_bandwidth_code)
 
     print("Tx LPF DC calibration...")
-    lms_txrx_lpf_dc_calibration(lms_dev, True)
+    result = lms_txrx_lpf_dc_calibration(lms_dev, True) and result
 
     # Disable Rx
     # We use this way of disabling Rx, because we have to leave
@@ -763,9 +877,9 @@ def lms_auto_calibration(lms_dev, ref_clock, lpf_bandwidth_code):
     rx_vga2gain = lms_set_rx_vga2gain(lms_dev, 30)
     # Calibrate!
     print("Rx LPF DC calibration...")
-    lms_txrx_lpf_dc_calibration(lms_dev, False)
+    result = lms_txrx_lpf_dc_calibration(lms_dev, False) and result
     print("RxVGA2 DC calibration...")
-    lms_rxvga2_dc_calibration(lms_dev)
+    result = lms_rxvga2_dc_calibration(lms_dev) and result
 
     # Restore saved values
     lms_set_rx_vga2gain(lms_dev, rx_vga2gain)
@@ -773,6 +887,171 @@ def lms_auto_calibration(lms_dev, ref_clock, lpf_bandwidth_code):
     lms_dev.reg_write(0x7C, reg_save_7C)
     lms_set_rx_lna(lms_dev, lna)
 
+    if verbosity > 0:
+        for base, addr in sorted(stats):
+            print("DC calibration 0x%02X/%d: polls %s" % (
+                base, addr, stats[(base, addr)]))
+    return result
+
+
+def lms_read_calibration(lms_dev):
+    """ Read results of the calibration procedures from the LMS.
+    Returns dictionary with "dc" - list of [calibration_reg_base, dc_addr,
+    DC_REGVAL] and "fields" - list of [reg, mask, value] """
+    clk_en_save = lms_dev.reg_set_bits(
+        0x09, sum(1 << m[2] for m in DC_CALIBRATION_MODULES))
+    dc = []
+    for base, num, _ in DC_CALIBRATION_MODULES:
+        reg_val = lms_dev.reg_read(base + 0x03) & ~(DC_START_CLBR | DC_LOAD)
+        for addr in range(num):
+            # DC_REGVAL is read for the selected DC_ADDR
+            lms_dev.reg_write(base + 0x03, (reg_val & ~DC_ADDR_MASK) | addr)
+            dc.append([base, addr, lms_dev.reg_read(base + 0x00) & 0x3f])
+        lms_dev.reg_write(base + 0x03, reg_val)
+    lms_dev.reg_write(0x09, clk_en_save)
+    fields = [[reg, mask, val & mask] for (reg, mask), val in zip(
+        LPF_CALIBRATION_FIELDS,
+        lms_dev.reg_read_many([f[0] for f in LPF_CALIBRATION_FIELDS]))]
+    return {"dc": dc, "fields": fields}
+
+
+def lms_apply_calibration(lms_dev, cal):
+    """ Write calibration results read by lms_read_calibration() in one
+    ordered register burst. DC values are loaded with DC_CNTVAL and
+    DC_LOAD instead of running the calibration. """
+    bases = [m[0] for m in DC_CALIBRATION_MODULES]
+    cur = lms_dev.reg_read_many(
+        [0x09] + [f[0] for f in cal["fields"]] + [b + 0x03 for b in bases])
+    clk_en_save = cur[0]
+    fields_cur = cur[1:1 + len(cal["fields"])]
+    ctrl = dict(zip(bases, cur[1 + len(cal["fields"]):]))
+    writes = [(0x09, clk_en_save |
+               sum(1 << m[2] for m in DC_CALIBRATION_MODULES))]
+    for (reg, mask, val), reg_val in zip(cal["fields"], fields_cur):
+        writes.append((reg, (reg_val & ~mask) | val))
+    for base, addr, val in cal["dc"]:
+        reg_val = ctrl[base] & ~(DC_START_CLBR | DC_LOAD | DC_ADDR_MASK)
+        # DC_CNTVAL := value, DC_ADDR := addr, DC_LOAD := 1, DC_LOAD := 0
+        writes += [(base + 0x02, val),
+                   (base + 0x03, reg_val | addr | DC_LOAD),
+                   (base + 0x03, reg_val | addr)]
+    writes += [(b + 0x03, ctrl[b] & ~(DC_START_CLBR | DC_LOAD))
+               for b in bases]
+    writes.append((0x09, clk_en_save))
+    lms_dev.reg_write_many(writes, ordered=True)
+
+
+def lms_verify_calibration(lms_dev, cal):
+    """ Read the calibration back and compare it with the applied one.
+    Returns list of [calibration_reg_base, dc_addr] of DC values and
+    [reg, mask] of fields which differ """
+    cur = lms_read_calibration(lms_dev)
+    dc = dict(((b, a), v) for b, a, v in cur["dc"])
+    fields = dict(((r, m), v) for r, m, v in cur["fields"])
+    return [[b, a] for b, a, v in cal["dc"] if dc.get((b, a)) != v] + \
+        [[r, m] for r, m, v in cal["fields"] if fields.get((r, m)) != v]
+
+
+def lms_check_dc_drift(lms_dev, cal, tolerance=DC_DRIFT_TOLERANCE):
+    """ Re-run the shortest DC calibration (LPF tuning module) and compare
+    the result with the cached one.
+    Returns True if the calibration is still valid """
+    cached = [v for b, a, v in cal["dc"] if b == 0x00 and a == 0]
+    if len(cached) == 0:
+        return False
+    clk_en_save = lms_dev.reg_set_bits(0x09, (1 << 5))
+    DCCAL = lms_general_dc_calibration(lms_dev, 0, 0x0)
+    lms_dev.reg_write(0x09, clk_en_save)
+    return DCCAL is not None and abs(DCCAL - cached[0]) <= tolerance
+
+
+class lms_calibration_cache:
+    """ Persistent cache of the calibration results keyed by UmTRX serial,
+    LMS number and LPF bandwidth code """
+
+    def __init__(self, filename=CALIBRATION_CACHE,
+                 max_age=CALIBRATION_MAX_AGE,
+                 max_temp_delta=CALIBRATION_MAX_TEMP_DELTA):
+        self.filename = filename
+        self.max_age = max_age
+        self.max_temp_delta = max_temp_delta
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(serial, lms, lpf_bandwidth_code):
+        return '%s/%d/%x' % (serial, lms, lpf_bandwidth_code)
+
+    def get(self, serial, lms, lpf_bandwidth_code, temperature=None):
+        """ Returns the calibration or None if it's missing or expired """
+        with self.lock:
+            e = self.entries.get(self.key(serial, lms, lpf_bandwidth_code))
+        if e is None or time.time() - e["time"] > self.max_age:
+            return None
+        if temperature is not None and e["temperature"] is not None and \
+                abs(temperature - e["temperature"]) > self.max_temp_delta:
+            return None
+        return e
+
+    def put(self, serial, lms, lpf_bandwidth_code, cal, temperature=None):
+        e = dict(cal)
+        e["time"] = time.time()
+        e["temperature"] = temperature
+        with self.lock:
+            self.entries[self.key(serial, lms, lpf_bandwidth_code)] = e
+
+    def invalidate(self, serial=None):
+        """ Drop the calibrations of the UmTRX or of all UmTRXs """
+        with self.lock:
+            if serial is None:
+                self.entries = {}
+            else:
+                self.entries = dict(
+                    (k, v) for k, v in self.entries.items()
+                    if not k.startswith(serial + '/'))
+
+    def save(self):
+        """ Write the cache atomically through a temporary file """
+        with self.lock:
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp, self.filename)
+
+
+def lms_auto_calibration_cached(lms_dev, ref_clock, lpf_bandwidth_code,
+                                cache, serial, temperature=None):
+    """ Apply the cached calibration if it's valid and doesn't drift,
+    otherwise run lms_auto_calibration() and update the cache if it
+    succeeds.
+    Returns (calibration result, True if the cached calibration has been
+    applied) """
+    lms = lms_dev.spi.spi_num
+    cal = cache.get(serial, lms, lpf_bandwidth_code, temperature)
+    if cal is not None:
+        lms_apply_calibration(lms_dev, cal)
+        # The drift check re-runs a calibration, so verify all the loaded
+        # values before it
+        failed = lms_verify_calibration(lms_dev, cal)
+        if len(failed) > 0:
+            print("Cached calibration hasn't been loaded: %s" % failed)
+        elif lms_check_dc_drift(lms_dev, cal):
+            print("Cached calibration applied")
+            return True, True
+        else:
+            print("DC offset drift detected")
+    if not lms_auto_calibration(lms_dev, ref_clock, lpf_bandwidth_code):
+        return False, False
+    cache.put(serial, lms, lpf_bandwidth_code,
+              lms_read_calibration(lms_dev), temperature)
+    cache.save()
+    return True, False
+
 
 def enable_loopback(lms_dev):
     """ Enable loopback"""
@@ -815,6 +1094,18 @@ if __name__ == '__main__':
                         help='LPF bandwidth code (default: 0x0f), used only ' +
                              'with --lms-lpf-bandwidth-tuning and ' +
                              '--lms-auto-calibration')
+    parser.add_argument('--calibration-cache', metavar='FILE', nargs='?',
+                        const=CALIBRATION_CACHE,
+                        help='apply cached calibration with ' +
+                             '--lms-auto-calibration if it is valid, ' +
+                             'update the cache otherwise (default: ' +
+                             CALIBRATION_CACHE + ')')
+    parser.add_argument('--serial',
+                        help='UmTRX serial, required with ' +
+                             '--calibration-cache')
+    parser.add_argument('--temperature', type=float,
+                        help='current temperature for the calibration ' +
+                             'cache validity check')
     basic_opt = parser.add_mutually_exclusive_group()
     basic_opt.add_argument('--detect', dest='bcast_addr',
                            default='192.168.10.255',
@@ -830,6 +1121,13 @@ if __name__ == '__main__':
                          metavar='0..0xFF',
                          help='data to be written into LMS register, hex')
     adv_opt.add_argument('--dump', action='store_true', help='dump registers')
+    adv_opt.add_argument('--snapshot', metavar='FILE',
+                         help='save all registers and DC calibration ' +
+                              'values of the LMS to a file')
+    adv_opt.add_argument('--restore', metavar='FILE',
+                         help='write registers saved with --snapshot which ' +
+                              'differ from the current values and verify ' +
+                              'them')
     adv_opt.add_argument('--lms-init', action='store_true',
                          help='run init sequence for LMS')
     adv_opt.add_argument('--lms-tx-enable', type=int, choices=range(0, 2),
@@ -932,6 +1230,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
     if args.lms is None:  # argparse do not have dependency concept for options
         if args.reg is not None or args.data is not None \
+           or args.snapshot is not None or args.restore is not None \
            or args.lms_tx_pll_tune is not None \
            or args.lms_rx_pll_tune is not None or args.lms_init \
            or args.lms_set_tx_pa is not None \
@@ -954,6 +1253,8 @@ if __name__ == '__main__':
     if args.lms_rx_pll_tune is not None:
         if not 232.5e6 < args.lms_rx_pll_tune <= 3720e6:
             exit('<lms-rx-pll-tune> is out of range 232.5e6..3720e6')
+    if args.calibration_cache is not None and args.serial is None:
+        exit('--calibration-cache requires --serial.')
     if args.lms_init:
         if args.reg is not None:
             exit('--reg makes no sense with --lms-init, aborting.')
@@ -985,8 +1286,15 @@ if __name__ == '__main__':
                 # 0x0f - 0.75MHz
                 lpf_bw_code = args.lpf_bandwidth_code if \
                     args.lpf_bandwidth_code is not None else 0x0f
-                lms_auto_calibration(umtrx_lms_dev, int(
-                    args.pll_ref_clock), int(lpf_bw_code))
+                if args.calibration_cache is not None:
+                    lms_auto_calibration_cached(
+                        umtrx_lms_dev, int(args.pll_ref_clock),
+                        int(lpf_bw_code),
+                        lms_calibration_cache(args.calibration_cache),
+                        args.serial, args.temperature)
+                else:
+                    lms_auto_calibration(umtrx_lms_dev, int(
+                        args.pll_ref_clock), int(lpf_bw_code))
             elif args.lms_lpf_tuning_dc_calibration:
                 lms_lpf_tuning_dc_calibration(umtrx_lms_dev)
             elif args.lms_tx_lpf_dc_calibration:
@@ -1078,6 +1386,15 @@ if __name__ == '__main__':
                       (umtrx_lms_dev.reg_read(args.reg), args.reg))
             elif args.enable_loopback:
                 enable_loopback(umtrx_lms_dev)
+            elif args.snapshot is not None:
+                save_snapshot(args.snapshot, snapshot(umtrx_lms_dev),
+                              lms_read_calibration(umtrx_lms_dev)["dc"])
+            elif args.restore is not None:
+                regs, dc = load_snapshot(args.restore)
+                changed, failed = restore(umtrx_lms_dev, regs, dc)
+                print('restored %d registers - %s' % (
+                    len(changed), 'OK' if len(failed) == 0 else
+                    'FAIL ' + ' '.join('0x%02X' % x for x in failed)))
             elif args.lms:
                 lms_regs = dump(umtrx_lms_dev)
                 print('LMS %u' % args.lms)
@@ -7,6 +7,7 @@
 
 import socket
 import json
+from transport_metrics import METRICS, now
 
 
 class umtrx_property_tree:
@@ -31,40 +32,39 @@ class umtrx_property_tree:
             d['value'] = value
         return self.s.send(json.dumps(d) + '\n')
 
-    def _recv_response(self):
+    def _transact(self, action, path, value_type=None, value=None):
+        """ Send a request and wait for the response """
+        op = "prop_" + action.lower()
+        t0 = now()
+        sent = self._send_request(action, path, value_type, value)
         resp = self.f.readline().strip()
-        if len(resp) > 0:
-            return json.loads(resp)
-        else:
+        if len(resp) == 0:
+            METRICS.error(op)
             return None
+        METRICS.record(op, now() - t0, sent, len(resp))
+        return json.loads(resp)
 
     #
     # Getters (raw)
     #
 
     def query_bool_raw(self, path):
-        self._send_request('GET', path, value_type='BOOL')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='BOOL')
 
     def query_int_raw(self, path):
-        self._send_request('GET', path, value_type='INT')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='INT')
 
     def query_double_raw(self, path):
-        self._send_request('GET', path, value_type='DOUBLE')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='DOUBLE')
 
     def query_sensor_raw(self, path):
-        self._send_request('GET', path, value_type='SENSOR')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='SENSOR')
 
     def query_range_raw(self, path):
-        self._send_request('GET', path, value_type='RANGE')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='RANGE')
 
     def query_string_raw(self, path):
-        self._send_request('GET', path, value_type='STRING')
-        return self._recv_response()
+        return self._transact('GET', path, value_type='STRING')
 
     #
     # Getters (value)
@@ -99,30 +99,24 @@ class umtrx_property_tree:
     #
 
     def set_bool(self, path, val):
-        self._send_request('SET', path, value_type='BOOL', value=val)
-        return self._recv_response()
+        return self._transact('SET', path, value_type='BOOL', value=val)
 
     def set_int(self, path, val):
-        self._send_request('SET', path, value_type='INT', value=val)
-        return self._recv_response()
+        return self._transact('SET', path, value_type='INT', value=val)
 
     def set_double(self, path, val):
-        self._send_request('SET', path, value_type='DOUBLE', value=val)
-        return self._recv_response()
+        return self._transact('SET', path, value_type='DOUBLE', value=val)
 
     def set_string(self, path, val):
-        self._send_request('SET', path, value_type='STRING', value=val)
-        return self._recv_response()
+        return self._transact('SET', path, value_type='STRING', value=val)
 
     #
     # Check path presence and list paths
     #
 
     def has_path_raw(self, path):
-        self._send_request('HAS', path)
-        return self._recv_response()
+        return self._transact('HAS', path)
 
     def list_path_raw(self, path):
-        self._send_request('LIST', path)
-        return self._recv_response()
+        return self._transact('LIST', path)
 
@@ -1,58 +1,130 @@
 import os
 import sys
 import time
-import subprocess
 import fcntl
-import time
+import select
+import argparse
 import datetime
 
 DEV = '/var/run/gpsd.device'
-DELAY = 3
+# Maximum time to wait for the required number of ZDA sentences
+TIMEOUT = 5
+# Maximum allowed system time lag
+MAX_DELTA = 45
+
+
+def nmea_checksum_ok(sentence):
+    """ Verify '*XX' checksum of the NMEA sentence if it's present """
+    star = sentence.rfind('*')
+    if star == -1:
+        return True
+    csum = 0
+    for c in sentence[1:star]:
+        csum ^= ord(c)
+    try:
+        return csum == int(sentence[star + 1:star + 3], 16)
+    except ValueError:
+        return False
 
-with open(DEV, 'rt') as f:
-    fd = f.fileno()
-    flag = fcntl.fcntl(fd, fcntl.F_GETFD)
-    fcntl.fcntl(fd, fcntl.F_SETFD, flag | os.O_NONBLOCK)
 
+def parse_zda(sentence):
+    """ Parse $GPZDA sentence and return GPS time or None if it's invalid """
+    if not sentence.startswith("$GPZDA") or not nmea_checksum_ok(sentence):
+        return None
+    p = sentence.split('*')[0].split(',')
+    if len(p) < 5 or '' in p[1:5]:
+        return None
+    try:
+        hms = float(p[1])
+        return datetime.datetime(int(p[4]), int(p[3]), int(p[2]),
+                                 int(hms / 10000),
+                                 int((hms % 10000) / 100),
+                                 int(hms % 100)) + \
+            datetime.timedelta(seconds=hms % 1)
+    except ValueError:
+        return None
+
+
+def nmea_sentences(fd, timeout):
+    """ Read the device incrementally and yield (arrival time, sentence)
+    for every complete line until the timeout expires """
+    deadline = time.time() + timeout
+    buf = b''
     while True:
-        l = os.read(fd, 131072)
-        if len(l) <= 2:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        if len(select.select([fd], [], [], remaining)[0]) == 0:
+            return
+        dt = datetime.datetime.today()
+        try:
+            chunk = os.read(fd, 4096)
+        except BlockingIOError:
+            continue
+        if len(chunk) == 0:
+            time.sleep(0.01)
+            continue
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        for l in lines:
+            yield dt, l.decode('utf-8', 'replace').strip()
+
+
+def sample_offsets(fd, count, timeout):
+    """ Collect up to `count` (arrival time, GPS time, sentence) samples """
+    samples = []
+    for dt, sentence in nmea_sentences(fd, timeout):
+        dt2 = parse_zda(sentence)
+        if dt2 is None:
+            continue
+        samples.append((dt, dt2, sentence))
+        if len(samples) >= count:
             break
+    return samples
 
-    time.sleep(DELAY)
-    dt = datetime.datetime.today()
 
-    ticks = []
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--samples", type=int, default=1,
+                        help="Number of ZDA sentences to collect (default: 1)")
+    parser.add_argument("-t", "--timeout", type=float, default=TIMEOUT,
+                        help="Maximum time to wait for all samples "
+                             "(default: %d sec)" % TIMEOUT)
+    args = parser.parse_args()
 
-    for l in os.read(fd, 65536).decode('utf-8').split():
-        if l.startswith("$GPZDA"):
-            ticks.append(l)
+    with open(DEV, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        flag = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
 
-    if len(ticks) < 1:
-        sys.exit(1)
+        # Drop everything buffered before we started
+        try:
+            while len(os.read(fd, 131072)) > 2:
+                pass
+        except BlockingIOError:
+            pass
 
-    p = ticks[-1].split(',')
-    if len(p) < 6:
-        if len(ticks) > 2:
-            p = ticks[-2].split(',')
-        else:
-            sys.exit(3)
+        samples = sample_offsets(fd, max(args.samples, 1),
+                                 args.timeout * max(args.samples, 1))
 
-    dt2 = datetime.datetime(int(p[4]), int(p[3]), int(p[2]),
-                            int(float(p[1]) / 10000),
-                            int((float(p[1]) % 10000) / 100),
-                            int(float(p[1]) % 100))
+    if len(samples) < 1:
+        sys.exit(1)
 
-    # print (dt, dt2, dt - dt2)
-    delta = (dt - dt2).total_seconds()
+    deltas = [(dt - dt2).total_seconds() for dt, dt2, _ in samples]
+    mean = sum(deltas) / len(deltas)
+    jitter = (sum((d - mean) ** 2 for d in deltas) / len(deltas)) ** 0.5
+    worst = max(deltas, key=abs)
+
+    dt, dt2, last = samples[-1]
     print("%s%+f: Got %d ticks; last was %s" %
-          (dt, delta, len(ticks), ticks[-1]))
+          (dt, deltas[-1], len(samples), last))
+    if len(samples) > 1:
+        print("Offset mean %+f, jitter %f, max %+f seconds" %
+              (mean, jitter, worst))
 
-    if abs(delta) < 45:
+    if abs(worst) < MAX_DELTA:
         print("SUCCESS")
         sys.exit(0)
     else:
-        print("Detected system time lag: %f seconds" % delta)
+        print("Detected system time lag: %f seconds" % worst)
         sys.exit(4)
-
-sys.exit(2)
@@ -1,8 +1,12 @@
 #!/usr/bin/python3
 import argparse
+import atexit
 import traceback
 import sys
 import select
+import queue
+import threading
+import multiprocessing
 
 from fwtp_engine import *
 
@@ -54,15 +58,93 @@ def def_func_visitor(path, ti, kwargs):
     except TimeoutError as e:
         res = TEST_FAIL
         tr.set_test_result(path, ti, res)
-        print("Error: %s" % e)
+        tr.output_error("Error: %s" % e)
     except:
         if _tests_debug:
-            traceback.print_exc()
+            tr.output_error(traceback.format_exc().rstrip())
         res = TEST_ABORTED
         tr.set_test_result(path, ti, res)
     return res
 
 
+LOG_DEBUG = 0
+LOG_PROGRESS = 1
+LOG_RESULT = 2
+
+LOG_LEVEL_NAMES = {
+    LOG_DEBUG: "debug",
+    LOG_PROGRESS: "progress",
+    LOG_RESULT: "result"
+}
+
+
+class ConsoleLogSink:
+    """
+    Background console writer. Records are put into a bounded queue and
+    written to the stream by a separate thread, so the test loop never waits
+    for the terminal. If the queue is full debug and progress records are
+    dropped, result records are always kept.
+    """
+
+    def __init__(self, level=LOG_PROGRESS, json_output=False,
+                 stream=sys.stdout, maxsize=4096):
+        self.level = level
+        self.json_output = json_output
+        self.stream = stream
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            self.stream.write(item)
+            if self.queue.empty():
+                self.stream.flush()
+            self.queue.task_done()
+        self.stream.flush()
+
+    def write(self, level, text, record=None):
+        """
+        Queue a record for the output
+        :param level: LOG_DEBUG, LOG_PROGRESS or LOG_RESULT
+        :param text: Human readable text
+        :param record: Dictionary to output in JSON mode instead of text
+        :return: None
+        """
+        if level < self.level:
+            return
+        if self.json_output:
+            rec = {"t": time.time(), "level": LOG_LEVEL_NAMES[level]}
+            rec.update(record if record is not None else {"msg": text})
+            text = json.dumps(rec, default=str)
+        item = text + "\n"
+        if level >= LOG_RESULT:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """ Wait till all queued records are written """
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """ Write out all queued records and stop the writer thread """
+        if self.dropped > 0:
+            self.write(LOG_RESULT, "%d log records were dropped" %
+                       self.dropped, {"dropped": self.dropped})
+        self.queue.put(None)
+        self.thread.join()
+
+
 class ConsoleTestResults(TestResults):
     RESULT_COLORS = {
         TEST_NA: bcolors.OKBLUE,
@@ -71,19 +153,28 @@ class ConsoleTestResults(TestResults):
         TEST_FAIL: bcolors.FAIL
     }
 
-    def __init__(self):
+    def __init__(self, sink=None):
         super().__init__()
+        self.sink = sink if sink is not None else ConsoleLogSink()
 
     def output_progress(self, string):
-        print(string)
+        self.sink.write(LOG_PROGRESS, string)
+
+    def output_debug(self, string):
+        self.sink.write(LOG_DEBUG, string)
+
+    def output_error(self, string):
+        """ Output errors of the test execution, shown at any log level """
+        self.sink.write(LOG_RESULT, string)
 
     def enter_bundle(self, t, path, bundle, disc):
-        print("[%s] Bundle %s%50s:  %s%s" % (
+        self.sink.write(LOG_PROGRESS, "[%s] Bundle %s%50s:  %s%s" % (
             time.strftime("%d %B %Y %H:%M:%S", time.localtime(t)),
             bcolors.OKBLUE,
             "%s/%s" % (path, bundle),
             disc,
-            bcolors.ENDC))
+            bcolors.ENDC), {"bundle": "%s/%s" % (path, bundle),
+                            "description": disc})
 
     def print_result(self, t, path, ti, result, value, old_result,
                      old_value, delta, reason=None):
@@ -99,7 +190,7 @@ class ConsoleTestResults(TestResults):
         else:
             tcolot = bcolors.WARNING
         exr = "" if reason is None else " (%s)" % reason
-        print("[%s] %s%50s:  %s%7s%s%s%s" % (
+        self.sink.write(LOG_RESULT, "[%s] %s%50s:  %s%7s%s%s%s%s" % (
             time.strftime("%d %B %Y %H:%M:%S", time.localtime(t)),
             tcolot,
             ti.INFO,  # TEST_NAMES.get(testname, testname),
@@ -107,20 +198,33 @@ class ConsoleTestResults(TestResults):
             TEST_RESULT_NAMES[result],
             bcolors.ENDC,
             was,
-            exr), end="")
-        if value is not None:
-            print(" (%s)" % str(value))
-        else:
-            print("")
+            exr,
+            " (%s)" % str(value) if value is not None else ""),
+            {"path": path, "test": ti.testname,
+             "result": TEST_RESULT_NAMES[result], "value": value,
+             "old_result": TEST_RESULT_NAMES.get(old_result),
+             "old_value": old_value, "delta": delta, "reason": reason})
 
 
 class ConsoleUI:
+    def __init__(self, sink=None):
+        """
+        :param sink: ConsoleLogSink to write out before prompting the user
+        """
+        self.sink = sink
+
     def ask(self, text):
         global ABORT_EXECUTION
         if ABORT_EXECUTION:
-            print("Abort ui '%s'" % text)
+            if self.sink is not None:
+                self.sink.write(LOG_PROGRESS, "Abort ui '%s'" % text)
+            else:
+                print("Abort ui '%s'" % text)
             return False
 
+        # The prompt must follow the queued progress output
+        if self.sink is not None:
+            self.sink.flush()
         # Note: this flush code works under *nix OS only
         try:
             while len(select.select([sys.stdin.fileno()], [], [], 0.0)[0]) > 0:
@@ -136,9 +240,36 @@ class ConsoleUI:
             return False
 
 
+class BatchUI:
+    """ Non-interactive UI for the batch mode: refuses all questions """
+
+    def __init__(self, tr):
+        self.tr = tr
+
+    def ask(self, text):
+        self.tr.output_progress("Batch mode, declining '%s'" % text)
+        return False
+
+
+class QueueStream:
+    """ Stream-like object forwarding output of a batch worker to the
+    parent process """
+
+    def __init__(self, name, out_queue):
+        self.name = name
+        self.out_queue = out_queue
+
+    def write(self, text):
+        self.out_queue.put(("out", self.name, text))
+
+    def flush(self):
+        pass
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("bts_ip", type=str, help="Tested BTS IP address")
+    parser.add_argument("bts_ip", type=str, nargs='?',
+                        help="Tested BTS IP address")
     parser.add_argument("-p", "--cmd57-port",
                         dest='cmd57_port', type=str, default='/dev/ttyUSB0',
                         help="Serial port name for the CMD57 control "
@@ -161,18 +292,227 @@ def parse_args():
     parser.add_argument("-t", "--trace", dest='trace',
                         type=bool, default=False,
                         help="Trace script execution")
-    return parser.parse_args()
+    parser.add_argument("-l", "--log-level", dest='log_level',
+                        choices=[LOG_LEVEL_NAMES[i] for i in
+                                 sorted(LOG_LEVEL_NAMES)],
+                        default=LOG_LEVEL_NAMES[LOG_PROGRESS],
+                        help="Minimum level of console messages "
+                             "(default: progress)")
+    parser.add_argument("-j", "--json", dest='json_output',
+                        action='store_true',
+                        help="Output JSON records instead of text")
+    parser.add_argument("-i", "--inventory", dest='inventory',
+                        type=str, default=None,
+                        help="Run the script in batch mode against all "
+                             "BTSs listed in the YAML inventory file")
+    parser.add_argument("-B", "--cmd57-broker", dest='cmd57_broker',
+                        type=str, default=None,
+                        help="In batch mode share the CMD57 between workers "
+                             "through a broker listening on this socket")
+    parser.add_argument("-w", "--workers", dest='workers',
+                        type=int, default=0,
+                        help="Maximum number of parallel batch workers "
+                             "(default: one per inventory entry)")
+    parser.add_argument("-T", "--chrome-trace", dest='chrome_trace',
+                        type=str, default=None,
+                        help="Save tests timing to the file in the Chrome "
+                             "trace format (chrome://tracing, Perfetto)")
+    parser.add_argument("-R", "--rerun", dest='rerun',
+                        action='store_true',
+                        help="After the run offer to run the script again "
+                             "reusing the BTS and CMD57 connections")
+    parser.add_argument("-C", "--checkpoint", dest='checkpoint',
+                        type=str, default=CHECKPOINT_FILE,
+                        help="Save results of the executed tests to the "
+                             "file to resume the run if it's interrupted "
+                             "(default: %s)" % CHECKPOINT_FILE)
+    parser.add_argument("-r", "--resume", dest='resume',
+                        action='store_true',
+                        help="Resume the interrupted run skipping the "
+                             "tests which have passed according to the "
+                             "checkpoint")
+    args = parser.parse_args()
+    if args.bts_ip is None and args.inventory is None:
+        parser.error("either bts_ip or --inventory is required")
+    return args
+
+
+def load_inventory(filename, args):
+    """
+    Load the batch inventory. It's a YAML list of dictionaries with
+    'bts_ip' and 'dut' keys and optional 'name', 'arfcn' and 'cmd57_port'
+    :param filename: Inventory file name
+    :param args: Parsed command line arguments providing defaults
+    :return: List of dictionaries with all keys filled in
+    """
+    with open(filename, "r") as f:
+        inventory = yaml.safe_load(f)
+    entries = []
+    for i, e in enumerate(inventory):
+        entries.append({
+            "name": str(e.get("name", "%s#%d" % (e["bts_ip"], i))),
+            "bts_ip": str(e["bts_ip"]),
+            "dut": e.get("dut", args.dut),
+            "arfcn": int(e.get("arfcn", args.arfcn)),
+            "cmd57_port": e.get("cmd57_port", args.cmd57_port)})
+    return entries
+
+
+def save_results(args):
+    """
+    Dump report of the finished run to a JSON file
+    :param args: Dictionary of variables after the run
+    :return: Test ID or None if nothing was saved
+    """
+    if "TEST_ID" not in args:
+        return None
+    test_id = args["TEST_ID"]
+    f = open("out/bts-test." + test_id + ".json", 'w')
+    f.write(args["TR"].json())
+    f.close()
+    save_transport_metrics(args, "out/bts-test." + test_id + ".metrics.json")
+    return test_id
 
 
-def finalize_testsuite(args):
+def batch_worker(entry, script, log_level, json_output, out_queue):
+    """ Entry point of a batch worker process running one DUT """
+    global ABORT_EXECUTION
+    TestSuiteConfig.DECORATOR_DEFAULT = def_func_visitor
+    sink = ConsoleLogSink(level=log_level, json_output=json_output,
+                          stream=QueueStream(entry["name"], out_queue))
+    tr = ConsoleTestResults(sink)
+    args = {
+        "BTS_IP": entry["bts_ip"],
+        "DUT": entry["dut"],
+        "ARFCN": entry["arfcn"],
+        "CMD57_PORT": entry["cmd57_port"],
+        "TR": tr,
+        "UI": BatchUI(tr),
+        "CHAN": ""}
+    test_id = None
+    try:
+        TestExecutor(script).run(args)
+        if not ABORT_EXECUTION:
+            test_id = save_results(args)
+    except:
+        sink.write(LOG_RESULT, traceback.format_exc())
+    finally:
+        sink.close()
+        out_queue.put(("done", entry["name"], {
+            "summary": tr.summary(),
+            "test_id": test_id,
+            "aborted": ABORT_EXECUTION}))
+
+
+def run_batch(entries, script, log_level, json_output, workers):
+    """
+    Run the script against every inventory entry in a separate process
+    and print combined progress and the summary table
+    :return: Number of entries with failed tests
+    """
+    out_queue = multiprocessing.Queue()
+    pending = list(entries)
+    running = {}
+    results = {}
+    workers = workers if workers > 0 else len(entries)
+
+    def handle(kind, name, data):
+        if kind == "out":
+            for line in data.splitlines():
+                print("%-20s %s" % (name, line))
+        else:
+            # The worker might have been already accounted as died
+            p = running.pop(name, None)
+            if p is not None:
+                p.join()
+            results[name] = data
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                entry = pending.pop(0)
+                p = multiprocessing.Process(
+                    target=batch_worker,
+                    args=(entry, script, log_level, json_output, out_queue))
+                p.start()
+                running[entry["name"]] = p
+            try:
+                handle(*out_queue.get(timeout=1))
+            except queue.Empty:
+                # Account workers which died without reporting. The report
+                # of a worker exiting just now is still in the queue and
+                # overwrites this result
+                for name, p in list(running.items()):
+                    if not p.is_alive():
+                        running.pop(name).join()
+                        results[name] = {"summary": {}, "test_id": None,
+                                         "aborted": True}
+    except KeyboardInterrupt:
+        print("Batch was interrupted, terminating workers")
+        for p in running.values():
+            p.terminate()
+        for p in running.values():
+            p.join()
+        running = {}
+    # Late reports of the workers accounted as died
+    while True:
+        try:
+            handle(*out_queue.get(timeout=0.1))
+        except queue.Empty:
+            break
+
+    failed_entries = 0
+    print("\n%-20s %-16s %-20s %5s %5s %5s %7s  %s" % (
+        "NAME", "BTS", "DUT", "OK", "FAIL", "N/A", "ABORTED", "TEST_ID"))
+    for e in entries:
+        r = results.get(e["name"], {"summary": {}, "test_id": None,
+                                    "aborted": True})
+        sm = r["summary"]
+        failed = (sm.get(TEST_NA, 0) + sm.get(TEST_ABORTED, 0) +
+                  sm.get(TEST_FAIL, 0))
+        if failed > 0 or r["aborted"]:
+            failed_entries += 1
+        print("%-20s %-16s %-20s %5d %5d %5d %7d  %s" % (
+            e["name"], e["bts_ip"], e["dut"],
+            sm.get(TEST_OK, 0), sm.get(TEST_FAIL, 0), sm.get(TEST_NA, 0),
+            sm.get(TEST_ABORTED, 0),
+            r["test_id"] if r["test_id"] is not None else "-"))
+    return failed_entries
+
+
+def print_timing(bundles):
+    """ Print per bundle timing table returned by TestResults.bundle_stats """
+    categories = sorted({c for b in bundles.values() for c in b["blocked"]})
+    print("\n%-50s %5s %9s" % ("BUNDLE", "TESTS", "WALL, s") +
+          "".join(" %9s %6s" % (c + ", s", "calls") for c in categories))
+    for path in sorted(bundles):
+        b = bundles[path]
+        print("%-50s %5d %9.2f" % (path, b["tests"], b["duration"]) +
+              "".join(" %9.2f %6d" % (b["blocked"].get(c, 0),
+                                      b["round_trips"].get(c, 0))
+                      for c in categories))
+    print()
+
+
+def finalize_testsuite(args, chrome_trace=None):
     global ABORT_EXECUTION
     tr = args["TR"]
+    tr.sink.close()
     sm = tr.summary()
-    for res in sm:
-        print("%s%8s%s: %2d" % (ConsoleTestResults.RESULT_COLORS[res],
-                                TEST_RESULT_NAMES[res],
-                                bcolors.ENDC,
-                                sm[res]))
+    if chrome_trace is not None:
+        with open(chrome_trace, "w") as f:
+            f.write(tr.chrome_trace())
+    if tr.sink.json_output:
+        print(json.dumps({"summary": {TEST_RESULT_NAMES[res]: sm[res]
+                                      for res in sm},
+                          "timing": tr.bundle_stats()}))
+    else:
+        print_timing(tr.bundle_stats())
+        for res in sm:
+            print("%s%8s%s: %2d" % (ConsoleTestResults.RESULT_COLORS[res],
+                                    TEST_RESULT_NAMES[res],
+                                    bcolors.ENDC,
+                                    sm[res]))
 
     failed = (sm.setdefault(TEST_NA, 0) +
               sm.setdefault(TEST_ABORTED, 0) +
@@ -183,14 +523,16 @@ def finalize_testsuite(args):
     #
     #   Dump report to a JSON file
     #
-    if ABORT_EXECUTION:
-        print("Test was aborted, don't save data")
+    if ABORT_EXECUTION or ("CHECKPOINT" in args and
+                           args["CHECKPOINT"].aborted):
+        print("Test was aborted, don't save data. "
+              "Use --resume to continue the run.")
         sys.exit(1)
+    if "CHECKPOINT" in args:
+        # The run is completed, nothing to resume
+        args["CHECKPOINT"].remove()
 
-    test_id = args["TEST_ID"]
-    f = open("out/bts-test." + test_id + ".json", 'w')
-    f.write(tr.json())
-    f.close()
+    save_results(args)
 
 
 ##################
@@ -210,16 +552,56 @@ if __name__ == '__main__':
             print("%35s: %-70s" % (i.testname, str(i)))
 
     TestExecutor.trace_calls = args.trace
+    log_level = {v: k for k, v in LOG_LEVEL_NAMES.items()}[args.log_level]
+    if args.script is not None and args.inventory is not None:
+        broker = None
+        if args.cmd57_broker is not None:
+            import cmd57_broker
+            broker = multiprocessing.Process(
+                target=cmd57_broker.run_broker,
+                args=(args.cmd57_port, args.cmd57_broker), daemon=True)
+            broker.start()
+            if not cmd57_broker.wait_broker(args.cmd57_broker, broker):
+                broker.terminate()
+                sys.exit("CMD57 broker hasn't started")
+            args.cmd57_port = cmd57_broker.BROKER_SCHEME + args.cmd57_broker
+        failed = run_batch(load_inventory(args.inventory, args),
+                           open(args.script, "r").read(),
+                           log_level, args.json_output, args.workers)
+        if broker is not None:
+            broker.terminate()
+        sys.exit(1 if failed > 0 else 0)
     if args.script is not None:
         texec = TestExecutor(open(args.script, "r").read())
-        args = {
-            "BTS_IP": args.bts_ip,
-            "DUT": args.dut,
-            "ARFCN": args.arfcn,
-            "CMD57_PORT": args.cmd57_port,
-            "TR": ConsoleTestResults(),
-            "UI": ConsoleUI(),
-            "CHAN": ""}
-        texec.run(args)
-        finalize_testsuite(args)
+        sessions = None
+        if args.rerun:
+            sessions = SessionRegistry()
+            atexit.register(sessions.close_all)
+        while True:
+            sink = ConsoleLogSink(level=log_level,
+                                  json_output=args.json_output)
+            run_args = {
+                "BTS_IP": args.bts_ip,
+                "DUT": args.dut,
+                "ARFCN": args.arfcn,
+                "CMD57_PORT": args.cmd57_port,
+                "SESSIONS": sessions,
+                "TR": ConsoleTestResults(sink),
+                "UI": ConsoleUI(sink),
+                "CHAN": ""}
+            # Metrics of this run only
+            METRICS.reset()
+            texec.run(run_args, args.checkpoint, args.resume)
+            finalize_testsuite(run_args, args.chrome_trace)
+            # Next runs start from the beginning
+            args.resume = False
+            if sessions is None:
+                break
+            sessions.release()
+            try:
+                if input("Run the script again? [y/N] ").strip().lower() \
+                        != 'y':
+                    break
+            except EOFError:
+                break
         sys.exit(0)
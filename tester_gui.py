@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from PyQt5.QtCore import pyqtSlot, Qt
+import html
+import atexit
+import argparse
+import threading
+from collections import deque
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, Qt, QThread, QTimer, \
+    QObject, QAbstractTableModel, QModelIndex
 from PyQt5.QtWidgets import QApplication, QMainWindow, QListWidgetItem, \
-    QMessageBox
+    QMessageBox, QDockWidget, QTableView
 from PyQt5.uic import loadUiType
 import time
 import traceback
@@ -16,6 +22,9 @@ import fwtp_engine
 
 main_form, base_class = loadUiType('mainwindow.ui')
 
+# Interval of closing the idle BTS and CMD57 sessions (ms)
+SESSION_EVICT_INTERVAL = 60000
+
 
 def get_html_color_tags(color):
     return '<font color="%s">' % color, '</font>'
@@ -33,6 +42,142 @@ HTML_RESULT_MAPS = {
 }
 
 
+class ResultsTableModel(QAbstractTableModel):
+    """ Structured view of the test results """
+
+    HEADERS = ["Time", "Path", "Test", "Result", "Value", "Was", "Delta"]
+
+    def __init__(self, max_rows=10000, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.max_rows = max_rows
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.rows[index.row()][index.column()]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def append_rows(self, rows):
+        """ Append a batch of rows dropping the oldest ones over the limit """
+        rows = rows[-self.max_rows:]
+        drop = max(len(self.rows) + len(rows) - self.max_rows, 0)
+        if drop > 0:
+            self.beginRemoveRows(QModelIndex(), 0, drop - 1)
+            del self.rows[:drop]
+            self.endRemoveRows()
+        self.beginInsertRows(QModelIndex(), len(self.rows),
+                             len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+
+class ConsoleLogBuffer(QObject):
+    """ Buffers console output and flushes it to the widget at a fixed frame
+    rate, so bursts of events cost one re-layout per frame """
+
+    def __init__(self, console, fps=20, max_blocks=20000, parent=None):
+        super().__init__(parent)
+        self.console = console
+        self.console.setMaximumBlockCount(max_blocks)
+        self.pending = deque(maxlen=max_blocks)
+        self.pending_rows = []
+        self.table = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(int(1000 / fps))
+
+    @pyqtSlot(str)
+    def append_html(self, text):
+        self.pending.append(text)
+
+    def append_text(self, text):
+        self.pending.append("<pre>%s</pre>" % html.escape(text))
+
+    def append_row(self, row):
+        if self.table is not None:
+            self.pending_rows.append(row)
+
+    @pyqtSlot()
+    def flush(self):
+        if len(self.pending) > 0:
+            text = "".join(self.pending)
+            self.pending.clear()
+            self.console.appendHtml(text)
+        if len(self.pending_rows) > 0:
+            self.table.append_rows(self.pending_rows)
+            self.pending_rows = []
+
+
+class TestExecutorThread(QThread):
+    """ Worker thread running TestExecutor. All GUI updates are delivered to
+    the main thread through the signals """
+
+    sigResult = pyqtSignal(float, str, object, int, object, object, object,
+                           object, object)
+    sigProgress = pyqtSignal(str)
+    sigBundle = pyqtSignal(float, str, str, str)
+    sigConsole = pyqtSignal(str)
+    sigAsk = pyqtSignal(str)
+    sigDone = pyqtSignal(bool, str)
+
+    def __init__(self, texec, args, resume=False, parent=None):
+        super().__init__(parent)
+        self.texec = texec
+        self.args = args
+        self.resume = resume
+
+    def run(self):
+        try:
+            self.texec.run(self.args, testsuite_bts.CHECKPOINT_FILE,
+                           self.resume)
+            self.sigDone.emit(True, "")
+        except serial.serialutil.SerialException as e:
+            self.sigDone.emit(False, ("<br><br><font color=\"red\">" +
+                                      "CMD57 exception:" +
+                                      "</font><br><b>%s</b>") % str(e))
+        except:
+            traceback.print_exc()
+            self.sigDone.emit(False, ("<br><br><font color=\"red\">" +
+                                      "Unknown exception:" +
+                                      "</font><br><b>%s</b>") %
+                              str(sys.exc_info()))
+
+
+class DiscoveryThread(QThread):
+    """ Runs the network discovery without blocking the GUI """
+
+    sigHost = pyqtSignal(object)
+    sigDone = pyqtSignal(int, float)
+
+    def __init__(self, discovery, parent=None):
+        super().__init__(parent)
+        self.discovery = discovery
+
+    def run(self):
+        t = time.time()
+        subnets, bcast_addrs = bts_discovery.default_scan_targets()
+        found = self.discovery.discover(subnets=subnets,
+                                        bcast_addrs=bcast_addrs,
+                                        on_result=self.sigHost.emit)
+        self.sigDone.emit(len(found), time.time() - t)
+
+
 class MainWindowImpl(QMainWindow, main_form):
     """ MainWindows implementation class """
 
@@ -55,7 +200,7 @@ class MainWindowImpl(QMainWindow, main_form):
         self.texec = fwtp_engine.TestExecutor(
             open(self.testscript, "r").read())
 
-    def __init__(self, app, testscript, *args):
+    def __init__(self, app, testscript, results_table=False, *args):
         super(MainWindowImpl, self).__init__(*args)
         self.app = app
         self.test_ok = False
@@ -66,8 +211,30 @@ class MainWindowImpl(QMainWindow, main_form):
         self.tests_debug = True
         self.tr = None
         self.testscript = testscript
+        self.aborted = False
+        self.worker = None
+        self.ask_event = threading.Event()
+        self.ask_reply = False
+        self.discovery = None
+        self.finder = None
+        # The previous run has been interrupted and can be resumed
+        self.resume_available = False
+        # BTS and CMD57 connections reused by the following runs
+        self.sessions = fwtp_core.SessionRegistry()
+        atexit.register(self.sessions.close_all)
+        self.evict_timer = QTimer(self)
+        self.evict_timer.timeout.connect(self.sessions.evict_idle)
+        self.evict_timer.start(SESSION_EVICT_INTERVAL)
 
         self.setupUi(self)
+        self.log = ConsoleLogBuffer(self.txConsole, parent=self)
+        if results_table:
+            self.log.table = ResultsTableModel(parent=self)
+            view = QTableView(self)
+            view.setModel(self.log.table)
+            dock = QDockWidget("Results", self)
+            dock.setWidget(view)
+            self.addDockWidget(Qt.BottomDockWidgetArea, dock)
         self.load_testsuite()
         self.load_tests()
         self.cbHosts.addItems(["manual", "local"])
@@ -90,79 +257,55 @@ class MainWindowImpl(QMainWindow, main_form):
         if self.started:
             self.aborted = True
             self.started = False
+            # Wake up the worker if it waits for the user
+            self.ask_reply = False
+            self.ask_event.set()
             self.on_stop()
-            self.btStartStop.setText("Start")
-            self.enable_controls(True)
+            # Controls are enabled back once the worker thread finishes
+            self.btStartStop.setEnabled(False)
         else:
             self.aborted = False
             self.started = True
             self.btStartStop.setText("Stop")
             self.enable_controls(False)
             self.test_ok = True
-
-            # self.on_start()
-            # return
-
-            try:
-                self.on_start()
-            except serial.serialutil.SerialException as e:
-                self.test_ok = False
-                self.txConsole.appendHtml("<br><br><font color=\"red\">" +
-                                          "CMD57 exception:" +
-                                          "</font><br><b>%s</b>" % str(e))
-            # scpi.errors.TimeoutError
-            except:
-                if self.tests_debug:
-                    traceback.print_exc()
-                self.test_ok = False
-                self.txConsole.appendHtml("<br><br><font color=\"red\">" +
-                                          "Unknown exception:" +
-                                          "</font><br><b>%s</b>" %
-                                          str(sys.exc_info()))
-            finally:
-                if not self.test_ok:
-                    self.txConsole.appendHtml(
-                        "<br><br><h2><font color=\"red\">" +
-                        "TEST FAILED</font></h2>")
-                elif not self.started:
-                    self.txConsole.appendHtml(
-                        "<br><br><h2><font color=\"yellow\">" +
-                        "TEST ABORTED</font></h2>")
-                else:
-                    self.txConsole.appendHtml(
-                        "<br><br><h2><font color=\"green\">" +
-                        "TEST OK</font></h2>")
-                self.btStartStop.setText("Start")
-                self.enable_controls(True)
-                self.started = False
+            self.on_start()
 
     @pyqtSlot()
     def on_btFind_clicked(self):
         """ Get all DUTs in the local network """
         self.cbHosts.clear()
         self.cbHosts.addItems(["manual", "local"])
-        # ips = subprocess.check_output(
-        #           'nmap -sP 192.168.1.0/24 | grep "Nmap scan report for "',
-        #           shell=True).decode('utf-8').replace("Nmap scan report" +
-        #                                               " for ", "").split()
-        # if len(ips) == 0:
-        #     self.txConsole.appendHtml("No hosts were found")
-        #     return
-        #
-        # for ip in ips:
-        #     self.app.processEvents()
-        #     try:
-        #         b = bts_test.BtsControlSsh(ip, 22)
-        #         u = b.get_uname()
-        #         s = b.get_umtrx_eeprom_val("serial")
-        #         self.txConsole.appendHtml(
-        #             "Host <b>%s</b>-<i>%s</i>-%s" % (ip, u, s))
-        #         self.cbHosts.addItem(ip)
-        #     except ConnectionRefusedError:
-        #         self.txConsole.appendHtml("Host %s is unreachable" % ip)
-        #     except socket.timeout:
-        #         self.txConsole.appendHtml("Host %s connection " +
-        #                                   "timed out" % ip)
+        self.btFind.setEnabled(False)
+        self.log.append_text("Searching for BTSs...")
+        dut = bts_params.HARDWARE_LIST.get(self.cbDevice.currentText(), {})
+        if self.discovery is None:
+            self.discovery = bts_discovery.BtsDiscovery()
+        self.discovery.login = dut.get("login", "")
+        self.discovery.password = dut.get("password", "")
+        self.finder = DiscoveryThread(self.discovery, self)
+        self.finder.sigHost.connect(self.on_host_found)
+        self.finder.sigDone.connect(self.on_discovery_done)
+        self.finder.start()
+
+    @pyqtSlot(object)
+    def on_host_found(self, res):
+        if res["reachable"]:
+            self.log.append_html("Host <b>%s</b>-<i>%s</i>-%s" % (
+                res["ip"], html.escape(res["uname"] or res["error"] or ""),
+                res["serial"] or "-"))
+            self.cbHosts.addItem(res["ip"])
+        else:
+            self.log.append_html("UmTRX <b>%s</b> (no SSH)" % res["ip"])
+
+    @pyqtSlot(int, float)
+    def on_discovery_done(self, count, duration):
+        if count == 0:
+            self.log.append_text("No hosts were found")
+        else:
+            self.log.append_text("Found %d hosts in %.1f sec" %
+                                 (count, duration))
+        self.btFind.setEnabled(not self.started)
 
     @pyqtSlot()
     def on_btAll_clicked(self):
@@ -190,39 +333,39 @@ class MainWindowImpl(QMainWindow, main_form):
             self.listWidget.item(i).setCheckState(s)
 
     def on_test_visit(self, path, ti, kwargs):
-        """ visit function that print progress during test execution """
+        """ visit function that print progress during test execution. Called
+        from the worker thread """
         testname = "%s/%s" % (path, ti.testname)
         func = ti.func
 
-        self.app.processEvents()
         if not self.started:
-            self.txConsole.appendHtml(("<pre>[%s] <font color=\"red\">" +
-                                       "Aborting   %60s" +
-                                       "</font></pre>") % (self.get_ts(),
-                                                           testname))
+            self.worker.sigConsole.emit(("<pre>[%s] <font color=\"red\">" +
+                                        "Aborting   %60s" +
+                                        "</font></pre>") % (self.get_ts(),
+                                                            testname))
             return fwtp_core.TEST_ABORTED
 
         if not self.tests[ti.testname]:
-            self.txConsole.appendHtml(("<pre>[%s] <font color=\"red\">" +
-                                       "Skipping   %60s" +
-                                       "</font></pre>") % (self.get_ts(),
-                                                           testname))
+            self.worker.sigConsole.emit(("<pre>[%s] <font color=\"red\">" +
+                                        "Skipping   %60s" +
+                                        "</font></pre>") % (self.get_ts(),
+                                                            testname))
             return fwtp_core.TEST_NA
 
-        self.txConsole.appendHtml(("<pre>[%s] <font color=\"blue\">" +
-                                   "Executing  %60s" +
-                                   "</font></pre>") % (self.get_ts(),
-                                                       testname))
+        self.worker.sigConsole.emit(("<pre>[%s] <font color=\"blue\">" +
+                                    "Executing  %60s" +
+                                    "</font></pre>") % (self.get_ts(),
+                                                        testname))
         try:
             val = func(kwargs)
             res = self.tr.check_test_result(path, ti, val, **kwargs)
         except TimeoutError as e:
             res = fwtp_core.TEST_FAIL
             self.tr.set_test_result(path, ti, res)
-            self.txConsole.appendHtml(("<pre>[%s] <font color=\"red\">" +
-                                       "Timeout (%s) %60s" +
-                                       "</font></pre>") % (self.get_ts(),
-                                                           e, testname))
+            self.worker.sigConsole.emit(("<pre>[%s] <font color=\"red\">" +
+                                        "Timeout (%s) %60s" +
+                                        "</font></pre>") % (self.get_ts(),
+                                                            e, testname))
         except:
             if self.tests_debug:
                 traceback.print_exc()
@@ -232,7 +375,6 @@ class MainWindowImpl(QMainWindow, main_form):
 
     def on_start(self):
         """ Start the test execution """
-        self.app.processEvents()
         self.tests = {self.listWidget.item(i).text():
                       self.listWidget.item(i).checkState() == Qt.Checked
                       for i in range(
@@ -241,31 +383,84 @@ class MainWindowImpl(QMainWindow, main_form):
         dut = self.cbDevice.currentText()
         arfcn = int(self.spArfcn.value())
 
-        # Initialize test results structure
-        self.tr = MyTestResults(self.on_test_result,
-                                self.on_test_progress, self.on_enter_bundle)
-
         # Initialize basic variables that used by the tests
         self.args = {
             "DUT": dut,
             "ARFCN": arfcn,
             "BTS_IP": self.cbHosts.currentText(),
             "CMD57_PORT": self.lnPort.text(),
-            "TR": self.tr,
+            "SESSIONS": self.sessions,
             "UI": self,
             "CHAN": ""
         }
 
-        self.texec.run(self.args)
+        resume = self.resume_available and self.ask_dialog(
+            "The previous run was interrupted. Resume it skipping the "
+            "passed tests?")
+
+        if self.log.table is not None:
+            self.log.table.clear()
+        self.worker = TestExecutorThread(self.texec, self.args, resume, self)
+        self.worker.sigResult.connect(self.on_test_result)
+        self.worker.sigProgress.connect(self.on_test_progress)
+        self.worker.sigBundle.connect(self.on_enter_bundle)
+        self.worker.sigConsole.connect(self.log.append_html)
+        self.worker.sigAsk.connect(self.on_ask)
+        self.worker.sigDone.connect(self.on_finished)
 
+        # Initialize test results structure
+        self.tr = MyTestResults(self.worker.sigResult.emit,
+                                self.worker.sigProgress.emit,
+                                self.worker.sigBundle.emit)
+        self.args["TR"] = self.tr
+        # Metrics of this run only
+        testsuite_bts.METRICS.reset()
+        self.worker.start()
+
+    @pyqtSlot(bool, str)
+    def on_finished(self, ok, error):
+        """ Called in the main thread when the worker thread is done """
+        self.worker.wait()
+        self.worker = None
+        self.sessions.release()
+        self.resume_available = not ok or self.aborted
+        if not self.resume_available and "CHECKPOINT" in self.args:
+            # The run is completed, nothing to resume
+            self.args["CHECKPOINT"].remove()
+        if not ok:
+            self.test_ok = False
+            self.log.append_html(error)
+        else:
+            self.write_results()
+
+        if not self.test_ok:
+            self.log.append_html(
+                "<br><br><h2><font color=\"red\">" +
+                "TEST FAILED</font></h2>")
+        elif not self.started:
+            self.log.append_html(
+                "<br><br><h2><font color=\"yellow\">" +
+                "TEST ABORTED</font></h2>")
+        else:
+            self.log.append_html(
+                "<br><br><h2><font color=\"green\">" +
+                "TEST OK</font></h2>")
+        self.log.flush()
+        self.btStartStop.setText("Start")
+        self.btStartStop.setEnabled(True)
+        self.enable_controls(True)
+        self.started = False
+
+    def write_results(self):
+        """ Print summary and store results of the finished run """
         sm = self.tr.summary()
         for res in sm:
-            self.txConsole.appendHtml(
+            self.log.append_html(
                 "<pre>%s: %2d</pre>" % (HTML_RESULT_MAPS[res], sm[res]))
         failed = sm.setdefault(fwtp_core.TEST_NA, 0) + sm.setdefault(
             fwtp_core.TEST_ABORTED, 0) + sm.setdefault(fwtp_core.TEST_FAIL, 0)
         if failed > 0:
-            self.txConsole.appendHtml(
+            self.log.append_html(
                 "<br>%s<h1>WARNING! NOT ALL TEST PASSED!</h1>%s<br>" %
                 get_html_color_tags("red"))
             if self.started:
@@ -278,19 +473,50 @@ class MainWindowImpl(QMainWindow, main_form):
             f = open("out/bts-test." + test_id + ".json", 'w')
             f.write(self.tr.json())
             f.close()
+            testsuite_bts.save_transport_metrics(
+                self.args, "out/bts-test." + test_id + ".metrics.json")
         else:
-            self.txConsole.appendHtml(
+            self.log.append_html(
                 ("<br>%sTEST_ID variable wasn't declared during test, " +
                  "skiping writing results") % get_html_color_tags("red"))
 
     def on_stop(self):
-        self.txConsole.appendPlainText("ABORT requested")
-        self.app.processEvents()
+        self.log.append_text("ABORT requested")
+
+    def closeEvent(self, event):
+        """ Abort the running tests and wait for the worker threads before
+        the window is destroyed """
+        if self.worker is not None:
+            self.aborted = True
+            self.started = False
+            # Wake up the worker if it waits for the user
+            self.ask_reply = False
+            self.ask_event.set()
+            self.on_stop()
+            self.worker.wait()
+        if self.finder is not None:
+            self.finder.wait()
+        super().closeEvent(event)
 
     def ask(self, text):
-        self.app.processEvents()
+        """ Ask the user. Blocks the calling worker thread until the
+        question is answered in the main thread """
         if self.aborted:
             return False
+        if QThread.currentThread() == self.thread():
+            return self.ask_dialog(text)
+        self.ask_event.clear()
+        self.worker.sigAsk.emit(text)
+        self.ask_event.wait()
+        return self.ask_reply and not self.aborted
+
+    @pyqtSlot(str)
+    def on_ask(self, text):
+        """ Show the question for the worker thread """
+        self.ask_reply = False if self.aborted else self.ask_dialog(text)
+        self.ask_event.set()
+
+    def ask_dialog(self, text):
         reply = QMessageBox.question(self, 'Message',
                                      text, QMessageBox.Ok |
                                      QMessageBox.Cancel, QMessageBox.Ok)
@@ -303,15 +529,13 @@ class MainWindowImpl(QMainWindow, main_form):
 
     def on_enter_bundle(self, t, path, bundle, disc):
         """ Function is called before test execution """
-        self.app.processEvents()
         tcolot = get_html_color_tags("blue")
-        self.txConsole.appendHtml(("<pre>[%s] Bundle %s<b>%50s</b>%s:  %s" +
-                                   "</pre>") % (self.get_ts(t),
-                                                tcolot[0],
-                                                "%s/%s" % (path, bundle),
-                                                tcolot[1],
-                                                disc))
-        self.app.processEvents()
+        self.log.append_html(("<pre>[%s] Bundle %s<b>%50s</b>%s:  %s" +
+                              "</pre>") % (self.get_ts(t),
+                                           tcolot[0],
+                                           "%s/%s" % (path, bundle),
+                                           tcolot[1],
+                                           disc))
 
     def on_test_result(self, t, path, ti, result, value, old_result,
                        old_value, delta, reason=None):
@@ -329,16 +553,22 @@ class MainWindowImpl(QMainWindow, main_form):
         was = " (%7s)%s" % (HTML_RESULT_MAPS[old_result], sdelta) if \
             old_result is not None else ""
         exr = "" if reason is None else " (%s)" % reason
-        self.txConsole.appendHtml(("<pre>[%s] %s<b>%50s</b>%s:  %s %s%s %s" +
-                                   "</pre>") % (self.get_ts(t),
-                                                tcolot[0],
-                                                ti.INFO,
-                                                tcolot[1],
-                                                HTML_RESULT_MAPS[result],
-                                                was,
-                                                exr,
-                                                "" if value is None else str(
-                                                   value)))
+        self.log.append_row((self.get_ts(t), path, ti.INFO,
+                             fwtp_core.TEST_RESULT_NAMES[result],
+                             "" if value is None else str(value),
+                             "" if old_result is None else
+                             fwtp_core.TEST_RESULT_NAMES[old_result],
+                             "" if delta is None else "%+f" % delta))
+        self.log.append_html(("<pre>[%s] %s<b>%50s</b>%s:  %s %s%s %s" +
+                              "</pre>") % (self.get_ts(t),
+                                           tcolot[0],
+                                           ti.INFO,
+                                           tcolot[1],
+                                           HTML_RESULT_MAPS[result],
+                                           was,
+                                           exr,
+                                           "" if value is None else str(
+                                              value)))
 
     @staticmethod
     def get_ts(t=None):
@@ -349,9 +579,7 @@ class MainWindowImpl(QMainWindow, main_form):
 
     def on_test_progress(self, string):
         """ General test progress update """
-        self.app.processEvents()
-        self.txConsole.appendHtml("<pre>%s</pre>" % string)
-        self.app.processEvents()
+        self.log.append_html("<pre>%s</pre>" % string)
 
 
 class MyTestResults(fwtp_engine.TestResults):
@@ -384,7 +612,17 @@ if __name__ == '__main__':
     # some IDE marks this as unreferenced module but we actually handle
     # callback from the decorator inside
     import testsuite_bts
-    main = MainWindowImpl(app, "./oc.yaml")
+    import bts_params
+    import bts_discovery
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--script", dest='script',
+                        type=str, default="./oc.yaml",
+                        help="Test script to run (default: ./oc.yaml)")
+    parser.add_argument("-r", "--results-table", dest='results_table',
+                        action='store_true',
+                        help="Show structured results table")
+    args = parser.parse_args(app.arguments()[1:])
+    main = MainWindowImpl(app, args.script, args.results_table)
     main.show()
 
     sys.exit(app.exec_())
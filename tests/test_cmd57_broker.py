@@ -0,0 +1,225 @@
+import os
+import sys
+import queue
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cmd57_broker
+from cmd57_broker import BrokerConnection, Cmd57Broker
+
+# Time to wait for a reply of the broker (sec)
+REPLY_TIMEOUT = 2
+
+
+class FakeCmd57:
+    """ Instrument logging all calls """
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _log(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def identify(self):
+        self._log("identify")
+        return ["Rohde&Schwarz", "CMD57", "000000/000", "FAKE"]
+
+    def ask_peak_power(self):
+        self._log("ask_peak_power")
+        return 15.0
+
+    def switch_to_idle(self):
+        self._log("switch_to_idle")
+
+    def set_io_used(self, io):
+        self._log("set_io_used", io)
+
+    def ask_dev_state(self):
+        raise ValueError("No answer")
+
+
+class FakeConnection:
+    """ Client end of the broker connection """
+
+    def __init__(self):
+        self.replies = queue.Queue()
+
+    def send(self, reply):
+        self.replies.put(reply)
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dev = FakeCmd57()
+        self.broker = Cmd57Broker(self.dev, None)
+
+    def start(self):
+        threading.Thread(target=self.broker._dispatch, daemon=True).start()
+
+    def client(self):
+        return BrokerConnection(FakeConnection())
+
+    def request(self, client, method, *args, priority=10):
+        self.broker._put(priority, client, (method, args, {}))
+
+    def reply(self, client):
+        return client.conn.replies.get(timeout=REPLY_TIMEOUT)
+
+    def assertNoReply(self, client):
+        self.assertRaises(queue.Empty, client.conn.replies.get,
+                          timeout=0.1)
+
+    def test_call(self):
+        a = self.client()
+        self.start()
+        self.request(a, "set_io_used", "I1O2")
+        self.assertEqual(self.reply(a), (True, None))
+        self.assertEqual(self.dev.calls, [("set_io_used", "I1O2")])
+
+    def test_exception_is_returned(self):
+        a = self.client()
+        self.start()
+        self.request(a, "ask_dev_state")
+        ok, value = self.reply(a)
+        self.assertFalse(ok)
+        self.assertIsInstance(value, ValueError)
+
+    def test_priority_order(self):
+        a = self.client()
+        self.request(a, "set_io_used", "low", priority=20)
+        self.request(a, "set_io_used", "high", priority=1)
+        self.start()
+        self.reply(a)
+        self.reply(a)
+        self.assertEqual(self.dev.calls, [("set_io_used", "high"),
+                                          ("set_io_used", "low")])
+
+    def test_identical_queries_are_merged(self):
+        clients = [self.client() for i in range(3)]
+        for c in clients:
+            self.request(c, "ask_peak_power")
+        self.start()
+        for c in clients:
+            self.assertEqual(self.reply(c), (True, 15.0))
+        self.assertEqual(self.dev.calls, [("ask_peak_power",)])
+        self.assertEqual(self.broker.stats, {"requests": 3, "calls": 1})
+
+    def test_commands_are_not_merged(self):
+        a = self.client()
+        b = self.client()
+        self.request(a, "switch_to_idle")
+        self.request(b, "switch_to_idle")
+        self.start()
+        self.reply(a)
+        self.reply(b)
+        self.assertEqual(len(self.dev.calls), 2)
+
+    def test_exclusive_acquire(self):
+        a = self.client()
+        b = self.client()
+        self.start()
+        self.request(a, "acquire")
+        self.assertEqual(self.reply(a), (True, None))
+        self.request(b, "switch_to_idle")
+        self.assertNoReply(b)
+        self.request(a, "set_io_used", "I1O1")
+        self.reply(a)
+        self.request(a, "release")
+        self.assertEqual(self.reply(a), (True, None))
+        self.reply(b)
+        self.assertEqual(self.dev.calls, [("set_io_used", "I1O1"),
+                                          ("switch_to_idle",)])
+
+    def test_equal_configurations_share(self):
+        a = self.client()
+        b = self.client()
+        c = self.client()
+        self.start()
+        self.request(a, "acquire", ("UmTRX-v2.2", 100))
+        self.reply(a)
+        self.request(b, "acquire", ("UmTRX-v2.2", 100))
+        self.assertEqual(self.reply(b), (True, None))
+        self.request(c, "acquire", ("UmTRX-v2.2", 120))
+        self.assertNoReply(c)
+        self.request(a, "release")
+        self.reply(a)
+        self.assertNoReply(c)
+        self.request(b, "release")
+        self.reply(b)
+        self.assertEqual(self.reply(c), (True, None))
+
+    def test_waiting_configuration_isnt_overtaken(self):
+        a = self.client()
+        b = self.client()
+        c = self.client()
+        self.start()
+        self.request(a, "acquire", ("UmTRX-v2.2", 100))
+        self.reply(a)
+        self.request(b, "acquire", ("UmTRX-v2.2", 120))
+        self.assertNoReply(b)
+        # Same configuration as the owner, but B is waiting
+        self.request(c, "acquire", ("UmTRX-v2.2", 100))
+        self.assertNoReply(c)
+        self.request(a, "release")
+        self.reply(a)
+        self.assertEqual(self.reply(b), (True, None))
+        self.assertNoReply(c)
+
+    def test_new_section_releases_previous(self):
+        a = self.client()
+        b = self.client()
+        self.start()
+        self.request(a, "acquire", ("UmTRX-v2.2", 100))
+        self.reply(a)
+        self.request(b, "acquire", ("UmTRX-v2.2", 100, "ber"))
+        self.assertNoReply(b)
+        self.request(a, "acquire", ("UmTRX-v2.2", 100, "ber"))
+        self.assertEqual(self.reply(a), (True, None))
+        self.assertEqual(self.reply(b), (True, None))
+
+    def test_queries_merged_across_owners_only(self):
+        a = self.client()
+        b = self.client()
+        self.start()
+        self.request(a, "acquire", ("UmTRX-v2.2", 100))
+        self.reply(a)
+        self.request(b, "identify")
+        self.assertNoReply(b)
+        self.request(a, "identify")
+        self.reply(a)
+        self.assertEqual(len(self.dev.calls), 1)
+        self.request(a, "release")
+        self.reply(a)
+        self.reply(b)
+        self.assertEqual(len(self.dev.calls), 2)
+
+    def test_gone_client_releases(self):
+        a = self.client()
+        b = self.client()
+        self.start()
+        self.request(a, "acquire")
+        self.reply(a)
+        self.request(b, "switch_to_idle")
+        # Sent by the broker when the connection is closed
+        self.request(a, "release", priority=-1)
+        self.reply(b)
+        self.assertNoReply(a)
+        self.assertEqual(self.broker.owners, {})
+
+
+class TestIsQuery(unittest.TestCase):
+
+    def test_is_query(self):
+        for m in ("ask_peak_power", "fetch_phase_err_pk",
+                  "read_ber_test_result", "identify"):
+            self.assertTrue(cmd57_broker.is_query(m))
+        for m in ("switch_to_idle", "set_io_used", "configure_man"):
+            self.assertFalse(cmd57_broker.is_query(m))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fwtp_core import SessionRegistry, ResourceProxy, TestStats, \
+    TestSuiteConfig, account_resource, RES_CMD57, RES_SSH, RES_UDP
+
+
+class Session:
+
+    def __init__(self, name):
+        self.name = name
+        self.alive = True
+        self.closed = False
+        self.released = 0
+
+
+class TestSessionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = SessionRegistry()
+        self.created = []
+
+    def factory(self, name="s"):
+        def create():
+            s = Session(name)
+            self.created.append(s)
+            return s
+        return create
+
+    def get(self, key="k", release=None):
+        return self.sessions.get(key, self.factory(key),
+                                 lambda s: s.alive,
+                                 lambda s: setattr(s, "closed", True),
+                                 release)
+
+    def test_reuse(self):
+        s, reused = self.get()
+        self.assertFalse(reused)
+        self.sessions.release()
+        s2, reused = self.get()
+        self.assertTrue(reused)
+        self.assertIs(s2, s)
+        self.assertEqual(len(self.created), 1)
+
+    def test_keys_are_separate(self):
+        a, _ = self.get("a")
+        b, reused = self.get("b")
+        self.assertFalse(reused)
+        self.assertIsNot(a, b)
+
+    def test_dead_session_is_replaced(self):
+        s, _ = self.get()
+        self.sessions.release()
+        s.alive = False
+        s2, reused = self.get()
+        self.assertFalse(reused)
+        self.assertTrue(s.closed)
+        self.assertIsNot(s2, s)
+
+    def test_failing_check_replaces_session(self):
+        s, _ = self.get()
+
+        def check(obj):
+            raise OSError("Connection reset")
+        s2, reused = self.sessions.get("k", self.factory(), check)
+        self.assertFalse(reused)
+        self.assertIsNot(s2, s)
+
+    def test_release_callback(self):
+        released = []
+        s, _ = self.get(release=released.append)
+        self.sessions.release()
+        self.assertEqual(released, [s])
+        # Only the sessions in use are released
+        self.sessions.release()
+        self.assertEqual(released, [s])
+
+    def test_release_callback_errors_are_ignored(self):
+        def release(obj):
+            raise OSError("Broken pipe")
+        self.get("a", release)
+        b, _ = self.get("b", lambda s: setattr(s, "released", 1))
+        self.sessions.release()
+        self.assertEqual(b.released, 1)
+
+    def test_evict_idle(self):
+        busy, _ = self.get("busy")
+        idle, _ = self.get("idle")
+        self.sessions.release()
+        self.get("busy")
+        self.sessions.idle_timeout = 0
+        time.sleep(0.01)
+        self.sessions.evict_idle()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+
+    def test_close_all(self):
+        a, _ = self.get("a")
+        b, _ = self.get("b")
+        self.sessions.close_all()
+        self.assertTrue(a.closed and b.closed)
+        _, reused = self.get("a")
+        self.assertFalse(reused)
+
+
+class Instrument:
+
+    def measure(self, helper_time=0):
+        time.sleep(0.02)
+        if helper_time > 0:
+            account_resource(RES_UDP, "spi", time.time(), helper_time, 10)
+        return 5
+
+    def fail(self):
+        raise TimeoutError()
+
+
+class TestResourceProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = TestStats("/bundle", "test")
+        TestSuiteConfig.CURRENT_STATS = self.stats
+
+    def tearDown(self):
+        TestSuiteConfig.CURRENT_STATS = None
+
+    def test_calls_are_accounted(self):
+        dev = ResourceProxy(Instrument(), RES_CMD57)
+        self.assertEqual(dev.measure(), 5)
+        self.assertRaises(TimeoutError, dev.fail)
+        self.assertEqual(self.stats.round_trips, {RES_CMD57: 2})
+        self.assertGreaterEqual(self.stats.blocked[RES_CMD57], 0.02)
+        self.assertEqual([s[1] for s in self.stats.spans],
+                         ["measure", "fail"])
+
+    def test_nested_time_isnt_counted_twice(self):
+        dev = ResourceProxy(Instrument(), RES_SSH)
+        dev.measure(0.015)
+        self.assertEqual(self.stats.blocked[RES_UDP], 0.015)
+        self.assertEqual(self.stats.round_trips, {RES_SSH: 1, RES_UDP: 10})
+        self.assertLess(self.stats.blocked[RES_SSH], 0.02)
+        self.assertGreaterEqual(self.stats.total_blocked(), 0.02)
+
+    def test_outside_of_test(self):
+        TestSuiteConfig.CURRENT_STATS = None
+        self.assertEqual(ResourceProxy(Instrument(), RES_CMD57).measure(),
+                         5)
+
+
+if __name__ == '__main__':
+    unittest.main()
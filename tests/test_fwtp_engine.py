@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fwtp_core
+import fwtp_engine
+from fwtp_core import TestSuiteConfig, TEST_OK, TEST_FAIL, TEST_ABORTED
+
+# Names of the executed tests
+CALLS = []
+# Names of the tests to fail
+FAILING = set()
+
+
+def checkpoint_test(name, **kwargs):
+    def test(args):
+        CALLS.append(name)
+        return name not in FAILING
+    if name not in TestSuiteConfig.KNOWN_TESTS_DESC:
+        fwtp_core.test_checker_decorator(
+            name, INFO=name, CHECK=fwtp_core.test_bool_checker(),
+            **kwargs)(test)
+
+
+checkpoint_test("ckpt_setup", SETUP=True)
+checkpoint_test("ckpt_first")
+checkpoint_test("ckpt_second")
+checkpoint_test("ckpt_third")
+
+
+@fwtp_core.test_checker_decorator("ckpt_export", INFO="ckpt_export")
+def export_variable(args):
+    CALLS.append("ckpt_export")
+    args["EXPORTED"] = [1, 2]
+    return True
+
+
+def checkpoint_visitor(path, ti, kwargs):
+    val = ti.func(kwargs)
+    return kwargs["TR"].check_test_result(path, ti, val, **kwargs)
+
+
+class QuietTestResults(fwtp_engine.TestResults):
+    """ TestResults collecting the printed results """
+
+    def __init__(self):
+        fwtp_engine.TestResults.__init__(self)
+        self.progress = []
+        self.results = []
+
+    def output_progress(self, string):
+        self.progress.append(string)
+
+    def enter_bundle(self, t, path, bundle, disc):
+        pass
+
+    def print_result(self, t, path, ti, result, value,
+                     old_result, old_value, delta, reason):
+        self.results.append((ti.testname, result))
+
+
+SCRIPT = yaml.dump([{"bundle": {
+    "name": "checkpoint",
+    "testsuites": ["ckpt_setup", "ckpt_first", "ckpt_export",
+                   "ckpt_second", "ckpt_third"]}}])
+
+
+class TestCheckpointResume(unittest.TestCase):
+
+    def setUp(self):
+        self.visitor = TestSuiteConfig.DECORATOR_DEFAULT
+        TestSuiteConfig.DECORATOR_DEFAULT = checkpoint_visitor
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.filename)
+        del CALLS[:]
+        FAILING.clear()
+
+    def tearDown(self):
+        TestSuiteConfig.DECORATOR_DEFAULT = self.visitor
+        for f in (self.filename, self.filename + ".tmp"):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def run_script(self, resume=False, **args):
+        variables = {"DUT": "UmTRX-v2.2", "ARFCN": 100, "SESSIONS": None,
+                     "TR": QuietTestResults()}
+        variables.update(args)
+        fwtp_engine.TestExecutor(SCRIPT).run(variables, self.filename,
+                                             resume)
+        return variables
+
+    def load(self):
+        with open(self.filename, "r") as f:
+            return json.load(f)
+
+    def test_results_are_saved(self):
+        FAILING.add("ckpt_second")
+        self.run_script()
+        data = self.load()
+        self.assertEqual(data["identity"], {"DUT": "UmTRX-v2.2",
+                                            "ARFCN": 100})
+        self.assertEqual(data["variables"], {"EXPORTED": [1, 2]})
+        self.assertEqual(
+            {k: v[1] for k, v in data["results"].items()},
+            {"/checkpoint/ckpt_setup": TEST_OK,
+             "/checkpoint/ckpt_first": TEST_OK,
+             "/checkpoint/ckpt_export": TEST_OK,
+             "/checkpoint/ckpt_second": TEST_FAIL,
+             "/checkpoint/ckpt_third": TEST_OK})
+
+    def test_resume_skips_passed_tests(self):
+        FAILING.add("ckpt_second")
+        self.run_script()
+        FAILING.clear()
+        del CALLS[:]
+        variables = self.run_script(resume=True)
+        # Setup tests are always run again
+        self.assertEqual(CALLS, ["ckpt_setup", "ckpt_second"])
+        self.assertEqual(variables["EXPORTED"], [1, 2])
+        self.assertIn(("ckpt_first", TEST_OK), variables["TR"].results)
+
+    def test_resume_of_another_run(self):
+        self.run_script()
+        del CALLS[:]
+        variables = self.run_script(resume=True, ARFCN=120)
+        self.assertEqual(len(CALLS), 5)
+        self.assertTrue(any("of another run" in p
+                            for p in variables["TR"].progress))
+
+    def test_runtime_variables_dont_identify_run(self):
+        self.run_script()
+        del CALLS[:]
+        self.run_script(resume=True, SESSIONS=object(), UI=object())
+        self.assertEqual(CALLS, ["ckpt_setup"])
+
+    def test_interrupted_save_aborts_run(self):
+        save = fwtp_engine.TestCheckpoint.save
+        saves = []
+
+        def interrupted_save(cp):
+            saves.append(len(cp.results))
+            if len(saves) == 4:
+                raise KeyboardInterrupt()
+            save(cp)
+        with mock.patch.object(fwtp_engine.TestCheckpoint, "save",
+                               interrupted_save):
+            variables = self.run_script()
+        self.assertEqual(CALLS, ["ckpt_setup", "ckpt_first", "ckpt_export"])
+        self.assertTrue(variables["CHECKPOINT"].aborted)
+        self.assertEqual(variables["TR"].results[-2:],
+                         [("ckpt_second", TEST_ABORTED),
+                          ("ckpt_third", TEST_ABORTED)])
+        # The previous checkpoint is kept
+        self.assertEqual(sorted(self.load()["results"]),
+                         ["/checkpoint/ckpt_first",
+                          "/checkpoint/ckpt_setup"])
+
+    def test_failed_save_is_reported(self):
+        save = fwtp_engine.TestCheckpoint.save
+        saves = []
+
+        def failing_save(cp):
+            saves.append(len(cp.results))
+            if len(saves) == 3:
+                raise OSError("No space left on device")
+            save(cp)
+        with mock.patch.object(fwtp_engine.TestCheckpoint, "save",
+                               failing_save):
+            variables = self.run_script()
+        self.assertEqual(len(CALLS), 5)
+        self.assertTrue(any("No space left" in p
+                            for p in variables["TR"].progress))
+        self.assertEqual(len(self.load()["results"]), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
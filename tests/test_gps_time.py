@@ -0,0 +1,58 @@
+import os
+import sys
+import datetime
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import test_umtrx_gps_time as gps_time
+
+
+def nmea(body):
+    """ NMEA sentence with the checksum """
+    csum = 0
+    for c in body:
+        csum ^= ord(c)
+    return "$%s*%02X" % (body, csum)
+
+
+class TestParseZda(unittest.TestCase):
+
+    def test_valid_sentence(self):
+        self.assertEqual(
+            gps_time.parse_zda(nmea("GPZDA,201530.00,04,07,2002,00,00")),
+            datetime.datetime(2002, 7, 4, 20, 15, 30))
+
+    def test_fractional_seconds(self):
+        self.assertEqual(
+            gps_time.parse_zda(nmea("GPZDA,000001.25,31,12,2019,00,00")),
+            datetime.datetime(2019, 12, 31, 0, 0, 1, 250000))
+
+    def test_without_checksum(self):
+        self.assertEqual(
+            gps_time.parse_zda("$GPZDA,201530.00,04,07,2002,00,00"),
+            datetime.datetime(2002, 7, 4, 20, 15, 30))
+
+    def test_bad_checksum(self):
+        self.assertIsNone(
+            gps_time.parse_zda("$GPZDA,201530.00,04,07,2002,00,00*00"))
+
+    def test_other_sentence(self):
+        self.assertIsNone(gps_time.parse_zda(
+            nmea("GPGGA,201530.00,4916.45,N,12311.12,W,1,08,0.9,545.4,M,"
+                 "46.9,M,,")))
+
+    def test_no_fix(self):
+        self.assertIsNone(gps_time.parse_zda(nmea("GPZDA,,,,,00,00")))
+
+    def test_truncated(self):
+        self.assertIsNone(gps_time.parse_zda("$GPZDA,201530.00,04"))
+
+    def test_garbage(self):
+        self.assertIsNone(
+            gps_time.parse_zda(nmea("GPZDA,2015x0.00,04,07,2002,00,00")))
+        self.assertIsNone(
+            gps_time.parse_zda(nmea("GPZDA,201530.00,04,13,2002,00,00")))
+
+
+if __name__ == '__main__':
+    unittest.main()
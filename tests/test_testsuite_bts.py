@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "helper"))
+import testsuite_bts
+from fwtp_core import TestStats, TestSuiteConfig, RES_UDP
+
+EEPROM_LINES = ['    EEPROM ["serial"] is "UMTRX0001"\n',
+                '    EEPROM ["mac-addr"] is "00:50:c2:85:3f:ff"\n']
+
+
+class FakeBts(testsuite_bts.BtsControlBase):
+    """ BTS answering the queries with canned output """
+
+    def __init__(self):
+        self.commands = []
+        # Lines appended to the metrics log by the helpers
+        self.metrics_log = ""
+        testsuite_bts.BtsControlBase.__init__(
+            self, debug_output=lambda x: None)
+
+    def _exec(self, cmd_str):
+        self.commands.append(cmd_str)
+        return None, [], []
+
+    def _copy_file_list(self, dir_from, flie_list, dir_to):
+        pass
+
+    def _exec_stdout_b(self, cmd_str):
+        self.commands.append(cmd_str)
+        if cmd_str.startswith("uname -a"):
+            return [b"Linux umsite 3.10.0 armv7l\n",
+                    b"HW_MODEL=UmSITE-TM3\n", b"BAND=GSM900\n"]
+        if cmd_str.startswith("tail -c +"):
+            offset = int(cmd_str.split()[2][1:])
+            return [l.encode() + b"\n"
+                    for l in self.metrics_log[offset - 1:].splitlines()]
+        return []
+
+    def _exec_stdout_stderr_b(self, cmd_str):
+        self.commands.append(cmd_str)
+        if "usrp_burn_mb_eeprom" in cmd_str:
+            return [l.encode() for l in EEPROM_LINES]
+        if "umtrx_set_dcdc_r.py" in cmd_str:
+            self.metrics_log += json.dumps(
+                {"spi": {"count": 4, "total": 0.25}}) + "\n"
+        return []
+
+    def count(self, what):
+        return len([c for c in self.commands if what in c])
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.bts = FakeBts()
+
+    def test_system_info_is_read_once(self):
+        self.assertEqual(self.bts.get_uname(), "Linux umsite 3.10.0 armv7l")
+        self.assertEqual(self.bts.bts_get_hw_config("HW_MODEL"),
+                         ["UmSITE-TM3\n"])
+        self.assertEqual(self.bts.bts_get_hw_config("BAND"), ["GSM900\n"])
+        self.assertEqual(self.bts.count("uname -a"), 1)
+
+    def test_invalidate_system_info(self):
+        self.bts.get_uname()
+        self.bts.invalidate_cache("system")
+        self.bts.get_uname()
+        self.assertEqual(self.bts.count("uname -a"), 2)
+
+    def test_eeprom_values_are_read_once(self):
+        self.assertEqual(self.bts.get_umtrx_eeprom_val("serial"),
+                         "UMTRX0001")
+        self.assertEqual(self.bts.get_umtrx_eeprom_val("mac-addr"),
+                         "00:50:c2:85:3f:ff")
+        self.assertEqual(self.bts.count("usrp_burn_mb_eeprom"), 1)
+
+    def test_missing_eeprom_value_is_cached(self):
+        self.assertIsNone(self.bts.get_umtrx_eeprom_val("ip-addr"))
+        self.assertIsNone(self.bts.get_umtrx_eeprom_val("ip-addr"))
+        self.assertEqual(self.bts.count("usrp_burn_mb_eeprom"), 1)
+
+    def test_umtrx_reset_invalidates_eeprom(self):
+        self.bts.get_umtrx_eeprom_val("serial")
+        self.bts.get_uname()
+        self.bts.umtrx_reset_test()
+        self.bts.get_umtrx_eeprom_val("serial")
+        self.bts.get_uname()
+        self.assertEqual(self.bts.count("usrp_burn_mb_eeprom"), 2)
+        self.assertEqual(self.bts.count("uname -a"), 1)
+
+    def test_invalidate_all(self):
+        self.bts.get_umtrx_eeprom_val("serial")
+        self.bts.get_uname()
+        self.bts.invalidate_cache()
+        self.bts.get_umtrx_eeprom_val("serial")
+        self.bts.get_uname()
+        self.assertEqual(self.bts.count("usrp_burn_mb_eeprom"), 2)
+        self.assertEqual(self.bts.count("uname -a"), 2)
+
+
+class TestHelperTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.bts = FakeBts()
+        self.stats = TestStats("/bundle", "test")
+        TestSuiteConfig.CURRENT_STATS = self.stats
+
+    def tearDown(self):
+        TestSuiteConfig.CURRENT_STATS = None
+
+    def test_helper_udp_time_is_accounted(self):
+        self.bts.umtrx_set_dcdc_r(200)
+        self.bts.umtrx_set_dcdc_r(210)
+        self.assertEqual(self.stats.blocked, {RES_UDP: 0.5})
+        self.assertEqual(self.stats.round_trips, {RES_UDP: 8})
+        self.assertEqual(self.bts.metrics_offset, len(self.bts.metrics_log))
+
+    def test_reset_transport_metrics(self):
+        self.bts.umtrx_set_dcdc_r(200)
+        self.bts.metrics_log = ""
+        self.bts.reset_transport_metrics()
+        self.assertEqual(self.bts.metrics_offset, 0)
+        self.bts.umtrx_set_dcdc_r(210)
+        self.assertEqual(self.stats.round_trips, {RES_UDP: 8})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import socket
+import struct
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "helper"))
+import umtrx_ctrl
+
+VER = umtrx_ctrl.USRP2_CONTROL_PROTO_VERSION
+REQUEST = umtrx_ctrl.USRP2_CTRL_ID_TRANSACT_ME_SOME_SPI_BRO
+RESPONSE = umtrx_ctrl.USRP2_CTRL_ID_OMG_TRANSACTED_SPI_DUDE
+
+
+def spi_pack(data):
+    return lambda seq: umtrx_ctrl.pack_spi_fmt(VER, REQUEST, seq, 1, data,
+                                               0, 0, 16, 1)
+
+
+class FakeUmtrxSocket:
+    """ UDP socket of an UmTRX executing SPI requests in the arrival order.
+    The reply data is the request data plus 1 """
+
+    def __init__(self, drop=None):
+        # Drop the n-th received packets of the listed request data
+        self.drop = drop if drop is not None else {}
+        self.received = {}
+        self.executed = []
+        self.replies = []
+        self.timeout = None
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendto(self, pkt, addr):
+        p = struct.unpack(umtrx_ctrl.SPI_FMT, pkt)
+        seq, data = p[2], p[4]
+        n = self.received.get(data, 0)
+        self.received[data] = n + 1
+        if n in self.drop.get(data, ()):
+            return
+        self.executed.append(data)
+        self.replies.append(umtrx_ctrl.pack_spi_fmt(
+            VER, RESPONSE, seq, 1, data + 1, 0, 0, 16, 1))
+
+    def recv(self, size):
+        if len(self.replies) == 0:
+            raise socket.timeout()
+        return self.replies.pop(0)
+
+
+def transport(skt):
+    t = umtrx_ctrl.umtrx_udp_transport(skt, "127.0.0.1")
+    t.rtt.rto = 0.001
+    return t
+
+
+class TestTransactMany(unittest.TestCase):
+
+    def transact_many(self, t, values, window=umtrx_ctrl.UDP_WINDOW,
+                      seqs=None):
+        return t.transact_many([spi_pack(v) for v in values],
+                               umtrx_ctrl.SPI_FMT, RESPONSE, 4, "spi",
+                               window, seqs)
+
+    def test_results_in_request_order(self):
+        t = transport(FakeUmtrxSocket())
+        seqs = [None] * 4
+        self.assertEqual(self.transact_many(t, [10, 20, 30, 40], seqs=seqs),
+                         [11, 21, 31, 41])
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(len(set(seqs)), 4)
+        self.assertEqual(t.retransmits, 0)
+
+    def test_lost_request_is_retransmitted(self):
+        skt = FakeUmtrxSocket(drop={20: [0]})
+        t = transport(skt)
+        seqs = [None] * 3
+        self.assertEqual(self.transact_many(t, [10, 20, 30], seqs=seqs),
+                         [11, 21, 31])
+        self.assertEqual(t.retransmits, 1)
+        self.assertEqual(skt.received[20], 2)
+        self.assertGreater(seqs[1], seqs[2])
+
+    def test_no_reply_after_all_retries(self):
+        skt = FakeUmtrxSocket(drop={20: range(umtrx_ctrl.UDP_RETRIES + 1)})
+        t = transport(skt)
+        self.assertEqual(self.transact_many(t, [10, 20]), [11, None])
+        self.assertEqual(skt.received[20], umtrx_ctrl.UDP_RETRIES + 1)
+
+    def test_stale_replies_are_discarded(self):
+        skt = FakeUmtrxSocket()
+        # Reply to an unknown sequence number and a reply of another type
+        skt.replies.append(umtrx_ctrl.pack_spi_fmt(
+            VER, RESPONSE, 0xfffffff0, 1, 99, 0, 0, 16, 1))
+        skt.replies.append(umtrx_ctrl.pack_control_fmt(
+            VER, umtrx_ctrl.UMTRX_CTRL_ID_RESPONSE, 1))
+        t = transport(skt)
+        self.assertEqual(self.transact_many(t, [10]), [11])
+        self.assertEqual(t.stale, 2)
+
+    def test_window_limits_requests_in_flight(self):
+        skt = FakeUmtrxSocket()
+        sent = []
+        send = skt.sendto
+
+        def sendto(pkt, addr):
+            sent.append(len(skt.replies))
+            send(pkt, addr)
+        skt.sendto = sendto
+        t = transport(skt)
+        self.assertEqual(self.transact_many(t, range(6), window=2),
+                         list(range(1, 7)))
+        self.assertLessEqual(max(sent), 1)
+
+
+class TestTransactOrdered(unittest.TestCase):
+
+    def test_reordered_requests_are_sent_again(self):
+        # The first transmission of the first request is lost, so its
+        # retransmit is executed after the second request
+        skt = FakeUmtrxSocket(drop={10: [0]})
+        t = transport(skt)
+        res = t.transact_ordered([spi_pack(v) for v in (10, 20, 30)],
+                                 umtrx_ctrl.SPI_FMT, RESPONSE, 4, "spi")
+        self.assertEqual(res, [11, 21, 31])
+        self.assertEqual(skt.executed[-3:], [10, 20, 30])
+
+    def test_first_reordered(self):
+        self.assertIsNone(umtrx_ctrl.first_reordered([1, 2, 3]))
+        self.assertIsNone(umtrx_ctrl.first_reordered([1, None, 3]))
+        self.assertEqual(umtrx_ctrl.first_reordered([4, 2, 3]), 1)
+        self.assertEqual(umtrx_ctrl.first_reordered([1, 2, 5, 3]), 3)
+
+
+class TestRttEstimator(unittest.TestCase):
+
+    def test_rto_follows_rtt(self):
+        rtt = umtrx_ctrl.rtt_estimator()
+        self.assertEqual(rtt.rto, umtrx_ctrl.UDP_INITIAL_RTO)
+        rtt.sample(0.01)
+        self.assertAlmostEqual(rtt.rto, 0.01 + 4 * 0.005)
+        for i in range(50):
+            rtt.sample(0.0001)
+        self.assertEqual(rtt.rto, umtrx_ctrl.UDP_MIN_RTO)
+        rtt.sample(10)
+        self.assertEqual(rtt.rto, umtrx_ctrl.UDP_TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
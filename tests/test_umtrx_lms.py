@@ -0,0 +1,161 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "helper"))
+import umtrx_ctrl
+import umtrx_lms
+
+
+class FakeLmsSpi:
+    """ SPI bus of a LMS modelling the DC calibration registers """
+
+    def __init__(self, spi_num=1):
+        self.spi_num = spi_num
+        self.regs = dict((x, 0) for x in range(128))
+        # DC values of every calibration module, selected by DC_ADDR
+        self.dc = dict((base, [31] * (umtrx_lms.DC_ADDR_MASK + 1))
+                       for base, _, _ in umtrx_lms.DC_CALIBRATION_MODULES)
+        self.writes = []
+
+    def _write(self, reg, data):
+        self.writes.append((reg, data))
+        if reg in self.dc:
+            # DC_REGVAL is read-only
+            return
+        self.regs[reg] = data
+        base = reg - 0x03
+        if base in self.dc and data & umtrx_lms.DC_LOAD:
+            addr = data & umtrx_lms.DC_ADDR_MASK
+            self.dc[base][addr] = self.regs[base + 0x02] & 0x3f
+
+    def _read(self, reg):
+        if reg in self.dc:
+            return self.dc[reg][self.regs[reg + 0x03] &
+                                umtrx_lms.DC_ADDR_MASK]
+        return self.regs[reg]
+
+    def spi_rw(self, data, num_bits, readback):
+        reg = (data >> 8) & 0x7f
+        if data & 0x8000:
+            self._write(reg, data & 0xff)
+            return 0
+        return self._read(reg)
+
+    def spi_rw_many(self, requests, window=umtrx_ctrl.UDP_WINDOW):
+        return [self.spi_rw(data, num_bits, readback)
+                for data, num_bits, readback in requests]
+
+
+def fake_lms_dev(spi_num=1):
+    lms_dev = umtrx_ctrl.umtrx_lms_device.__new__(
+        umtrx_ctrl.umtrx_lms_device)
+    lms_dev.spi = FakeLmsSpi(spi_num)
+    lms_dev.verbosity = 0
+    return lms_dev
+
+
+def calibration(values):
+    """ Calibration with the DC values from `values` in the module order """
+    dc = []
+    for base, num, _ in umtrx_lms.DC_CALIBRATION_MODULES:
+        for addr in range(num):
+            dc.append([base, addr, next(values)])
+    return {"dc": dc, "fields": [[0x35, 0x3f, 0x15], [0x56, 0x70, 0x30]]}
+
+
+class TestApplyCalibration(unittest.TestCase):
+
+    def test_apply_loads_dc_values(self):
+        lms_dev = fake_lms_dev()
+        cal = calibration(iter(range(5, 64, 3)))
+        umtrx_lms.lms_apply_calibration(lms_dev, cal)
+        self.assertEqual(umtrx_lms.lms_verify_calibration(lms_dev, cal), [])
+        self.assertEqual(umtrx_lms.lms_read_calibration(lms_dev)["dc"],
+                         cal["dc"])
+
+    def test_apply_doesnt_write_regval(self):
+        lms_dev = fake_lms_dev()
+        umtrx_lms.lms_apply_calibration(lms_dev, calibration(iter(
+            range(5, 64, 3))))
+        bases = [m[0] for m in umtrx_lms.DC_CALIBRATION_MODULES]
+        self.assertEqual([w for w in lms_dev.spi.writes if w[0] in bases],
+                         [])
+
+    def test_apply_keeps_control_registers(self):
+        lms_dev = fake_lms_dev()
+        lms_dev.spi.regs[0x09] = 0x40
+        lms_dev.spi.regs[0x33] = 0x42 | umtrx_lms.DC_LOAD
+        umtrx_lms.lms_apply_calibration(lms_dev, calibration(iter(
+            range(5, 64, 3))))
+        self.assertEqual(lms_dev.spi.regs[0x09], 0x40)
+        self.assertEqual(lms_dev.spi.regs[0x33], 0x42)
+
+    def test_verify_reports_values_not_loaded(self):
+        lms_dev = fake_lms_dev()
+        cal = calibration(iter(range(5, 64, 3)))
+        umtrx_lms.lms_apply_calibration(lms_dev, cal)
+        lms_dev.spi.dc[0x60][3] = 0
+        lms_dev.spi.regs[0x35] = 0
+        self.assertEqual(umtrx_lms.lms_verify_calibration(lms_dev, cal),
+                         [[0x60, 3], [0x35, 0x3f]])
+
+
+class TestSnapshotRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.lms_dev = fake_lms_dev()
+        for x in range(128):
+            self.lms_dev.spi.regs[x] = (x * 7) & 0xff
+        # Keep the DC calibration idle
+        for base, _, _ in umtrx_lms.DC_CALIBRATION_MODULES:
+            self.lms_dev.spi.regs[base + 0x03] &= umtrx_lms.DC_ADDR_MASK
+        umtrx_lms.lms_apply_calibration(self.lms_dev, calibration(iter(
+            range(5, 64, 3))))
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_round_trip(self):
+        regs = umtrx_lms.snapshot(self.lms_dev)
+        dc = umtrx_lms.lms_read_calibration(self.lms_dev)["dc"]
+        umtrx_lms.save_snapshot(self.filename, regs, dc)
+        # Perturb the registers and the DC values
+        umtrx_lms.lms_apply_calibration(self.lms_dev, calibration(iter(
+            range(60, 0, -2))))
+        self.lms_dev.reg_write_many([(0x40, 0x11), (0x72, 0x22)])
+
+        regs_loaded, dc_loaded = umtrx_lms.load_snapshot(self.filename)
+        self.assertEqual(regs_loaded, regs)
+        self.assertEqual(dc_loaded, dc)
+        changed, failed = umtrx_lms.restore(self.lms_dev, regs_loaded,
+                                            dc_loaded)
+        self.assertIn(0x40, changed)
+        self.assertIn(0x72, changed)
+        self.assertEqual(failed, [])
+        self.assertEqual(umtrx_lms.snapshot(self.lms_dev), regs)
+        self.assertEqual(umtrx_lms.lms_read_calibration(self.lms_dev)["dc"],
+                         dc)
+
+    def test_restore_reports_dc_not_loaded(self):
+        regs = umtrx_lms.snapshot(self.lms_dev)
+        dc = umtrx_lms.lms_read_calibration(self.lms_dev)["dc"]
+        umtrx_lms.lms_apply_calibration(
+            self.lms_dev, {"dc": [[0x30, 1, 9], [0x60, 2, 9]], "fields": []})
+        # DC_LOAD doesn't work on the Rx VGA2 module
+        real_write = self.lms_dev.spi._write
+
+        def write(reg, data):
+            real_write(reg, data & ~umtrx_lms.DC_LOAD
+                       if reg == 0x63 else data)
+        self.lms_dev.spi._write = write
+        changed, failed = umtrx_lms.restore(self.lms_dev, regs, dc)
+        self.assertEqual(failed, [0x60])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import json
 import atexit
 from scpi.devices import cmd57_console as cmd57
+import cmd57_broker
+import cmd57_sim
 # from scpi.errors import TimeoutError
 
 from fwtp_core import *
@@ -14,25 +19,129 @@ import time
 import paramiko
 import subprocess
 import re
+import io
+import random
+import queue
+import signal
+import threading
+from urllib.parse import urlparse, parse_qsl
 
 from abc import ABCMeta, abstractmethod
 
+# Helpers are shared with the tester
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "helper"))
+import transport_metrics
+from transport_metrics import METRICS, now
+
+# Time to wait for the command output to end after the command is aborted
+ABORT_DRAIN_TIMEOUT = 5
+
+HW_CONFIG_FILE = '/etc/osmocom/hardware.conf'
+
+# Results of the executed tests to resume an interrupted run
+CHECKPOINT_FILE = 'out/bts-test.checkpoint.json'
+
+# Service readiness polling: total timeout and backoff limits (sec)
+SERVICE_READY_TIMEOUT = 60
+SERVICE_POLL_MIN = 0.1
+SERVICE_POLL_MAX = 2.0
+SERVICE_READY_MARK = "READY"
+# osmo-trx is ready when it has bound the clock socket of TRX0, UDP port
+# 5700 (0x1644). The local address is the 2nd column of /proc/net/udp
+OSMO_TRX_READY_PROBE = \
+    "awk '$2 ~ /:1644$/ { f = 1 } END { exit !f }' /proc/net/udp"
+
+# Time to wait for a reply of the VTY session helper (sec)
+VTY_SESSION_TIMEOUT = 30
+
+# OsmoBTS VTY node of TRX0 configuration
+VTY_NODE_TRX0 = ["configure terminal", "bts 0", "trx 0"]
+
+
+class VtyError(Exception):
+    """ OsmoBTS VTY command has failed """
+    pass
+
+
+class VtySession:
+    """
+    Client of the osmobts-vty-session.py helper running on the BTS. The
+    helper keeps the VTY connection open, so every request costs one round
+    trip.
+    """
+
+    def __init__(self, stdin, stdout, timeout=VTY_SESSION_TIMEOUT):
+        """
+        :param stdin: Helper stdin stream
+        :param stdout: Helper stdout stream
+        :param timeout: Time to wait for a reply (sec)
+        """
+        self.stdin = stdin
+        self.timeout = timeout
+        self.lines = queue.Queue()
+        # Blocking reads of the stream can't time out, read it in a thread
+        threading.Thread(target=self._reader, args=(stdout,),
+                         daemon=True).start()
+
+    def _reader(self, stdout):
+        try:
+            for line in iter(stdout.readline, ''):
+                if len(line) == 0:
+                    break
+                self.lines.put(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.lines.put(None)
+
+    def run(self, node, commands):
+        """
+        Execute VTY commands
+        :param node: List of commands entering the config node from the
+                     enable node, [] for the enable node
+        :param commands: List of commands to execute in the node
+        :return: List of command outputs
+        """
+        self.stdin.write((json.dumps({"node": node, "commands": commands}) +
+                          "\n").encode("utf-8"))
+        self.stdin.flush()
+        try:
+            line = self.lines.get(timeout=self.timeout)
+        except queue.Empty:
+            raise IOError("VTY session helper hasn't replied in %d sec" %
+                          self.timeout)
+        if line is None:
+            # Keep the end mark for the following calls
+            self.lines.put(None)
+            raise IOError("VTY session helper has exited")
+        rep = json.loads(line if type(line) is str else line.decode("utf-8"))
+        if not rep["ok"]:
+            raise VtyError(rep["error"])
+        return rep["output"]
+
+    def close(self):
+        self.stdin.close()
+
 
 class BtsControlBase(metaclass=ABCMeta):
     """
     Base class for the BTS control
     """
 
-    helpers = ["obscvty.py", "osmobts-en-loopback.py",
-               "osmobts-set-maxdly.py", "osmobts-set-slotmask.py",
+    helpers = ["obscvty.py", "osmobts-vty-session.py",
                "osmo-trx-primary-trx.py", "umtrx_set_dcdc_r.py",
                "umtrx_get_vswr_sensors.py",
                # TODO: Move this from helpers to packages
                "umtrx_property_tree.py",
-               "umtrx_ctrl.py", "umtrx_lms.py"]
+               "umtrx_ctrl.py", "umtrx_lms.py", "transport_metrics.py",
+               "umtrx_ctrl_async.py", "umtrx_calibrate.py"]
 
     locals = ["test_umtrx_reset.py", "test_umtrx_gps_time.py"]
 
+    # Function used to output raw command results and progress messages
+    debug_output = print
+
     @abstractmethod
     def _exec(self, cmd_str):
         """ Execute command on the DUT """
@@ -67,68 +176,268 @@ class BtsControlBase(metaclass=ABCMeta):
         """
         return []
 
-    def __init__(self, tmpdir='/tmp/bts-test', sudopkg='sudo'):
+    def __init__(self, tmpdir='/tmp/bts-test', sudopkg='sudo',
+                 debug_output=None):
         """" Connect to a BTS and prepare it for testing """
+        if debug_output is not None:
+            self.debug_output = debug_output
+        # Results of the idempotent queries, see _cached()
+        self.query_cache = {}
+        self.vty_session = None
         # Copy helper scripts to the BTS
         self.tmpdir = tmpdir
-        self._exec_stdout('mkdir -p ' + self.tmpdir)
+        # Size of the metrics log already accounted to the tests
+        self.metrics_offset = 0
+        # Empty metrics log enables metrics collection in the helpers
+        self._exec_stdout('mkdir -p %s; : > %s/%s' % (
+            self.tmpdir, self.tmpdir, transport_metrics.METRICS_LOG))
         self._copy_file_list('helper/', self.helpers, self.tmpdir)
         self._copy_file_list('./', self.locals, self.tmpdir)
         self.sudo = sudopkg
 
-    @staticmethod
-    def _tee(stream, filename):
-        """ Write lines from the stream to the file and return the lines """
-        lines = [i if type(i) is str else i.decode("utf-8")
-                 for i in stream.readlines()]
-        f = open(filename, 'w')
-        f.writelines(lines)
-        f.close()
-        return lines
+    def _exec_streams(self, cmd_str):
+        """
+        Start command execution
+        :param cmd_str: command to execute
+        :return: (stdout, stderr, function aborting the command)
+        """
+        stdin, stdout, stderr = self._exec(cmd_str)
+        return stdout, stderr, lambda: None
+
+    def _exec_stream(self, cmd_str, on_line=None, files=None):
+        """
+        Execute command reading its stdout and stderr concurrently line by
+        line
+        :param cmd_str: command to execute
+        :param on_line: Function called with ("stdout" or "stderr", line)
+                        for every line as soon as it's received. The command
+                        is aborted if it returns True
+        :param files: Dictionary { "stdout" or "stderr" : filename } to
+                      write the lines to
+        :return: False if the command has been aborted, True otherwise
+        """
+        stdout, stderr, abort = self._exec_streams(cmd_str)
+        lines = queue.Queue()
+
+        def reader(name, stream):
+            try:
+                for line in iter(stream.readline, ''):
+                    if len(line) == 0:
+                        break
+                    lines.put((name, line if type(line) is str
+                               else line.decode("utf-8", "replace")))
+            except (OSError, ValueError):
+                # The stream is closed by abort()
+                pass
+            finally:
+                lines.put((name, None))
+
+        outs = {}
+        aborted = False
+        try:
+            for name in (files or {}):
+                outs[name] = open(files[name], 'w')
+            for name, stream in (("stdout", stdout), ("stderr", stderr)):
+                threading.Thread(target=reader, args=(name, stream),
+                                 daemon=True).start()
+            running = 2
+            while running > 0:
+                try:
+                    name, line = lines.get(
+                        timeout=ABORT_DRAIN_TIMEOUT if aborted else None)
+                except queue.Empty:
+                    break
+                if line is None:
+                    running -= 1
+                    continue
+                if name in outs:
+                    outs[name].write(line)
+                if not aborted and on_line is not None and \
+                        on_line(name, line):
+                    aborted = True
+                    try:
+                        abort()
+                    except OSError:
+                        # The command has already exited
+                        pass
+        finally:
+            for f in outs.values():
+                f.close()
+        return not aborted
+
+    def _cached(self, key, query):
+        """ Return the cached result of an idempotent query, run the query
+        on the first call """
+        if key not in self.query_cache:
+            self.query_cache[key] = query()
+        return self.query_cache[key]
+
+    def invalidate_cache(self, key=None):
+        """ Drop the cached query result or all of them if key is None.
+        Keys: "system" - uname and hardware.conf, "eeprom" - UmTRX EEPROM
+        """
+        if key is None:
+            self.query_cache = {}
+        else:
+            self.query_cache.pop(key, None)
+
+    def _read_system_info(self):
+        """ Read uname and hardware configuration with one command
+        :return: (uname string, list of hardware.conf lines) """
+        lines = self._exec_stdout('uname -a; cat %s' % HW_CONFIG_FILE)
+        return lines[0].strip(), lines[1:]
+
+    def _read_umtrx_eeprom(self, name):
+        """ Read UmTRX EEPROM value
+        :return: Dictionary of all values reported by usrp_burn_mb_eeprom """
+        lines = self._exec_stdout_stderr(
+            '/usr/lib/uhd/utils/usrp_burn_mb_eeprom --values "%s"' % name)
+        eeprom_val = re.compile(r' {4}EEPROM \["(.*)"\] is "(.*)"')
+        values = {}
+        for s in lines:
+            match = eeprom_val.match(s)
+            if match is not None:
+                values[match.group(1)] = match.group(2)
+        return values
 
     def get_uname(self):
         """ Get uname string """
-        return self._exec_stdout('uname -a')[0].strip()
+        return self._cached("system", self._read_system_info)[0]
+
+    def get_transport_metrics(self):
+        """ Collect transport metrics of the helpers run on the BTS """
+        metrics = transport_metrics.TransportMetrics()
+        for l in self._exec_stdout('cat %s/%s' % (
+                self.tmpdir, transport_metrics.METRICS_LOG)):
+            try:
+                metrics.merge(json.loads(l))
+            except ValueError:
+                pass
+        return metrics.snapshot()
+
+    def reset_transport_metrics(self):
+        """ Drop transport metrics of the helpers run on the BTS """
+        self._exec_stdout(': > %s/%s' % (self.tmpdir,
+                                         transport_metrics.METRICS_LOG))
+        self.metrics_offset = 0
+
+    def _exec_udp_helper(self, exec_func, cmd_str):
+        """
+        Execute a helper controlling the UmTRX over UDP and account its UDP
+        and property tree time to the test as RES_UDP
+        :param exec_func: Function executing the command, e.g. _exec_stdout
+        :param cmd_str: command to execute
+        :return: Result of exec_func
+        """
+        start = time.time()
+        try:
+            return exec_func(cmd_str)
+        finally:
+            self._account_helper_transport(start)
+
+    def _account_helper_transport(self, start):
+        """ Account the metrics appended to the log since the last call """
+        lines = self._exec_stdout('tail -c +%d %s/%s' % (
+            self.metrics_offset + 1, self.tmpdir,
+            transport_metrics.METRICS_LOG))
+        for l in lines:
+            # Skip the record being written now
+            if not l.endswith('\n'):
+                break
+            self.metrics_offset += len(l.encode("utf-8"))
+            try:
+                ops = json.loads(l)
+            except ValueError:
+                continue
+            for op in ops:
+                account_resource(RES_UDP, op, start, ops[op]["total"],
+                                 ops[op]["count"])
 
     def trx_set_primary(self, num):
-        """ Set primary TRX """
-        print("Setting primary TRX to TRX%d" % num)
-        return self._exec_stdout_stderr(
+        """ Set primary TRX
+        :return: True if osmo-trx run file has been changed, False if the
+                 TRX is primary already, None if the result is unknown """
+        self.debug_output("Setting primary TRX to TRX%d" % num)
+        res = [l.strip() for l in self._exec_stdout_stderr(
             'cd ' + self.tmpdir + '; ' +
-            '%s python osmo-trx-primary-trx.py %d' % (self.sudo, num))
+            '%s python osmo-trx-primary-trx.py %d' % (self.sudo, num))]
+        if "changed" in res:
+            return True
+        if "unchanged" in res:
+            return False
+        return None
+
+    def trx_apply_primary(self, num):
+        """ Set primary TRX and restart osmo-trx if the setting has been
+        changed or the result is unknown
+        :return: True if osmo-trx has been restarted """
+        if self.trx_set_primary(num) is False:
+            return False
+        self.osmo_trx_restart()
+        return True
+
+    def vty_run(self, node, commands):
+        """
+        Execute OsmoBTS VTY commands through the persistent VTY session.
+        The session helper is started on the first call and restarted once
+        if it has died. VtyError is raised if a command fails.
+        :param node: List of commands entering the config node from the
+                     enable node, [] for the enable node
+        :param commands: List of commands to execute in the node
+        :return: List of command outputs
+        """
+        for attempt in range(2):
+            if self.vty_session is None:
+                stdin, stdout, stderr = self._exec(
+                    'cd ' + self.tmpdir + '; ' +
+                    'python osmobts-vty-session.py')
+                self.vty_session = VtySession(stdin, stdout)
+            try:
+                return self.vty_session.run(node, commands)
+            except (IOError, OSError, ValueError):
+                self.vty_close()
+                if attempt > 0:
+                    raise
+
+    def vty_close(self):
+        """ Stop the VTY session helper """
+        if self.vty_session is not None:
+            try:
+                self.vty_session.close()
+            except (IOError, OSError):
+                pass
+            self.vty_session = None
 
     def bts_en_loopback(self):
         """ Enable loopbak in the BTS """
-        print("Enabling BTS loopback")
-        return self._exec_stdout_stderr(
-            'cd ' + self.tmpdir + '; ' +
-            'python osmobts-en-loopback.py')
+        self.debug_output("Enabling BTS loopback")
+        return self.vty_run([], ["bts 0 trx 0 ts 2 lchan 0 activate",
+                                 "bts 0 trx 0 ts 2 lchan 0 loopback"])
 
     def bts_set_slotmask(self, ts0, ts1, ts2, ts3, ts4, ts5, ts6, ts7):
         """ Set BTS TRX0 slotmask """
-        print("Setting BTS slotmask")
-        return self._exec_stdout_stderr(
-            'cd ' + self.tmpdir + '; ' +
-            'python osmobts-set-slotmask.py %d %d %d %d %d %d %d %d'
-            % (ts0, ts1, ts2, ts3, ts4, ts5, ts6, ts7))
+        self.debug_output("Setting BTS slotmask")
+        return self.vty_run(VTY_NODE_TRX0, [
+            "slotmask %d %d %d %d %d %d %d %d" %
+            (ts0, ts1, ts2, ts3, ts4, ts5, ts6, ts7)])
 
-    def umtrx_get_gps_time(self):
+    def umtrx_get_gps_time(self, samples=1):
         """Obtain time diff GPS vs system"""
         return self._exec_stdout_stderr(
             'cd ' + self.tmpdir + '; ' +
-            '%s python3 test_umtrx_gps_time.py' % self.sudo)
+            '%s python3 test_umtrx_gps_time.py -n %d' % (self.sudo, samples))
 
     def bts_get_hw_config(self, param):
-        """ Get hardware configuration parameter """
-        return self._exec_stdout_stderr(
-            'cat /etc/osmocom/hardware.conf | grep %s | cut -d= -f2' % param)
+        """ Get hardware configuration parameter. Same as
+        'grep <param> hardware.conf | cut -d= -f2' """
+        return [l.rstrip('\n').split('=')[1 if '=' in l else 0] + '\n'
+                for l in self._cached("system", self._read_system_info)[1]
+                if param in l]
 
     def bts_set_maxdly(self, val):
         """ Set BTS TRX0 max timing advance """
-        print("BTS: setting max delay to %d." % val)
-        return self._exec_stdout_stderr(
-            'cd ' + self.tmpdir + '; ' +
-            'python osmobts-set-maxdly.py %d' % val)
+        self.debug_output("BTS: setting max delay to %d." % val)
+        return self.vty_run(VTY_NODE_TRX0, ["maxdly %d" % val])
 
     def bts_led_blink(self, period=1):
         """ Continously blink LED """
@@ -140,13 +449,30 @@ class BtsControlBase(metaclass=ABCMeta):
         return self._exec_stdout_stderr(
             '%s umsite-led-on-%s.sh' % (self.sudo, 'on' if on else 'off'))
 
+    def is_alive(self):
+        """ Check that the BTS responds and the helpers are in place, used
+        before reusing the connection for another test run """
+        try:
+            lines = self._exec_stdout('test -d %s && echo alive' %
+                                      self.tmpdir)
+        except Exception:
+            return False
+        return len(lines) > 0 and lines[0].strip() == "alive"
+
+    def close(self):
+        """ Release the BTS connection """
+        self.vty_close()
+
     def bts_shutdown(self):
         """ Shutdown BTS host """
+        self.invalidate_cache()
+        self.vty_close()
         return self._exec_stdout_stderr(
             '%s shutdown -h now' % self.sudo)
 
     def umtrx_reset_test(self):
         """ Do umtrx reset and get console output form it """
+        self.invalidate_cache("eeprom")
         return self._exec_stdout_stderr(
             'cd ' + self.tmpdir + '; ' +
             '%s python3 test_umtrx_reset.py' % self.sudo)
@@ -154,7 +480,8 @@ class BtsControlBase(metaclass=ABCMeta):
     def umtrx_set_dcdc_r(self, val):
         """ Set UmTRX DCDC control register value """
         # print("UmTRX: setting DCDC control register to %d." % val)
-        return self._exec_stdout_stderr(
+        return self._exec_udp_helper(
+            self._exec_stdout_stderr,
             'cd ' + self.tmpdir + '; ' +
             'python umtrx_set_dcdc_r.py %d' % val)
 
@@ -162,64 +489,104 @@ class BtsControlBase(metaclass=ABCMeta):
         """ Set UmTRX Tx VGA2 gain """
         # print("UmTRX: setting UmTRX Tx VGA2 gain for chan %d to %d." %
         #       (chan, val))
-        return self._exec_stdout_stderr(
+        return self._exec_udp_helper(
+            self._exec_stdout_stderr,
             'cd ' + self.tmpdir + '; ' +
             'python umtrx_lms.py --lms %d --lms-set-tx-vga2-gain %d'
             % (chan, val))
 
     def umtrx_get_vswr_sensors(self, chan):
         """ Read UmTRX VPR and VPF sensors """
-        lines = self._exec_stdout(
+        lines = self._exec_udp_helper(
+            self._exec_stdout,
             'cd ' + self.tmpdir + '; ' +
             'python umtrx_get_vswr_sensors.py')
         res = [float(x.strip()) for x in lines]
         start = (chan - 1) * 2
         return res[start:start + 2]
 
-    def start_runit_service(self, service):
-        """ Start a runit controlled service """
-        print("Starting '%s' service." % service)
-        return self._exec_stdout_stderr(
+    def start_runit_service(self, service, probe=None):
+        """ Start a runit controlled service and wait till it's ready
+        :param probe: Shell command succeeding when the service is ready
+        :return: Time to ready (sec) or None if it's not ready in time """
+        self.debug_output("Starting '%s' service." % service)
+        t0 = time.time()
+        self._exec_stdout_stderr(
             '%s sv start %s' % (self.sudo, service))
-        # TODO: Check result
+        return self.wait_runit_service(service, probe, t0=t0)
 
     def stop_runit_service(self, service):
         """ Stop a runit controlled service """
-        print("Stopping '%s' service." % service)
+        self.debug_output("Stopping '%s' service." % service)
         return self._exec_stdout_stderr(
             '%s sv stop %s' % (self.sudo, service))
-        # TODO: Check result
 
-    def restart_runit_service(self, service):
-        """ Restart a runit controlled service """
-        print("Restarting '%s' service." % service)
-        return self._exec_stdout_stderr(
+    def restart_runit_service(self, service, probe=None):
+        """ Restart a runit controlled service and wait till it's ready
+        :param probe: Shell command succeeding when the service is ready
+        :return: Time to ready (sec) or None if it's not ready in time """
+        self.debug_output("Restarting '%s' service." % service)
+        t0 = time.time()
+        self._exec_stdout_stderr(
             '%s sv restart %s' % (self.sudo, service))
-        # TODO: Check result
+        return self.wait_runit_service(service, probe, t0=t0)
+
+    def _runit_service_ready(self, service, probe=None):
+        """ Check once whether the service is up and the probe succeeds """
+        cmd = '%s sv status %s' % (self.sudo, service)
+        if probe is not None:
+            cmd += '; %s && echo %s' % (probe, SERVICE_READY_MARK)
+        lines = [l.strip() for l in self._exec_stdout(cmd)]
+        return any(l.startswith("run:") for l in lines) and \
+            (probe is None or SERVICE_READY_MARK in lines)
+
+    def wait_runit_service(self, service, probe=None,
+                           timeout=SERVICE_READY_TIMEOUT, t0=None):
+        """
+        Poll the service status with exponential backoff till it's ready
+        :param service: runit service name
+        :param probe: Shell command succeeding when the service is ready,
+                      e.g. checking a socket or a log message
+        :param timeout: Maximum time to wait (sec)
+        :param t0: Time the service has been (re)started at, now if None
+        :return: Time to ready (sec) or None if it's not ready in time
+        """
+        if t0 is None:
+            t0 = time.time()
+        delay = SERVICE_POLL_MIN
+        while True:
+            if self._runit_service_ready(service, probe):
+                return time.time() - t0
+            if time.time() + delay - t0 > timeout:
+                self.debug_output("Service '%s' is not ready in %d sec." %
+                                  (service, timeout))
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, SERVICE_POLL_MAX)
 
     def osmo_trx_start(self):
-        """ Start omso-trx service """
-        return self.start_runit_service("osmo-trx")
+        """ Start omso-trx service
+        :return: Time to ready (sec) or None if it's not ready in time """
+        return self.start_runit_service("osmo-trx", OSMO_TRX_READY_PROBE)
 
     def osmo_trx_stop(self):
         """ Stop osmo-trx service """
         return self.stop_runit_service("osmo-trx")
 
     def osmo_trx_restart(self):
-        """ Restart osmo-trx service """
-        return self.restart_runit_service("osmo-trx")
+        """ Restart osmo-trx service
+        :return: Time to ready (sec) or None if it's not ready in time """
+        return self.restart_runit_service("osmo-trx", OSMO_TRX_READY_PROBE)
 
     def get_umtrx_eeprom_val(self, name):
-        """ Read UmTRX serial from EEPROM.
+        """ Read UmTRX value from EEPROM, e.g. "serial".
             All UHD apps should be stopped at the time of reading. """
-        lines = self._exec_stdout_stderr(
-            '/usr/lib/uhd/utils/usrp_burn_mb_eeprom --values "serial"')
-        eeprom_val = re.compile(r' {4}EEPROM \["' + name + r'"\] is "(.*)"')
-        for s in lines:
-            match = eeprom_val.match(s)
-            if match is not None:
-                return match.group(1)
-        return None
+        values = self.query_cache.setdefault("eeprom", {})
+        if name not in values:
+            values.update(self._read_umtrx_eeprom(name))
+            # Missing values are cached too
+            values.setdefault(name, None)
+        return values[name]
 
     def umtrx_autocalibrate(self, preset, filename_stdout, filename_stderr):
         """ Run UmTRX autocalibration for the selected band.
@@ -227,46 +594,95 @@ class BtsControlBase(metaclass=ABCMeta):
                      GSM850, EGSM900 (same as GSM900),
                      GSM1800 (same as DCS1800), GSM1900 (same as PCS1900)
             All UHD apps should be stopped at the time of executing. """
-        stdin, stdout, stderr = self._exec(
-            '%s umtrx_auto_calibration %s' % (self.sudo, preset))
-        # TODO: Check result
-        lines = self._tee(stdout, filename_stdout)
-        self._tee(stderr, filename_stderr)
         line_re = re.compile(
             r'Calibration type .* side . from .* to .*: ([A-Z]+)')
-        if len(lines) == 0:
-            return False
+        stdout_lines = [0]
+
+        def on_line(name, line):
+            if name != "stdout":
+                return False
+            stdout_lines[0] += 1
+            match = line_re.match(line)
+            # Abort on the first failed calibration
+            return match is not None and match.group(1) != 'SUCCESS'
+
+        completed = self._exec_stream(
+            '%s umtrx_auto_calibration %s' % (self.sudo, preset), on_line,
+            {"stdout": filename_stdout, "stderr": filename_stderr})
+        return completed and stdout_lines[0] > 0
+
+    def umtrx_lms_calibrate(self, preset, filename_report, serial=None):
+        """ Calibrate both UmTRX LMS chips and check PLL tuning for the
+            selected bands with the umtrx_calibrate.py helper.
+            preset - Space separated bands as for umtrx_autocalibrate()
+            filename_report - File to save the JSON report to
+            serial - UmTRX serial to use the calibration cache with or None
+                     to run the full calibration
+            All UHD apps should be stopped at the time of executing.
+            Returns the report dictionary or None """
+        cmd = '%s python3 umtrx_calibrate.py --json --preset "%s"' % (
+            self.sudo, preset)
+        if serial is not None:
+            cmd += ' --calibration-cache --serial "%s"' % serial
+        return self._save_calibration_report(
+            self._exec_udp_helper(self._exec_stdout,
+                                  'cd ' + self.tmpdir + '; ' + cmd),
+            filename_report)
 
+    @staticmethod
+    def _save_calibration_report(lines, filename_report):
+        """ Find the JSON report in the helper output and save it """
+        report = None
         for l in lines:
-            match = line_re.match(l)
-            if match is not None:
-                if match.group(1) != 'SUCCESS':
-                    return False
-        return True
+            try:
+                report = json.loads(l)
+            except ValueError:
+                continue
+        if report is not None:
+            with open(filename_report, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
 
     def _exec_stdout(self, cmd_str):
         """ return array of string from execution _exec_stdout_b """
         barrs = self._exec_stdout_b(cmd_str)
-        print(barrs)
+        self.debug_output(barrs)
         return [i if type(i) is str else i.decode("utf-8") for i in barrs]
 
     def _exec_stdout_stderr(self, cmd_str):
         """ return array of string from execution _exec_stdout_stderr_b """
         barrs = self._exec_stdout_stderr_b(cmd_str)
-        print(barrs)
+        self.debug_output(barrs)
         return [i if type(i) is str else i.decode("utf-8") for i in barrs]
 
 
 class BtsControlSsh(BtsControlBase):
 
     def __init__(self, bts_ip, port=22, username='', password='',
-                 tmpdir='/tmp/bts-test'):
-        """ Connect to a BTS and prepare it for testing """
+                 tmpdir='/tmp/bts-test', prepare=True, debug_output=None):
+        """ Connect to a BTS and prepare it for testing. With
+        prepare=False only the connection is established, it's enough for
+        the queries not using helpers """
+        if debug_output is not None:
+            self.debug_output = debug_output
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh.connect(bts_ip, port=port, username=username,
                          password=password, timeout=2)
-        BtsControlBase.__init__(self, tmpdir)
+        self.query_cache = {}
+        self.vty_session = None
+        if prepare:
+            BtsControlBase.__init__(self, tmpdir, debug_output=debug_output)
+
+    def close(self):
+        self.vty_close()
+        self.ssh.close()
+
+    def is_alive(self):
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        return BtsControlBase.is_alive(self)
 
     def _exec_stdout_b(self, cmd_str):
         raise Exception('Incorrect usage!')
@@ -277,19 +693,37 @@ class BtsControlSsh(BtsControlBase):
     def _copy_file_list(self, dir_from, flie_list, dir_to):
         sftp = self.ssh.open_sftp()
         for f in flie_list:
+            t0 = now()
             sftp.put(dir_from + f, dir_to + '/' + f)
+            METRICS.record("sftp_put", now() - t0,
+                           os.path.getsize(dir_from + f))
         sftp.close()
 
     def _exec(self, cmd_str):
-        return self.ssh.exec_command(cmd_str)
+        t0 = now()
+        res = self.ssh.exec_command(cmd_str)
+        METRICS.record("ssh_exec", now() - t0, len(cmd_str))
+        return res
+
+    def _exec_streams(self, cmd_str):
+        stdin, stdout, stderr = self._exec(cmd_str)
+        return stdout, stderr, stdout.channel.close
 
     def _exec_stdout(self, cmd_str):
+        t0 = now()
         stdin, stdout, stderr = self.ssh.exec_command(cmd_str)
-        return stdout.readlines()
+        lines = stdout.readlines()
+        METRICS.record("ssh_exec", now() - t0, len(cmd_str),
+                       sum(len(l) for l in lines))
+        return lines
 
     def _exec_stdout_stderr(self, cmd_str):
+        t0 = now()
         stdin, stdout, stderr = self.ssh.exec_command(cmd_str)
-        return stderr.readlines() + stdout.readlines()
+        lines = stderr.readlines() + stdout.readlines()
+        METRICS.record("ssh_exec", now() - t0, len(cmd_str),
+                       sum(len(l) for l in lines))
+        return lines
 
 
 class BtsControlLocalManual(BtsControlBase):
@@ -297,9 +731,10 @@ class BtsControlLocalManual(BtsControlBase):
     Local manual control class
     """
 
-    def __init__(self, ui, tmpdir='/tmp/bts-test', sudopkg='sudo'):
+    def __init__(self, ui, tmpdir='/tmp/bts-test', sudopkg='sudo',
+                 debug_output=None):
         """ Connect to a BTS and prepare it for testing """
-        BtsControlBase.__init__(self, tmpdir, sudopkg)
+        BtsControlBase.__init__(self, tmpdir, sudopkg, debug_output)
         self.ui = ui
 
     def _copy_file_list(self, dir_from, flie_list, dir_to):
@@ -314,6 +749,15 @@ class BtsControlLocalManual(BtsControlBase):
                              shell=True)
         return p.stdin, p.stdout, p.stderr
 
+    def _exec_streams(self, cmd_str):
+        # Own process group to abort the shell together with its children
+        p = subprocess.Popen(cmd_str,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             shell=True, start_new_session=True)
+        return p.stdout, p.stderr, \
+            lambda: os.killpg(p.pid, signal.SIGKILL)
+
     def _exec_stdout_b(self, cmd_str):
         p = subprocess.Popen(cmd_str,
                              stdout=subprocess.PIPE,
@@ -327,14 +771,20 @@ class BtsControlLocalManual(BtsControlBase):
                              shell=True)
         return p.stdout.readlines()
 
+    def _ask_service(self, question):
+        """ Ask the operator to control a service
+        :return: Time to the confirmation (sec) or None if refused """
+        t0 = time.time()
+        return time.time() - t0 if self.ui.ask(question) else None
+
     def osmo_trx_start(self):
-        return self.ui.ask("Please start osmo-trx")
+        return self._ask_service("Please start osmo-trx")
 
     def osmo_trx_stop(self):
         return self.ui.ask("Please stop osmo-trx")
 
     def osmo_trx_restart(self):
-        return self.ui.ask("Please restart osmo-trx")
+        return self._ask_service("Please restart osmo-trx")
 
 
 class BtsControlLocal(BtsControlBase):
@@ -342,9 +792,10 @@ class BtsControlLocal(BtsControlBase):
     Local sv-based service BTS control
     """
 
-    def __init__(self, tmpdir='/tmp/bts-test', sudopkg='sudo'):
+    def __init__(self, tmpdir='/tmp/bts-test', sudopkg='sudo',
+                 debug_output=None):
         """ Connect to a BTS and prepare it for testing """
-        BtsControlBase.__init__(self, tmpdir, sudopkg)
+        BtsControlBase.__init__(self, tmpdir, sudopkg, debug_output)
 
     def _copy_file_list(self, dir_from, flie_list, dir_to):
         for f in flie_list:
@@ -358,6 +809,15 @@ class BtsControlLocal(BtsControlBase):
                              shell=True)
         return p.stdin, p.stdout, p.stderr
 
+    def _exec_streams(self, cmd_str):
+        # Own process group to abort the shell together with its children
+        p = subprocess.Popen(cmd_str,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             shell=True, start_new_session=True)
+        return p.stdout, p.stderr, \
+            lambda: os.killpg(p.pid, signal.SIGKILL)
+
     def _exec_stdout_b(self, cmd_str):
         p = subprocess.Popen(cmd_str,
                              stdout=subprocess.PIPE,
@@ -372,31 +832,237 @@ class BtsControlLocal(BtsControlBase):
         return p.stdout.readlines()
 
     def osmo_trx_start(self):
-        return self._exec_stdout_stderr("%s sv start osmo-trx" % self.sudo)
+        t0 = time.time()
+        self._exec_stdout_stderr("%s sv start osmo-trx" % self.sudo)
+        return self.wait_runit_service("osmo-trx", OSMO_TRX_READY_PROBE,
+                                       t0=t0)
 
     def osmo_trx_stop(self):
         return self._exec_stdout_stderr("%s sv stop osmo-trx" % self.sudo)
 
     def osmo_trx_restart(self):
-        return self._exec_stdout_stderr("%s sv restart osmo-trx" % self.sudo)
+        t0 = time.time()
+        self._exec_stdout_stderr("%s sv restart osmo-trx" % self.sudo)
+        return self.wait_runit_service("osmo-trx", OSMO_TRX_READY_PROBE,
+                                       t0=t0)
+
+
+class BtsControlSim(BtsControlBase):
+    """
+    Simulated BTS control for running test scripts without hardware.
+    Every remote call sleeps for `latency` plus a random `jitter` and fails
+    with TimeoutError with `failure_rate` probability.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 hw_model="UmSITE-TM3", band="GSM900", umtrx_ver="2.3.1",
+                 serial="SIM0001", seed=None, tmpdir='/tmp/bts-test',
+                 debug_output=None):
+        """ Create a simulated BTS """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rnd = random.Random(seed)
+        self.calls = 0
+        self.hw_config = {"HW_MODEL": hw_model, "BAND": band,
+                          "UMTRX_VER": umtrx_ver}
+        self.eeprom = {"serial": serial}
+        self.tx_vga2 = {1: UMSITE_TM3_VGA2_DEF, 2: UMSITE_TM3_VGA2_DEF}
+        self.dcdc_r = 255
+        self.primary_trx = 1
+        BtsControlBase.__init__(self, tmpdir, '', debug_output)
+
+    @staticmethod
+    def from_url(url, debug_output=None):
+        """
+        Create simulated BTS from
+        "sim://?latency=0.05&jitter=0.01&failure_rate=0.01&seed=1".
+        A plain "sim" string creates BTS with default parameters.
+        """
+        params = {"debug_output": debug_output}
+        for k, v in parse_qsl(urlparse(url).query):
+            if k in ("latency", "jitter", "failure_rate"):
+                params[k] = float(v)
+            elif k == "seed":
+                params[k] = int(v)
+            else:
+                params[k] = v
+        return BtsControlSim(**params)
+
+    def __str__(self):
+        return "Simulated BTS (latency %g sec, failure rate %g)" % (
+            self.latency, self.failure_rate)
+
+    def _sim_call(self, what):
+        """ Inject latency and failures into a remote call """
+        self.calls += 1
+        t = self.latency + self.rnd.uniform(0, self.jitter)
+        if t > 0:
+            time.sleep(t)
+        if self.rnd.random() < self.failure_rate:
+            raise TimeoutError("Simulated failure of '%s'" % what)
+
+    def _copy_file_list(self, dir_from, flie_list, dir_to):
+        self._sim_call("copy")
+
+    def _exec(self, cmd_str):
+        self._sim_call(cmd_str)
+        out = b""
+        if "umtrx_auto_calibration" in cmd_str:
+            out = b"".join(
+                ("Calibration type %s side A from 0 to 1: SUCCESS\n" %
+                 t).encode("utf-8") for t in ("dc", "iq"))
+        return io.BytesIO(), io.BytesIO(out), io.BytesIO()
+
+    def _exec_stdout_b(self, cmd_str):
+        self._sim_call(cmd_str)
+        return []
+
+    def _exec_stdout_stderr_b(self, cmd_str):
+        self._sim_call(cmd_str)
+        return []
+
+    def _read_system_info(self):
+        self._sim_call("uname; hardware.conf")
+        return "Linux umsite-sim 3.10.0 #1 SMP armv7l GNU/Linux", \
+            ["%s=%s\n" % (k, v) for k, v in self.hw_config.items()]
+
+    def _read_umtrx_eeprom(self, name):
+        self._sim_call("usrp_burn_mb_eeprom")
+        return dict(self.eeprom)
+
+    def _runit_service_ready(self, service, probe=None):
+        self._sim_call("sv status %s" % service)
+        return True
+
+    def is_alive(self):
+        try:
+            self._sim_call("echo alive")
+        except TimeoutError:
+            return False
+        return True
+
+    def trx_set_primary(self, num):
+        self._sim_call("osmo-trx-primary-trx.py")
+        changed = self.primary_trx != num
+        self.primary_trx = num
+        return changed
+
+    def vty_run(self, node, commands):
+        self._sim_call("vty: " + "; ".join(commands))
+        return ["" for cmd in commands]
+
+    def umtrx_get_gps_time(self, samples=1):
+        self._sim_call("test_umtrx_gps_time.py")
+        return ["Got %d ticks\n" % samples, "SUCCESS\n"]
+
+    def umtrx_reset_test(self):
+        self.invalidate_cache("eeprom")
+        self._sim_call("test_umtrx_reset.py")
+        return ["SUCCESS\n"]
+
+    def umtrx_set_tx_vga2(self, chan, val):
+        self._sim_call("umtrx_lms.py")
+        self.tx_vga2[chan] = val
+        return []
+
+    def umtrx_set_dcdc_r(self, val):
+        self._sim_call("umtrx_set_dcdc_r.py")
+        self.dcdc_r = val
+        return []
+
+    def umtrx_lms_calibrate(self, preset, filename_report, serial=None):
+        self._sim_call("umtrx_calibrate.py")
+        steps = []
+        for lms in (1, 2):
+            steps.append({"lms": lms, "step": "auto_calibration",
+                          "band": None, "start": 0.0, "duration": 0.0,
+                          "result": True})
+            for band in preset.split():
+                for step in ("tx_pll_tune", "rx_pll_tune"):
+                    steps.append({"lms": lms, "step": step, "band": band,
+                                  "start": 0.0, "duration": 0.0,
+                                  "result": True})
+        return self._save_calibration_report(
+            [json.dumps({"umtrx": "sim", "serial": serial,
+                         "bands": preset.split(), "duration": 0.0,
+                         "retransmits": 0, "result": True,
+                         "steps": steps})], filename_report)
+
+    def umtrx_get_vswr_sensors(self, chan):
+        self._sim_call("umtrx_get_vswr_sensors.py")
+        vpf = 0.5 + 0.05 * self.tx_vga2.get(chan, 0) + self.dcdc_r / 1000.0
+        return [round(vpf + self.rnd.gauss(0, 0.01), 2),
+                round(vpf / 10 + self.rnd.gauss(0, 0.01), 2)]
+
+
+def bts_debug_output(kwargs):
+    """ Function outputting BTS command results to the debug log of the
+    run """
+    return lambda x: kwargs["TR"].output_debug(str(x))
+
+
+def new_bts_control(kwargs, bts_ip):
+    """ Connect to the BTS and prepare it for testing """
+    dut_checks = kwargs["DUT_CHECKS"]
+    debug_output = bts_debug_output(kwargs)
+    if bts_ip == "sim" or bts_ip.startswith("sim://"):
+        return BtsControlSim.from_url(bts_ip, debug_output)
+    elif bts_ip == "local":
+        return BtsControlLocal(debug_output=debug_output)
+    elif bts_ip == "manual":
+        return BtsControlLocalManual(kwargs["UI"],
+                                     debug_output=debug_output)
+    return BtsControlSsh(
+        bts_ip, 22, dut_checks['login'], dut_checks['password'],
+        debug_output=debug_output)
 
 
 @test_checker_decorator("bts_connection",
-                        INFO="Establishing connection with the BTS")
+                        INFO="Establishing connection with the BTS",
+                        PROVIDES=["BTS"])
 def test_bts_connection(kwargs):
     bts_ip = kwargs["BTS_IP"] if "BTS_IP" in kwargs else "local"
-    dut_checks = kwargs["DUT_CHECKS"]
-    if bts_ip == "local":
-        bts = BtsControlLocal()
-    elif bts_ip == "manual":
-        bts = BtsControlLocalManual(kwargs["UI"])
+    sessions = kwargs.get("SESSIONS")
+    # The manual control is bound to the UI of the run
+    if sessions is None or bts_ip == "manual":
+        bts = new_bts_control(kwargs, bts_ip)
     else:
-        bts = BtsControlSsh(
-            bts_ip, 22, dut_checks['login'], dut_checks['password'])
-
-    kwargs["BTS"] = bts
+        bts, reused = sessions.get(
+            ("bts", bts_ip, kwargs["DUT_CHECKS"].get('login')),
+            lambda: new_bts_control(kwargs, bts_ip),
+            lambda b: b.is_alive(), lambda b: b.close())
+        if reused:
+            # The hardware might have been changed between the runs
+            bts.invalidate_cache()
+            bts.reset_transport_metrics()
+            kwargs["TR"].output_progress("Reusing connection to %s" % bts)
+
+    # A reused connection outputs to the run it's used by now
+    bts.debug_output = bts_debug_output(kwargs)
+    kwargs["BTS"] = ResourceProxy(bts, RES_SSH)
     return str(bts)
 
+
+def save_transport_metrics(kwargs, filename):
+    """
+    Save transport metrics of the tester and of the tested BTS
+    :param kwargs: Dictionary of variables after the run
+    :param filename: JSON file name
+    :return: None
+    """
+    bts_metrics = None
+    # Don't connect to the BTS only for the metrics of a resumed run
+    if "BTS" in kwargs and not isinstance(kwargs["BTS"], DeferredResource):
+        try:
+            bts_metrics = kwargs["BTS"].get_transport_metrics()
+        except Exception as e:
+            print("Can't collect BTS transport metrics: %s" % e)
+    with open(filename, "w") as f:
+        f.write(json.dumps({"tester": METRICS.snapshot(),
+                            "bts": bts_metrics},
+                           indent=4, separators=(',', ': ')))
+
 ###############################
 #   non-CMD57 based tests
 ###############################
@@ -438,7 +1104,7 @@ def umtrx_reset_test(kwargs):
                         INFO="UmTRX GPS time",
                         CHECK=test_bool_checker())
 def umtrx_gps_time(kwargs):
-    lns = kwargs["BTS"].umtrx_get_gps_time()
+    lns = kwargs["BTS"].umtrx_get_gps_time(kwargs.get("GPS_SAMPLES", 1))
     kwargs["TR"].output_progress(str(lns))
     return len(lns) > 0 and lns[-1].find('SUCCESS') != -1
 
@@ -459,8 +1125,16 @@ def set_primary_trx(kwargs):
     return chan
 
 
+@test_checker_decorator("apply_primary_trx",
+                        INFO="Set Primary TRX and restart osmo-trx if changed")
+def apply_primary_trx(kwargs):
+    chan = kwargs["CHAN"]
+    kwargs["BTS"].trx_apply_primary(chan)
+    return chan
+
+
 @test_checker_decorator("restart_osmo_trx",
-                        INFO="Restart osmo-trx service")
+                        INFO="Restart osmo-trx service, time to ready (sec)")
 def restart_osmo_trx(kwargs):
     return kwargs["BTS"].osmo_trx_restart()
 
@@ -512,17 +1186,68 @@ def bts_umtrx_autocalibrate(bts, preset, filename_stdout, filename_stderr):
     return bts.umtrx_autocalibrate(preset, filename_stdout, filename_stderr)
 
 
+@test_checker_decorator("umtrx_lms_calibrate",
+                        DUT=["UmTRX", "UmSITE"],
+                        INFO="UmTRX LMS calibration",
+                        CHECK=test_bool_checker())
+def bts_umtrx_lms_calibrate(kwargs):
+    bts = kwargs["BTS"]
+    report = bts.umtrx_lms_calibrate(get_band(kwargs["ARFCN"]),
+                                     "out/calibration." +
+                                     kwargs["TEST_ID"] + ".json",
+                                     bts.get_umtrx_eeprom_val("serial"))
+    return report is not None and report["result"]
+
+
 ###############################
 #   CMD57 based tests
 ###############################
 
+def new_cmd57(kwargs, cmd57_port):
+    """ Open the CMD57 control """
+    if cmd57_port.startswith(cmd57_sim.SIM_SCHEME):
+        return cmd57_sim.from_url(cmd57_port, kwargs.get("DUT_CHECKS"))
+    elif cmd57_port.startswith(cmd57_broker.BROKER_SCHEME):
+        # The instrument is acquired by cmd57_section()
+        return cmd57_broker.Cmd57BrokerClient(
+            cmd57_port, kwargs.get("CMD57_PRIORITY",
+                                   cmd57_broker.DEFAULT_PRIORITY))
+    return cmd57.rs232(cmd57_port, rtscts=True)
+
+
+def cmd57_section(kwargs, *config):
+    """ Start a configure and measure section of the run. The CMD57 shared
+    through the broker is acquired till the next section or the end of the
+    run. Runs of the same script with equal configurations share the
+    instrument, so their identical queries are merged by the broker """
+    if kwargs.get("CMD57_PORT", "").startswith(
+            cmd57_broker.BROKER_SCHEME):
+        kwargs["CMD"].acquire((kwargs["DUT"], kwargs["ARFCN"]) + config)
+
+
+def cmd57_release(dev):
+    """ Release the CMD57 at the end of the run """
+    if isinstance(dev, cmd57_broker.Cmd57BrokerClient):
+        dev.release()
+
+
 @test_checker_decorator("cmd57_init",
-                        INFO="Initialize CMD57")
+                        INFO="Initialize CMD57",
+                        PROVIDES=["CMD"])
 def test_cmd57_init(kwargs):
     cmd57_port = kwargs.get("CMD57_PORT", "/dev/ttyUSB0")
-    dev = cmd57.rs232(cmd57_port, rtscts=True)
-    kwargs["CMD"] = dev
-    atexit.register(dev.quit)
+    sessions = kwargs.get("SESSIONS")
+    if sessions is None:
+        dev = new_cmd57(kwargs, cmd57_port)
+        atexit.register(dev.quit)
+    else:
+        dev, reused = sessions.get(
+            ("cmd57", cmd57_port), lambda: new_cmd57(kwargs, cmd57_port),
+            lambda d: d.identify() is not None, lambda d: d.quit(),
+            cmd57_release)
+        if reused:
+            kwargs["TR"].output_progress("Reusing %s" % dev)
+    kwargs["CMD"] = ResourceProxy(dev, RES_CMD57)
     return str(dev)
 
 
@@ -716,7 +1441,8 @@ def test_spectrum_switching_match(kwargs):
 
 @test_checker_decorator("ber_configure",
                         INFO="BER test configuration",
-                        CHECK=test_ignore_checker())
+                        CHECK=test_ignore_checker(),
+                        SETUP=True)
 def test_ber_configure(kwargs):
     cmd = kwargs["CMD"]
     dut_checks = kwargs["DUT_CHECKS"]
@@ -726,7 +1452,6 @@ def test_ber_configure(kwargs):
         ber_unused_ts_power = dut_checks["ber_unused_ts_power"]
     else:
         ber_unused_ts_power = 30
-    cmd.set_ber_unused_ts_power(ber_unused_ts_power)
 
     if "ber_used_ts_power" in kwargs:
         ber_used_ts_power = kwargs["ber_used_ts_power"]
@@ -734,10 +1459,14 @@ def test_ber_configure(kwargs):
         ber_used_ts_power = dut_checks["ber_used_ts_power"]
     else:
         ber_used_ts_power = -104
-    cmd.set_ber_used_ts_power(ber_used_ts_power)
 
     ber_test_num = dut_checks["ber_test_num"] if \
         "ber_test_num" in dut_checks else 1
+
+    cmd57_section(kwargs, "ber", ber_unused_ts_power, ber_used_ts_power,
+                  ber_test_num)
+    cmd.set_ber_unused_ts_power(ber_unused_ts_power)
+    cmd.set_ber_used_ts_power(ber_used_ts_power)
     return cmd.set_ber_test_num(ber_test_num)
 
 
@@ -987,7 +1716,8 @@ def test_power_vswr_dcdc(kwargs):
 
 
 @test_checker_decorator("enable_tch_loopback",
-                        INFO="Enabling BTS loopback mode")
+                        INFO="Enabling BTS loopback mode",
+                        SETUP=True)
 def test_enable_tch_loopback(kwargs):
     kwargs["CMD"].switch_to_man_btch()
     return kwargs["BTS"].bts_en_loopback()
@@ -1007,12 +1737,14 @@ def cmd57_configure(cmd, arfcn):
 
 @test_checker_decorator("configure_cmd57",
                         INFO="Configure CMD57 for using with the DUT",
-                        CHECK=test_bool_checker())
+                        CHECK=test_bool_checker(),
+                        SETUP=True)
 def test_configure_cmd57(kwargs):
     cmd = kwargs["CMD"]
     arfcn = kwargs["ARFCN"]
     dut = kwargs["DUT"]
     kwargs["BTS"].bts_set_maxdly(10)
+    cmd57_section(kwargs)
 
     if dut.startswith("UmTRX"):
         cmd.set_io_used('I1O2')
@@ -1027,7 +1759,8 @@ def test_configure_cmd57(kwargs):
 
 @test_checker_decorator("run_tch_sync",
                         INFO="Syncronize CMD57 with the DUT",
-                        CHECK=test_val_checker(TEST_OK))
+                        CHECK=test_val_checker(TEST_OK),
+                        SETUP=True)
 def run_tch_sync(kwargs):
     # print("Starting Tx tests.")
 
@@ -1224,7 +1957,8 @@ def check_hw_band(kwargs):
 
 @test_checker_decorator("connect_rf_to_cmd57",
                         INFO="UI interactions to reconnect CMD57",
-                        CHECK=test_bool_checker())
+                        CHECK=test_bool_checker(),
+                        SETUP=True)
 def connect_rf_to_cmd57(kwargs):
     return kwargs["UI"].ask("Connect CMD57 to the TRX%s." %
                             str(kwargs.get("CHAN", "")))